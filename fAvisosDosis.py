@@ -0,0 +1,252 @@
+# fAvisosDosis.py
+# Servicio de avisos de dosis. Es un proceso que queda corriendo:
+#     python fAvisosDosis.py
+# Carga una sola vez los horarios de todos los medicamentos activos y después se entera de
+# los cambios (altas, finalizaciones, ocultos) por LISTEN/NOTIFY, sin volver a leer la tabla.
+import heapq
+import select
+from datetime import datetime, timedelta
+import psycopg2.extras
+from functions import connect_to_supabase
+from fmedi import horario_de, proxima_toma, _fecha_o_none
+
+CANAL_CAMBIOS = "medicamentos_cambios"
+LOTE_OUTBOX_DOSIS = 5000
+EPOCA = datetime(2000, 1, 1)
+UN_MINUTO = timedelta(minutes=1)
+
+def _a_minuto(momento):
+    return (momento - EPOCA) // UN_MINUTO
+
+def _de_minuto(minuto):
+    return EPOCA + minuto * UN_MINUTO
+
+class RuedaTemporal:
+    """
+    Rueda de tiempo jerárquica con resolución de un minuto.
+    Nivel 0: 60 ranuras de un minuto; nivel 1: 24 ranuras de una hora; nivel 2: 64 ranuras
+    de un día. Lo que queda más lejos espera en un heap. Agregar es O(1) y avanzar un minuto
+    solo toca la ranura de ese minuto; al empezar cada hora (o día) la ranura del nivel de
+    arriba se redistribuye hacia abajo.
+    """
+    NIVELES = ((60, 1), (24, 60), (64, 1440))
+
+    def __init__(self, minuto_actual):
+        self.actual = minuto_actual
+        self._ranuras = [[[] for _ in range(tamanio)] for tamanio, _ in self.NIVELES]
+        self._horizonte = self.NIVELES[-1][0] * self.NIVELES[-1][1]
+        self._lejanos = []
+        self._vencidos = []
+        self._orden = 0
+        self.cantidad = 0
+
+    def agregar(self, minuto, dato):
+        self.cantidad += 1
+        self._ubicar(minuto, dato)
+
+    def _ubicar(self, minuto, dato):
+        espera = minuto - self.actual
+        if espera <= 0:
+            self._vencidos.append((minuto, dato))
+            return
+        for nivel, (tamanio, resolucion) in enumerate(self.NIVELES):
+            if espera < tamanio * resolucion:
+                self._ranuras[nivel][(minuto // resolucion) % tamanio].append((minuto, dato))
+                return
+        self._orden += 1
+        heapq.heappush(self._lejanos, (minuto, self._orden, dato))
+
+    def _redistribuir(self, nivel, indice):
+        entradas = self._ranuras[nivel][indice]
+        self._ranuras[nivel][indice] = []
+        for minuto, dato in entradas:
+            self._ubicar(minuto, dato)
+
+    def avanzar(self, hasta_minuto):
+        """Avanza el reloj hasta `hasta_minuto` y devuelve [(minuto, dato)] de lo que venció."""
+        vencidos, self._vencidos = self._vencidos, []
+        while self.actual < hasta_minuto:
+            self.actual += 1
+            minuto = self.actual
+            if minuto % 1440 == 0:
+                while self._lejanos and self._lejanos[0][0] - minuto < self._horizonte:
+                    lejano, _, dato = heapq.heappop(self._lejanos)
+                    self._ubicar(lejano, dato)
+                self._redistribuir(2, (minuto // 1440) % 64)
+            if minuto % 60 == 0:
+                self._redistribuir(1, (minuto // 60) % 24)
+            ranura = self._ranuras[0][minuto % 60]
+            if ranura:
+                self._ranuras[0][minuto % 60] = []
+                vencidos.extend(ranura)
+            # Lo que se redistribuyó justo para este minuto cae en _vencidos
+            if self._vencidos:
+                vencidos.extend(self._vencidos)
+                self._vencidos = []
+        self.cantidad -= len(vencidos)
+        return vencidos
+
+class ServicioAvisosDosis:
+    """
+    Mantiene en la rueda la próxima toma de cada medicamento activo. Cuando vence, la
+    devuelve como evento y agenda la siguiente. Los cambios se aplican por medicamento:
+    cada recarga sube su versión, y las entradas viejas que siguen en la rueda se descartan
+    al vencer (cancelación perezosa, sin buscarlas).
+    """
+    def __init__(self, ahora=None):
+        ahora = ahora or datetime.now()
+        self.rueda = RuedaTemporal(_a_minuto(ahora))
+        self._medicamentos = {}
+        self._versiones = {}
+
+    def __len__(self):
+        return len(self._medicamentos)
+
+    def _agendar(self, id_medicamento, desde):
+        datos = self._medicamentos[id_medicamento]
+        siguiente = proxima_toma(datos["horario"], desde, datos["fecha_inicio"], datos["fecha_fin"])
+        if siguiente is None:
+            # El tratamiento terminó: se olvida sin esperar a otra notificación
+            del self._medicamentos[id_medicamento]
+            return
+        self.rueda.agregar(_a_minuto(siguiente), (id_medicamento, self._versiones[id_medicamento]))
+
+    def cargar(self, id_medicamento, id_paciente, frecuencia_tipo, frecuencia_valor, fecha_inicio, fecha_fin, ahora=None):
+        """Agrega o reemplaza un medicamento y agenda su próxima toma."""
+        horario = horario_de(frecuencia_tipo, frecuencia_valor)
+        self._versiones[id_medicamento] = self._versiones.get(id_medicamento, 0) + 1
+        if horario is None:
+            self._medicamentos.pop(id_medicamento, None)
+            return
+        self._medicamentos[id_medicamento] = {"id_paciente": id_paciente, "horario": horario,
+                                              "fecha_inicio": _fecha_o_none(fecha_inicio),
+                                              "fecha_fin": _fecha_o_none(fecha_fin)}
+        self._agendar(id_medicamento, ahora or _de_minuto(self.rueda.actual))
+
+    def quitar(self, id_medicamento):
+        self._versiones[id_medicamento] = self._versiones.get(id_medicamento, 0) + 1
+        self._medicamentos.pop(id_medicamento, None)
+
+    def avanzar(self, ahora):
+        """Devuelve [(id_medicamento, id_paciente, momento)] de las tomas que vencieron hasta `ahora`."""
+        eventos = []
+        for minuto, (id_medicamento, version) in self.rueda.avanzar(_a_minuto(ahora)):
+            if self._versiones.get(id_medicamento) != version or id_medicamento not in self._medicamentos:
+                continue
+            momento = _de_minuto(minuto)
+            eventos.append((id_medicamento, self._medicamentos[id_medicamento]["id_paciente"], momento))
+            # Desde el reloj actual: si el servicio estuvo frenado no se agendan tomas ya pasadas
+            self._agendar(id_medicamento, _de_minuto(self.rueda.actual))
+        return eventos
+
+_CONSULTA_ACTIVOS = """
+    SELECT id_medicamento, id_paciente, frecuencia_tipo, frecuencia_valor, fecha_inicio, fecha_fin
+    FROM medicamentos
+    WHERE (fecha_fin IS NULL OR fecha_fin > CURRENT_DATE)
+      AND (oculto IS NULL OR oculto = FALSE)
+"""
+
+def asegurar_esquema_avisos(conn):
+    """Crea el outbox de avisos de dosis y el trigger que notifica los cambios de medicamentos."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS outbox_dosis (
+                id BIGSERIAL PRIMARY KEY,
+                id_medicamento INTEGER NOT NULL,
+                id_paciente INTEGER NOT NULL,
+                momento TIMESTAMP NOT NULL,
+                creado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                enviado_en TIMESTAMP,
+                UNIQUE (id_medicamento, momento)
+            );
+            CREATE INDEX IF NOT EXISTS outbox_dosis_pendientes_idx
+                ON outbox_dosis (id) WHERE enviado_en IS NULL;
+
+            CREATE OR REPLACE FUNCTION notificar_cambio_medicamento() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    PERFORM pg_notify('{CANAL_CAMBIOS}', OLD.id_medicamento::text);
+                    RETURN OLD;
+                END IF;
+                PERFORM pg_notify('{CANAL_CAMBIOS}', NEW.id_medicamento::text);
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS medicamentos_cambios ON medicamentos;
+            CREATE TRIGGER medicamentos_cambios
+                AFTER INSERT OR DELETE
+                   OR UPDATE OF frecuencia_tipo, frecuencia_valor, fecha_inicio, fecha_fin, oculto
+                ON medicamentos
+                FOR EACH ROW EXECUTE FUNCTION notificar_cambio_medicamento();
+        """)
+    conn.commit()
+
+def cargar_activos(servicio, conn):
+    """Carga todos los medicamentos activos en una sola pasada, con un cursor del lado del servidor."""
+    with conn.cursor(name="avisos_dosis_activos") as cur:
+        cur.itersize = 10000
+        cur.execute(_CONSULTA_ACTIVOS)
+        for fila in cur:
+            servicio.cargar(*fila)
+    conn.commit()
+
+def recargar(servicio, conn, ids):
+    """Vuelve a leer solo los medicamentos que cambiaron; los que ya no están activos se quitan."""
+    with conn.cursor() as cur:
+        cur.execute(_CONSULTA_ACTIVOS + " AND id_medicamento = ANY(%s)", (list(ids),))
+        activos = {fila[0]: fila for fila in cur.fetchall()}
+    conn.commit()
+    for id_medicamento in ids:
+        if id_medicamento in activos:
+            servicio.cargar(*activos[id_medicamento], ahora=datetime.now())
+        else:
+            servicio.quitar(id_medicamento)
+
+def volcar_eventos(conn, eventos):
+    """Escribe los avisos vencidos en outbox_dosis. Devuelve cuántos eran nuevos."""
+    if not eventos:
+        return 0
+    with conn.cursor() as cur:
+        nuevos = psycopg2.extras.execute_values(cur, """
+            INSERT INTO outbox_dosis (id_medicamento, id_paciente, momento)
+            VALUES %s
+            ON CONFLICT (id_medicamento, momento) DO NOTHING
+            RETURNING id
+        """, eventos, page_size=LOTE_OUTBOX_DOSIS, fetch=True)
+    conn.commit()
+    return len(nuevos)
+
+def servir():
+    """
+    Bucle principal: espera hasta el próximo minuto o hasta que llegue una notificación,
+    aplica los cambios y vuelca al outbox las tomas que vencieron.
+    """
+    conn = connect_to_supabase()
+    asegurar_esquema_avisos(conn)
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {CANAL_CAMBIOS}")
+    conn.commit()
+
+    servicio = ServicioAvisosDosis()
+    cargar_activos(servicio, conn)
+    print(f"Avisos de dosis: {len(servicio)} medicamentos activos, {servicio.rueda.cantidad} tomas agendadas")
+
+    try:
+        while True:
+            ahora = datetime.now()
+            espera = (_de_minuto(_a_minuto(ahora) + 1) - ahora).total_seconds()
+            if select.select([conn], [], [], espera) != ([], [], []):
+                conn.poll()
+            # Las notificaciones también pueden llegar durante nuestras propias consultas
+            if conn.notifies:
+                cambiados = {int(aviso.payload) for aviso in conn.notifies}
+                conn.notifies.clear()
+                recargar(servicio, conn, cambiados)
+            nuevos = volcar_eventos(conn, servicio.avanzar(datetime.now()))
+            if nuevos:
+                print(f"{datetime.now():%H:%M} · {nuevos} avisos de dosis en el outbox")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    servir()
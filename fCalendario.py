@@ -1,10 +1,29 @@
 import streamlit as st
 import calendar
 import pandas as pd
-from datetime import datetime, timedelta, date
+from functools import lru_cache
+from datetime import datetime, timedelta, date, time, timezone
+from zoneinfo import ZoneInfo
 import psycopg2
+import psycopg2.errors
+import psycopg2.extras
+import io
+import os
+import re
+import threading
+from time import monotonic
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict, defaultdict
 from functions import connect_to_supabase 
 
+# Duración por defecto de un turno, en minutos
+DURACION_TURNO_MIN = 30
+# Los eventos importados más largos que esto se recortan: ningún turno dura más
+DURACION_MAXIMA_TURNO_MIN = 8 * 60
+# Zona horaria de la clínica: los turnos se guardan en esta hora local, sin zona
+ZONA_CLINICA = ZoneInfo(os.getenv("MEDCHECK_ZONA", "America/Argentina/Buenos_Aires"))
+
 # ------------------------
 # 🔍 Obtener días con turnos
 # ------------------------
@@ -56,6 +75,7 @@ def eliminar_turno(id_turno):
     conn.commit()
     cur.close()
     conn.close()
+    obtener_detector_conflictos().quitar(id_turno)
 
 def editar_turno(id_turno, nueva_fecha, nuevo_lugar):
     conn = connect_to_supabase()
@@ -88,37 +108,114 @@ def obtener_o_crear_paciente(dni):
     conn.close()
     return id_paciente
 
-def obtener_o_crear_medico(nombre, especialidad, lugar):
+# Se ejecuta una sola vez por proceso: deja id_medico como columna identity con la
+# secuencia después del MAX actual, junta los médicos repetidos que dejaron las altas
+# viejas y agrega la unicidad (nombre, especialidad) que necesita el ON CONFLICT de
+# obtener_o_crear_medico.
+_esquema_medicos_listo = False
+
+def asegurar_esquema_medicos():
+    """
+    Lanza RuntimeError si no se pudo preparar la tabla: sin la unicidad el ON CONFLICT
+    de obtener_o_crear_medico falla igual, así que mejor decir por qué.
+    """
+    global _esquema_medicos_listo
+    if _esquema_medicos_listo:
+        return True
+
+    query = """
+        DO $$
+        DECLARE
+            secuencia TEXT;
+            tabla TEXT;
+        BEGIN
+            -- Frena las altas mientras se acomodan la secuencia y los duplicados
+            LOCK TABLE medicos IN SHARE ROW EXCLUSIVE MODE;
+
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'medicos' AND column_name = 'id_medico'
+                  AND (is_identity = 'YES' OR column_default IS NOT NULL)
+            ) THEN
+                ALTER TABLE medicos ALTER COLUMN id_medico ADD GENERATED BY DEFAULT AS IDENTITY;
+            END IF;
+
+            -- Las altas con MAX(id_medico) + 1 insertaban ids explícitos: una secuencia
+            -- que ya existía puede haber quedado atrás del MAX
+            secuencia := pg_get_serial_sequence('medicos', 'id_medico');
+            IF secuencia IS NOT NULL THEN
+                PERFORM setval(secuencia, COALESCE(MAX(id_medico), 1), MAX(id_medico) IS NOT NULL)
+                FROM medicos;
+            END IF;
+
+            IF to_regclass('medicos_nombre_especialidad_key') IS NULL THEN
+                -- Médicos repetidos por carreras viejas: queda el id más chico y recibe sus turnos
+                CREATE TEMP TABLE medicos_repetidos ON COMMIT DROP AS
+                SELECT id_medico, id_canonico
+                FROM (
+                    SELECT id_medico, MIN(id_medico) OVER (PARTITION BY nombre, especialidad) AS id_canonico
+                    FROM medicos
+                    WHERE nombre IS NOT NULL AND especialidad IS NOT NULL
+                ) m
+                WHERE id_medico <> id_canonico;
+
+                IF EXISTS (SELECT 1 FROM medicos_repetidos) THEN
+                    FOREACH tabla IN ARRAY ARRAY['turnos', 'series_turnos', 'horarios_medicos'] LOOP
+                        IF to_regclass(tabla) IS NOT NULL THEN
+                            EXECUTE format('UPDATE %I t SET id_medico = r.id_canonico
+                                            FROM medicos_repetidos r WHERE t.id_medico = r.id_medico', tabla);
+                        END IF;
+                    END LOOP;
+                    UPDATE medicos m SET lugar = r.lugar
+                    FROM (
+                        SELECT DISTINCT ON (r.id_canonico) r.id_canonico, d.lugar
+                        FROM medicos_repetidos r JOIN medicos d ON d.id_medico = r.id_medico
+                        WHERE d.lugar IS NOT NULL
+                        ORDER BY r.id_canonico, r.id_medico DESC
+                    ) r
+                    WHERE m.id_medico = r.id_canonico AND m.lugar IS NULL;
+                    DELETE FROM medicos m USING medicos_repetidos r WHERE m.id_medico = r.id_medico;
+                END IF;
+
+                CREATE UNIQUE INDEX medicos_nombre_especialidad_key ON medicos (nombre, especialidad);
+            END IF;
+        END $$;
+    """
+    conn = connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+        _esquema_medicos_listo = True
+    except Exception as e:
+        conn.rollback()
+        raise RuntimeError(f"No se pudo preparar la tabla Medicos (identity/unique): {e}") from e
+    finally:
+        conn.close()
+    return _esquema_medicos_listo
+
+def obtener_o_crear_medico(nombre, especialidad, lugar=None):
+    """
+    Devuelve el id del médico (nombre, especialidad), creándolo si no existe.
+    Es un único INSERT ... ON CONFLICT, así que dos reservas simultáneas del mismo
+    médico nuevo no chocan. Si viene un lugar, se actualiza.
+    """
+    asegurar_esquema_medicos()
     conn = connect_to_supabase()
     cursor = conn.cursor()
 
     try:
-        # Verificar si ya existe el médico con ese nombre y especialidad
         cursor.execute(
-            "SELECT id_medico FROM Medicos WHERE nombre = %s AND especialidad = %s",
-            (nombre, especialidad)
+            """
+            INSERT INTO Medicos (nombre, especialidad, lugar)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (nombre, especialidad)
+            DO UPDATE SET lugar = COALESCE(EXCLUDED.lugar, Medicos.lugar)
+            RETURNING id_medico
+            """,
+            (nombre, especialidad, lugar)
         )
-        result = cursor.fetchone()
-
-        if result:
-            id_medico = result[0]
-            # Actualizar el lugar si es diferente
-            cursor.execute(
-                "UPDATE Medicos SET lugar = %s WHERE id_medico = %s",
-                (lugar, id_medico)
-            )
-        else:
-            # Obtener el próximo ID disponible
-            cursor.execute("SELECT COALESCE(MAX(id_medico), 0) + 1 FROM Medicos")
-            next_id = cursor.fetchone()[0]
-            
-            # Insertar nuevo médico con ID específico
-            cursor.execute(
-                "INSERT INTO Medicos (id_medico, nombre, especialidad, lugar) VALUES (%s, %s, %s, %s)",
-                (next_id, nombre, especialidad, lugar)
-            )
-            id_medico = next_id
-        
+        id_medico = cursor.fetchone()[0]
         conn.commit()
 
     except Exception as e:
@@ -131,16 +228,40 @@ def obtener_o_crear_medico(nombre, especialidad, lugar):
     
     return id_medico
 
-def guardar_turno(id_paciente, id_medico, fecha, hora, lugar):
+def guardar_turno(id_paciente, id_medico, fecha, hora, lugar, duracion_min=DURACION_TURNO_MIN):
+    """
+    Guarda un turno nuevo. Lanza TurnoSuperpuestoError si se pisa con otro turno
+    del paciente o del médico.
+    """
+    asegurar_esquema_turnos()
+    detector = obtener_detector_conflictos()
+    inicio = datetime.combine(fecha, hora)
+    conflicto = detector.buscar_conflicto(id_medico, id_paciente, inicio, inicio + timedelta(minutes=duracion_min))
+    if conflicto:
+        raise TurnoSuperpuestoError(conflicto)
+
     conn = connect_to_supabase()
     cur = conn.cursor()
     
     try:
+        _bloquear_agendas(cur, id_medico, id_paciente)
         cur.execute(
-            "INSERT INTO Turnos (fecha, hora, id_paciente, id_medico, lugar) VALUES (%s, %s, %s, %s, %s)",
-            (fecha, hora, id_paciente, id_medico, lugar)
+            """
+            WITH nuevo AS (
+                INSERT INTO Turnos (fecha, hora, id_paciente, id_medico, lugar, duracion_min)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                RETURNING id_turno, id_medico
+            )
+            SELECT nuevo.id_turno, m.nombre FROM nuevo JOIN Medicos m ON m.id_medico = nuevo.id_medico
+            """,
+            (fecha, hora, id_paciente, id_medico, lugar, duracion_min)
         )
+        id_turno, medico = cur.fetchone()
         conn.commit()
+    except psycopg2.errors.ExclusionViolation:
+        conn.rollback()
+        detector.olvidar(id_medico, id_paciente)
+        raise TurnoSuperpuestoError()
     except Exception as e:
         conn.rollback()
         print(f"Error al guardar turno: {e}")
@@ -149,6 +270,9 @@ def guardar_turno(id_paciente, id_medico, fecha, hora, lugar):
         cur.close()
         conn.close()
 
+    detector.registrar(id_turno, id_medico, id_paciente, fecha, hora, duracion_min, medico, lugar)
+    return id_turno
+
 def obtener_todos_los_medicos():
     conn = connect_to_supabase()
     cursor = conn.cursor()
@@ -162,6 +286,152 @@ def obtener_todos_los_medicos():
     # Retornar una lista de tuplas (id, "Nombre - Especialidad")
     return [(m[0], f"{m[1]} - {m[2]}") for m in medicos]
 
+# ------------------------
+# 📇 Directorio de médicos en memoria
+# ------------------------
+def _normalizar(texto):
+    """Minúsculas y sin acentos, para comparar nombres y especialidades."""
+    texto = unicodedata.normalize("NFKD", str(texto or "").lower())
+    return "".join(c for c in texto if not unicodedata.combining(c)).strip()
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class DirectorioMedicos:
+    """
+    Índice de todos los médicos compartido por todas las sesiones del proceso.
+    - Búsqueda por prefijo: lista ordenada de palabras (bisect).
+    - Búsqueda por subcadena: índice de trigramas, verificado contra el texto.
+    - Búsqueda por id: diccionario, O(1).
+    """
+    BUSQUEDAS_GUARDADAS = 64
+
+    def __init__(self, filas=()):
+        self._lock = threading.RLock()
+        self._por_id = {}
+        self._orden = []                      # (nombre normalizado, id)
+        self._palabras = []                   # (palabra normalizada, id)
+        self._trigramas = defaultdict(set)    # trigrama -> ids
+        self._busquedas = OrderedDict()       # consulta -> ids, LRU compartido por todas las sesiones
+        for fila in filas:
+            self._indexar(*fila, ordenar=False)
+        self._orden.sort()
+        self._palabras.sort()
+
+    def _claves(self, id_medico):
+        medico = self._por_id[id_medico]
+        texto = medico["texto"]
+        palabras = set(texto.replace("-", " ").split()) | {_normalizar(medico["nombre"]), _normalizar(medico["especialidad"])}
+        return texto, palabras
+
+    def _indexar(self, id_medico, nombre, especialidad, lugar, ordenar=True):
+        id_medico = int(id_medico)
+        if id_medico in self._por_id:
+            self._desindexar(id_medico)
+        self._por_id[id_medico] = {
+            "id_medico": id_medico,
+            "nombre": nombre,
+            "especialidad": especialidad,
+            "lugar": lugar,
+            "etiqueta": f"{nombre} - {especialidad}",
+            "texto": _normalizar(f"{nombre} - {especialidad}"),
+            "orden": (_normalizar(nombre), id_medico),
+        }
+        texto, palabras = self._claves(id_medico)
+        agregar = insort if ordenar else list.append
+        agregar(self._orden, self._por_id[id_medico]["orden"])
+        for palabra in palabras:
+            agregar(self._palabras, (palabra, id_medico))
+        for trigrama in _trigramas(texto):
+            self._trigramas[trigrama].add(id_medico)
+
+    def _desindexar(self, id_medico):
+        texto, palabras = self._claves(id_medico)
+        self._orden.remove(self._por_id[id_medico]["orden"])
+        for palabra in palabras:
+            self._palabras.remove((palabra, id_medico))
+        for trigrama in _trigramas(texto):
+            self._trigramas[trigrama].discard(id_medico)
+        del self._por_id[id_medico]
+
+    def agregar(self, id_medico, nombre, especialidad, lugar=None):
+        """
+        Agrega o actualiza un médico sin recargar todo el directorio. Como en
+        obtener_o_crear_medico, un lugar vacío no pisa el que ya tenía.
+        """
+        with self._lock:
+            actual = self._por_id.get(int(id_medico))
+            if lugar is None and actual:
+                lugar = actual["lugar"]
+            self._indexar(id_medico, nombre, especialidad, lugar)
+            self._busquedas.clear()
+
+    def obtener(self, id_medico):
+        return self._por_id.get(int(id_medico))
+
+    def _buscar_ids(self, consulta):
+        if not consulta:
+            return [id_medico for _, id_medico in self._orden]
+
+        # 1) Palabras que empiezan con la consulta
+        encontrados = set()
+        i = bisect_left(self._palabras, (consulta,))
+        while i < len(self._palabras) and self._palabras[i][0].startswith(consulta):
+            encontrados.add(self._palabras[i][1])
+            i += 1
+
+        # 2) La consulta aparece en cualquier parte de "nombre - especialidad"
+        if len(consulta) >= 3:
+            candidatos = None
+            for trigrama in _trigramas(consulta):
+                ids = self._trigramas.get(trigrama, set())
+                candidatos = set(ids) if candidatos is None else candidatos & ids
+                if not candidatos:
+                    break
+            for id_medico in candidatos or ():
+                if consulta in self._por_id[id_medico]["texto"]:
+                    encontrados.add(id_medico)
+
+        return sorted(encontrados, key=lambda id_medico: self._por_id[id_medico]["orden"])
+
+    def buscar(self, texto="", pagina=0, por_pagina=20):
+        """
+        Devuelve (médicos de la página pedida, total de coincidencias).
+        Las últimas búsquedas quedan guardadas por consulta, así que cambiar de página
+        no vuelve a buscar aunque otras sesiones estén buscando otra cosa.
+        """
+        consulta = _normalizar(texto)
+        with self._lock:
+            ids = self._busquedas.get(consulta)
+            if ids is None:
+                ids = self._buscar_ids(consulta)
+                self._busquedas[consulta] = ids
+                while len(self._busquedas) > self.BUSQUEDAS_GUARDADAS:
+                    self._busquedas.popitem(last=False)
+            self._busquedas.move_to_end(consulta)
+            inicio = max(pagina, 0) * por_pagina
+            return [self._por_id[i] for i in ids[inicio:inicio + por_pagina]], len(ids)
+
+    def __len__(self):
+        return len(self._por_id)
+
+@st.cache_resource(ttl=600)
+def obtener_directorio_medicos():
+    """
+    Carga una sola vez por proceso todos los médicos en un DirectorioMedicos.
+    Los médicos nuevos se agregan con DirectorioMedicos.agregar; el TTL recoge
+    los cambios hechos por otros procesos.
+    """
+    conn = connect_to_supabase()
+    if not conn:
+        return DirectorioMedicos()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id_medico, nombre, especialidad, lugar FROM Medicos")
+            return DirectorioMedicos(cur.fetchall())
+    finally:
+        conn.close()
+
 def obtener_lugares_por_medico(id_medico):
     conn = connect_to_supabase()
     cur = conn.cursor()
@@ -212,20 +482,1255 @@ def editar_turno(id_turno, nueva_fecha, nueva_hora, nuevo_lugar):
     """
     Actualiza la fecha, hora y lugar de un turno existente.
     CORREGIDO: Ahora incluye la actualización de la columna 'hora'.
+    Lanza TurnoSuperpuestoError si el nuevo horario se pisa con otro turno.
     """
+    asegurar_esquema_turnos()
     conn = connect_to_supabase()
     if not conn: return
+    detector = obtener_detector_conflictos()
     try:
         with conn.cursor() as cur:
+            cur.execute("""
+                SELECT t.id_medico, t.id_paciente, t.duracion_min, m.nombre
+                FROM Turnos t JOIN Medicos m ON t.id_medico = m.id_medico
+                WHERE t.id_turno = %s
+            """, (int(id_turno),))
+            id_medico, id_paciente, duracion_min, medico = cur.fetchone()
+
+            inicio = datetime.combine(nueva_fecha, nueva_hora)
+            conflicto = detector.buscar_conflicto(id_medico, id_paciente, inicio,
+                                                  inicio + timedelta(minutes=duracion_min), excluir=int(id_turno))
+            if conflicto:
+                raise TurnoSuperpuestoError(conflicto)
+
+            _bloquear_agendas(cur, id_medico, id_paciente)
             cur.execute(
                 "UPDATE Turnos SET fecha = %s, hora = %s, lugar = %s WHERE id_turno = %s",
                 (nueva_fecha, nueva_hora, nuevo_lugar, id_turno)
             )
         conn.commit()
+        detector.registrar(int(id_turno), id_medico, id_paciente, nueva_fecha, nueva_hora, duracion_min, medico, nuevo_lugar)
+    except TurnoSuperpuestoError:
+        conn.rollback()
+        raise
+    except psycopg2.errors.ExclusionViolation:
+        conn.rollback()
+        detector.olvidar(id_medico, id_paciente)
+        raise TurnoSuperpuestoError()
     except Exception as e:
         st.error(f"Error al editar el turno: {e}")
         conn.rollback()
     finally:
         if conn: conn.close()
 
+# ------------------------
+# 🗂️ Caché de meses y precarga en segundo plano
+# ------------------------
+def _rango_mes(year, month):
+    """Devuelve (primer día del mes, primer día del mes siguiente)."""
+    inicio = date(year, month, 1)
+    fin = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return inicio, fin
+
+def _mes_adyacente(year, month, delta):
+    indice = year * 12 + (month - 1) + delta
+    return indice // 12, indice % 12 + 1
+
+def consultar_mes(year, month, dni):
+    """
+    Trae en una sola conexión los turnos del mes (sueltos y de series recurrentes)
+    y deriva de ellos los días con turnos. No usa widgets de Streamlit, así que puede correr en un hilo de fondo.
+    """
+    inicio, fin = _rango_mes(year, month)
+    conn = connect_to_supabase()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT t.id_turno, t.fecha, t.hora, m.nombre AS medico, t.lugar, NULL, NULL
+                FROM Turnos t
+                JOIN Pacientes p ON t.id_paciente = p.id_paciente
+                JOIN Medicos m ON t.id_medico = m.id_medico
+                WHERE p.dni = %s
+                  AND t.fecha >= %s
+                  AND t.fecha < %s
+            """, (dni, inicio, fin))
+            datos = cur.fetchall()
+            datos += _ocurrencias_series_mes(cur, dni, year, month)
+    finally:
+        conn.close()
+
+    df = pd.DataFrame(datos, columns=["ID", "Fecha", "Hora", "Médico", "Lugar", "Serie", "FechaOriginal"])
+    if not df.empty:
+        df["Fecha"] = pd.to_datetime(df["Fecha"]).dt.date
+        df["Hora"] = pd.to_datetime(df["Hora"].astype(str)).dt.time
+        df = df.sort_values(["Fecha", "Hora"], ignore_index=True)
+    return {"dias": set(df["Fecha"]), "turnos": df}
+
+class CacheMeses:
+    """
+    LRU chico con los datos de cada mes ya consultado, uno por sesión.
+    Es seguro entre hilos: los hilos de precarga escriben acá y no en st.session_state.
+    """
+    def __init__(self, capacidad=6):
+        self.capacidad = capacidad
+        self._datos = OrderedDict()
+        self._en_curso = set()
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            if clave not in self._datos:
+                return None
+            self._datos.move_to_end(clave)
+            return self._datos[clave]
+
+    def guardar(self, clave, valor, version=None):
+        with self._lock:
+            # Si se limpió la caché mientras se consultaba, el dato puede estar viejo
+            if valor is None or (version is not None and version != self._version):
+                return
+            self._datos[clave] = valor
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.capacidad:
+                self._datos.popitem(last=False)
+
+    def reservar(self, clave):
+        """Marca una clave como en precarga. Devuelve la versión, o None si no hace falta precargar."""
+        with self._lock:
+            if clave in self._datos or clave in self._en_curso:
+                return None
+            self._en_curso.add(clave)
+            return self._version
+
+    def liberar(self, clave):
+        with self._lock:
+            self._en_curso.discard(clave)
+
+    def limpiar(self):
+        """Vacía la caché. Se llama después de crear, editar o eliminar un turno."""
+        with self._lock:
+            self._datos.clear()
+            self._version += 1
+
+def obtener_cache_meses():
+    if "cache_meses" not in st.session_state:
+        st.session_state.cache_meses = CacheMeses()
+    return st.session_state.cache_meses
+
+def cargar_mes(year, month, dni, cache):
+    """Devuelve {"dias", "turnos"} del mes, desde la caché si ya estaba cargado."""
+    clave = (dni, year, month)
+    datos = cache.obtener(clave)
+    if datos is None:
+        datos = consultar_mes(year, month, dni)
+        cache.guardar(clave, datos)
+    if datos is None:
+        return {"dias": set(), "turnos": pd.DataFrame()}
+    return datos
+
+def _precargar_mes(cache, clave, version):
+    dni, year, month = clave
+    try:
+        cache.guardar(clave, consultar_mes(year, month, dni), version)
+    except Exception as e:
+        print(f"Error al precargar el mes {month}/{year}: {e}")
+    finally:
+        cache.liberar(clave)
+
+def precargar_meses_adyacentes(year, month, dni, cache):
+    """Lanza hilos de fondo que dejan en la caché el mes anterior y el siguiente."""
+    for delta in (-1, 1):
+        y, m = _mes_adyacente(year, month, delta)
+        clave = (dni, y, m)
+        version = cache.reservar(clave)
+        if version is not None:
+            threading.Thread(target=_precargar_mes, args=(cache, clave, version), daemon=True).start()
+
+
+# ------------------------
+# ⏱️ Detección de turnos superpuestos
+# ------------------------
+class TurnoSuperpuestoError(Exception):
+    """Se lanza cuando un turno nuevo o editado se pisa con otro del médico o del paciente."""
+    def __init__(self, turno=None, mensaje=None):
+        self.turno = turno
+        super().__init__(mensaje or describir_conflicto(turno))
+
+def describir_conflicto(turno):
+    if not turno:
+        return "El turno se superpone con otro ya agendado."
+    quien = "El médico ya tiene" if turno["agenda"] == "medico" else "Ya tenés"
+    return (f"{quien} un turno el {turno['inicio'].strftime('%d/%m/%Y')} de "
+            f"{turno['inicio'].strftime('%H:%M')} a {turno['fin'].strftime('%H:%M')} hs"
+            f" con {turno['medico']} en {turno['lugar'] or 'lugar no especificado'}.")
+
+# Se ejecuta una sola vez por proceso: agrega la duración y el período de cada turno.
+# Las restricciones de exclusión las crea el mantenimiento diario (migrar_restricciones_turnos).
+_esquema_turnos_listo = False
+_restricciones_turnos_listas = False
+
+def asegurar_esquema_turnos():
+    global _esquema_turnos_listo
+    if _esquema_turnos_listo:
+        return True
+
+    conn = connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                ALTER TABLE turnos ADD COLUMN IF NOT EXISTS duracion_min INTEGER NOT NULL DEFAULT {DURACION_TURNO_MIN};
+                ALTER TABLE turnos ADD COLUMN IF NOT EXISTS periodo tsrange
+                    GENERATED ALWAYS AS (tsrange(fecha + hora, fecha + hora + duracion_min * INTERVAL '1 minute')) STORED;
+                ALTER TABLE turnos ADD COLUMN IF NOT EXISTS uid_ics TEXT;
+                CREATE UNIQUE INDEX IF NOT EXISTS turnos_uid_ics_key ON turnos (uid_ics);
+            """)
+        conn.commit()
+        _esquema_turnos_listo = True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al preparar la tabla Turnos: {e}")
+    finally:
+        conn.close()
+    return _esquema_turnos_listo
+
+def restricciones_turnos_creadas(cur):
+    """
+    True si ya existen las restricciones de exclusión de Turnos. Mientras no existan,
+    las superposiciones se controlan solo con el detector en memoria.
+    """
+    global _restricciones_turnos_listas
+    if not _restricciones_turnos_listas:
+        cur.execute("""
+            SELECT count(*) FROM pg_constraint
+            WHERE conrelid = 'turnos'::regclass
+              AND conname IN ('turnos_medico_sin_superposicion', 'turnos_paciente_sin_superposicion')
+        """)
+        _restricciones_turnos_listas = cur.fetchone()[0] == 2
+    return _restricciones_turnos_listas
+
+def _turnos_superpuestos(cur):
+    """Pares (id_turno, id_turno) del mismo médico o del mismo paciente que se pisan."""
+    # Un turno solo puede pisarse con los que empiezan hasta su duración más larga después
+    cur.execute("SELECT COALESCE(max(duracion_min), 0) / 1440 + 1 FROM turnos")
+    dias = cur.fetchone()[0]
+    cur.execute("""
+        SELECT a.id_turno, b.id_turno
+        FROM turnos a
+        JOIN turnos b ON (b.id_medico = a.id_medico OR b.id_paciente = a.id_paciente)
+                     AND b.fecha BETWEEN a.fecha AND a.fecha + %s
+                     AND (b.fecha, b.hora, b.id_turno) > (a.fecha, a.hora, a.id_turno)
+        WHERE a.periodo && b.periodo
+        ORDER BY a.id_turno, b.id_turno
+    """, (dias,))
+    return cur.fetchall()
+
+def migrar_restricciones_turnos(conn=None):
+    """
+    Crea las restricciones de exclusión que impiden turnos superpuestos en la base.
+    Si ya hay turnos que se pisan no cambia nada y devuelve esos pares de id_turno para
+    resolverlos a mano; si no, devuelve []. None si la migración falló.
+    Pensado para el mantenimiento diario (fMantenimiento.py); con las restricciones creadas no hace nada.
+    """
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    try:
+        if not asegurar_esquema_turnos():
+            return None
+        with conn.cursor() as cur:
+            if restricciones_turnos_creadas(cur):
+                return []
+            superpuestos = _turnos_superpuestos(cur)
+            if superpuestos:
+                conn.rollback()
+                return superpuestos
+            cur.execute("""
+                CREATE EXTENSION IF NOT EXISTS btree_gist;
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'turnos_medico_sin_superposicion') THEN
+                        ALTER TABLE turnos ADD CONSTRAINT turnos_medico_sin_superposicion
+                            EXCLUDE USING gist (id_medico WITH =, periodo WITH &&);
+                    END IF;
+                    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'turnos_paciente_sin_superposicion') THEN
+                        ALTER TABLE turnos ADD CONSTRAINT turnos_paciente_sin_superposicion
+                            EXCLUDE USING gist (id_paciente WITH =, periodo WITH &&);
+                    END IF;
+                END $$;
+            """)
+        conn.commit()
+        return []
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al crear las restricciones de exclusión de Turnos: {e}")
+        return None
+    finally:
+        if cerrar:
+            conn.close()
+
+class AgendaIntervalos:
+    """
+    Turnos de un médico o de un paciente como intervalos [inicio, fin).
+    Guarda los inicios ordenados y la duración más larga de la agenda: cualquier
+    turno que se superponga con [inicio, fin) empieza entre inicio - duración
+    máxima y fin, así que la consulta es un bisect más los pocos turnos de esa ventana.
+    """
+    def __init__(self):
+        # Las claves son str(id_turno): los turnos tienen id entero y las ocurrencias de
+        # series "serie-N-AAAA-MM-DD", y en un empate de inicio no se puede comparar int con str
+        self._inicios = []      # (inicio, clave), ordenado
+        self._turnos = {}       # clave -> turno
+        self._max_duracion = timedelta(0)
+
+    def agregar(self, turno):
+        clave = str(turno["id_turno"])
+        self.quitar(clave)
+        self._turnos[clave] = turno
+        insort(self._inicios, (turno["inicio"], clave))
+        self._max_duracion = max(self._max_duracion, turno["fin"] - turno["inicio"])
+
+    def quitar(self, id_turno):
+        clave = str(id_turno)
+        turno = self._turnos.pop(clave, None)
+        if turno:
+            i = bisect_left(self._inicios, (turno["inicio"], clave))
+            del self._inicios[i]
+
+    def superpuestos(self, inicio, fin, excluir=None):
+        i = bisect_left(self._inicios, (inicio - self._max_duracion,))
+        conflictos = []
+        while i < len(self._inicios) and self._inicios[i][0] < fin:
+            turno = self._turnos[self._inicios[i][1]]
+            if (excluir is None or self._inicios[i][1] != str(excluir)) and turno["fin"] > inicio:
+                conflictos.append(turno)
+            i += 1
+        return conflictos
+
+    def __len__(self):
+        return len(self._turnos)
+
+def _armar_turno(id_turno, fecha, hora, duracion_min, medico, lugar, agenda):
+    inicio = datetime.combine(fecha, hora)
+    return {
+        "id_turno": id_turno,
+        "inicio": inicio,
+        "fin": inicio + timedelta(minutes=int(duracion_min or DURACION_TURNO_MIN)),
+        "medico": medico,
+        "lugar": lugar,
+        "agenda": agenda,
+    }
+
+class DetectorConflictos:
+    """
+    Una AgendaIntervalos por médico y otra por paciente, compartidas por todo el proceso,
+    con los turnos sueltos y las ocurrencias de series hasta HORIZONTE_SERIES.
+    Cada agenda se carga de la base la primera vez que se consulta, se mantiene al día
+    con las altas, ediciones y bajas de este proceso y se vuelve a cargar cuando pasa
+    AGENDA_TTL_S, para ver lo que cambiaron otros procesos. Un conflicto se confirma
+    recargando la agenda antes de rechazar el turno, así que un turno ya borrado en
+    otro lado no bloquea nada. Lo que agendaron otros procesos desde la última carga lo
+    frena la restricción de exclusión de la tabla (que no cubre las series), una vez que
+    el mantenimiento diario la creó.
+    """
+    AGENDA_TTL_S = 60
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._agendas = {}      # ("medico" | "paciente", id) -> AgendaIntervalos
+        self._cargadas = {}     # misma clave -> monotonic() de la carga
+
+    def _cargar(self, tipo, id_):
+        columna = "id_medico" if tipo == "medico" else "id_paciente"
+        conn = connect_to_supabase()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT t.id_turno, t.fecha, t.hora, t.duracion_min, m.nombre, t.lugar
+                    FROM Turnos t
+                    JOIN Medicos m ON t.id_medico = m.id_medico
+                    WHERE t.{columna} = %s AND t.hora IS NOT NULL
+                """, (id_,))
+                filas = cur.fetchall()
+                hoy = date.today()
+                series = ocurrencias_series(cur, hoy, hoy + HORIZONTE_SERIES, f"s.{columna} = %s", (id_,))
+        finally:
+            conn.close()
+        agenda = AgendaIntervalos()
+        for fila in filas:
+            agenda.agregar(_armar_turno(*fila, agenda=tipo))
+        for o in series:
+            agenda.agregar(_armar_turno(o["id_turno"], o["fecha"], o["hora"], o["duracion_min"],
+                                        o["medico"], o["lugar"], agenda=tipo))
+        return agenda
+
+    def _agenda(self, tipo, id_, recargar=False):
+        clave = (tipo, int(id_))
+        with self._lock:
+            if recargar or clave not in self._agendas or monotonic() - self._cargadas[clave] > self.AGENDA_TTL_S:
+                self._agendas[clave] = self._cargar(tipo, clave[1])
+                self._cargadas[clave] = monotonic()
+            return self._agendas[clave]
+
+    def buscar_conflicto(self, id_medico, id_paciente, inicio, fin, excluir=None):
+        """Devuelve el primer turno que se pisa con [inicio, fin), o None."""
+        with self._lock:
+            for tipo, id_ in (("paciente", id_paciente), ("medico", id_medico)):
+                if self._agenda(tipo, id_).superpuestos(inicio, fin, excluir):
+                    # Puede ser un turno que otro proceso ya movió o borró: se confirma en la base
+                    conflictos = self._agenda(tipo, id_, recargar=True).superpuestos(inicio, fin, excluir)
+                    if conflictos:
+                        return conflictos[0]
+        return None
+
+    def registrar(self, id_turno, id_medico, id_paciente, fecha, hora, duracion_min, medico, lugar):
+        with self._lock:
+            self.quitar(id_turno)
+            for tipo, id_ in (("medico", id_medico), ("paciente", id_paciente)):
+                clave = (tipo, int(id_))
+                if clave in self._agendas:
+                    self._agendas[clave].agregar(
+                        _armar_turno(id_turno, fecha, hora, duracion_min, medico, lugar, agenda=tipo))
+
+    def quitar(self, id_turno):
+        with self._lock:
+            for agenda in self._agendas.values():
+                agenda.quitar(id_turno)
+
+    def olvidar(self, id_medico, id_paciente):
+        """Descarta las agendas para que se recarguen (p. ej. si la base rechazó un turno)."""
+        with self._lock:
+            for clave in (("medico", int(id_medico)), ("paciente", int(id_paciente))):
+                self._agendas.pop(clave, None)
+                self._cargadas.pop(clave, None)
+
+@st.cache_resource
+def obtener_detector_conflictos():
+    return DetectorConflictos()
+
+
+# ------------------------
+# 🔁 Turnos recurrentes
+# ------------------------
+FRECUENCIAS_SERIE = {"semanal": "Semanal", "mensual": "Mensual"}
+
+_esquema_series_listo = False
+
+def asegurar_esquema_series():
+    """Crea (una vez por proceso) las tablas de series de turnos y sus excepciones."""
+    global _esquema_series_listo
+    if _esquema_series_listo:
+        return True
+
+    query = f"""
+        CREATE TABLE IF NOT EXISTS series_turnos (
+            id_serie SERIAL PRIMARY KEY,
+            id_paciente INTEGER NOT NULL,
+            id_medico INTEGER NOT NULL,
+            lugar TEXT,
+            fecha_inicio DATE NOT NULL,
+            fecha_fin DATE,
+            hora TIME NOT NULL,
+            duracion_min INTEGER NOT NULL DEFAULT {DURACION_TURNO_MIN},
+            frecuencia TEXT NOT NULL CHECK (frecuencia IN ('semanal', 'mensual')),
+            intervalo INTEGER NOT NULL DEFAULT 1 CHECK (intervalo > 0),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS series_turnos_paciente_idx
+            ON series_turnos (id_paciente, fecha_inicio);
+        CREATE TABLE IF NOT EXISTS excepciones_series (
+            id_serie INTEGER NOT NULL REFERENCES series_turnos (id_serie) ON DELETE CASCADE,
+            fecha_original DATE NOT NULL,
+            nueva_fecha DATE,
+            nueva_hora TIME,
+            cancelada BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (id_serie, fecha_original)
+        );
+        CREATE INDEX IF NOT EXISTS excepciones_series_nueva_fecha_idx
+            ON excepciones_series (id_serie, nueva_fecha);
+    """
+    conn = connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+        _esquema_series_listo = True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al crear las tablas de series de turnos: {e}")
+    finally:
+        conn.close()
+    return _esquema_series_listo
+
+@lru_cache(maxsize=4096)
+def expandir_serie(fecha_inicio, frecuencia, intervalo, fecha_fin, year, month):
+    """
+    Devuelve las fechas de la serie que caen en el mes pedido.
+    Salta directo a la primera ocurrencia del mes, así que el costo depende
+    de las ocurrencias del mes y no de cuánto tiempo lleva la serie.
+    """
+    inicio_mes, fin_mes = _rango_mes(year, month)
+    limite = fin_mes if fecha_fin is None else min(fin_mes, fecha_fin + timedelta(days=1))
+    if fecha_inicio >= limite:
+        return ()
+
+    if frecuencia == "semanal":
+        paso = timedelta(weeks=intervalo)
+        desde = max(inicio_mes, fecha_inicio)
+        saltos = -(-(desde - fecha_inicio).days // paso.days)
+        fecha = fecha_inicio + saltos * paso
+        fechas = []
+        while fecha < limite:
+            fechas.append(fecha)
+            fecha += paso
+        return tuple(fechas)
+
+    if frecuencia == "mensual":
+        meses = (year - fecha_inicio.year) * 12 + (month - fecha_inicio.month)
+        if meses < 0 or meses % intervalo:
+            return ()
+        # Si la serie arrancó un 31, en los meses más cortos cae el último día
+        fecha = date(year, month, min(fecha_inicio.day, calendar.monthrange(year, month)[1]))
+        return (fecha,) if fecha_inicio <= fecha < limite else ()
+
+    return ()
+
+def _ocurrencias_series_mes(cur, dni, year, month):
+    """
+    Filas (ID, Fecha, Hora, Médico, Lugar, Serie, FechaOriginal) de las series del
+    paciente que tienen ocurrencias en el mes, ya con las excepciones aplicadas.
+    """
+    return _ocurrencias_series(cur, dni, [(year, month)])
+
+def _ocurrencias_series(cur, dni, meses):
+    """Igual que _ocurrencias_series_mes pero para varios meses consecutivos, con las mismas dos consultas."""
+    inicio, fin = _rango_mes(*meses[0])[0], _rango_mes(*meses[-1])[1]
+    return [(o["id_turno"], o["fecha"], o["hora"], o["medico"], o["lugar"], o["id_serie"], o["fecha_original"])
+            for o in ocurrencias_series(cur, inicio, fin, "p.dni = %s", (dni,))]
+
+# Las series no tienen fin, así que fuera de la vista mensual (agendas, turnos libres,
+# exportación, recordatorios) se expanden solo hasta este horizonte
+HORIZONTE_SERIES = timedelta(days=365)
+
+def id_ocurrencia(id_serie, fecha_original):
+    """Id de una ocurrencia de serie, el mismo en la vista del mes, las agendas y el .ics."""
+    return f"serie-{int(id_serie)}-{str(fecha_original)[:10]}"
+
+def fechas_serie(fecha_inicio, frecuencia, intervalo, fecha_fin, desde, hasta):
+    """Fechas de la serie entre desde y hasta (fechas, hasta excluido), mes a mes con expandir_serie."""
+    desde = max(desde, fecha_inicio)
+    if fecha_fin is not None:
+        hasta = min(hasta, fecha_fin + timedelta(days=1))
+    fechas = []
+    year, month = desde.year, desde.month
+    while date(year, month, 1) < hasta:
+        fechas += [f for f in expandir_serie(fecha_inicio, frecuencia, intervalo, fecha_fin, year, month)
+                   if desde <= f < hasta]
+        year, month = _mes_adyacente(year, month, 1)
+    return fechas
+
+def ocurrencias_series(cur, desde, hasta, filtro="TRUE", params=()):
+    """
+    Ocurrencias de las series que cumplen `filtro` (SQL sobre s = series_turnos,
+    p = Pacientes, m = Medicos) entre desde y hasta (fechas, hasta excluido), ya con
+    las excepciones aplicadas. Son dos consultas sin importar cuántas ocurrencias haya.
+    Cada ocurrencia es un dict con id_turno, id_serie, fecha_original, fecha, hora,
+    duracion_min, id_paciente, id_medico, medico, especialidad, lugar, paciente y email.
+    """
+    if not asegurar_esquema_series():
+        return []
+    cur.execute(f"""
+        SELECT s.id_serie, s.fecha_inicio, s.frecuencia, s.intervalo, s.fecha_fin, s.hora, s.duracion_min,
+               s.id_paciente, s.id_medico, m.nombre, m.especialidad, s.lugar, p.nombre, p.email
+        FROM series_turnos s
+        JOIN Pacientes p ON s.id_paciente = p.id_paciente
+        JOIN Medicos m ON s.id_medico = m.id_medico
+        WHERE ({filtro})
+          AND s.fecha_inicio < %s
+          AND (s.fecha_fin IS NULL OR s.fecha_fin >= %s)
+    """, (*params, hasta, desde))
+    series = {fila[0]: fila for fila in cur.fetchall()}
+    if not series:
+        return []
+
+    # Excepciones que sacan una ocurrencia del rango o la traen al rango
+    cur.execute("""
+        SELECT id_serie, fecha_original, nueva_fecha, nueva_hora, cancelada
+        FROM excepciones_series
+        WHERE id_serie = ANY(%s)
+          AND ((fecha_original >= %s AND fecha_original < %s)
+               OR (nueva_fecha >= %s AND nueva_fecha < %s))
+    """, (list(series), desde, hasta, desde, hasta))
+    excepciones = defaultdict(dict)
+    for id_serie, fecha_original, *cambio in cur.fetchall():
+        excepciones[id_serie][fecha_original] = cambio
+
+    return [o for id_serie, fila in series.items()
+            for o in _expandir_ocurrencias(fila, excepciones[id_serie], desde, hasta)]
+
+def _expandir_ocurrencias(fila, excepciones, desde, hasta):
+    """
+    Ocurrencias de una serie (una fila como las de ocurrencias_series) entre desde y hasta,
+    de a una. excepciones es {fecha_original: [nueva_fecha, nueva_hora, cancelada]} de la serie.
+    """
+    def ocurrencia(fecha_original, fecha, hora):
+        (id_serie, _, _, _, _, _, duracion_min, id_paciente, id_medico,
+         medico, especialidad, lugar, paciente, email) = fila
+        return {"id_turno": id_ocurrencia(id_serie, fecha_original), "id_serie": id_serie,
+                "fecha_original": fecha_original, "fecha": fecha, "hora": hora,
+                "duracion_min": duracion_min, "id_paciente": id_paciente, "id_medico": id_medico,
+                "medico": medico, "especialidad": especialidad, "lugar": lugar,
+                "paciente": paciente, "email": email}
+
+    for fecha in fechas_serie(*fila[1:5], desde, hasta):
+        if fecha not in excepciones:
+            yield ocurrencia(fecha, fecha, fila[5])
+
+    for fecha_original, (nueva_fecha, nueva_hora, cancelada) in excepciones.items():
+        if cancelada or nueva_fecha is None or not (desde <= nueva_fecha < hasta):
+            continue
+        yield ocurrencia(fecha_original, nueva_fecha, nueva_hora or fila[5])
+
+def _bloquear_agendas(cur, id_medico, id_paciente):
+    """
+    Toma, hasta el fin de la transacción, los locks de las agendas del médico y del paciente.
+    Las series no están cubiertas por las restricciones de exclusión, así que las altas de
+    turnos y de series se ordenan con estos locks (siempre primero el médico: sin deadlocks).
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('agenda-medico-' || %s))", (int(id_medico),))
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('agenda-paciente-' || %s))", (int(id_paciente),))
+
+def _conflicto_serie_nueva(cur, id_medico, id_paciente, fecha_inicio, hora, frecuencia, intervalo,
+                           fecha_fin, duracion_min):
+    """
+    Primer turno (o ocurrencia de otra serie) de la base que se pisa con alguna ocurrencia
+    futura de la serie nueva, o None. Revisa todos los turnos agendados, aunque estén más
+    allá de HORIZONTE_SERIES, y las otras series hasta el horizonte.
+    """
+    hoy = date.today()
+    cur.execute("""
+        SELECT t.id_turno, t.fecha, t.hora, t.duracion_min, m.nombre, t.lugar, t.id_medico = %s
+        FROM Turnos t
+        JOIN Medicos m ON t.id_medico = m.id_medico
+        WHERE (t.id_medico = %s OR t.id_paciente = %s) AND t.hora IS NOT NULL
+          AND t.fecha >= %s AND (%s::date IS NULL OR t.fecha <= %s)
+    """, (id_medico, id_medico, id_paciente, max(fecha_inicio, hoy) - timedelta(days=1), fecha_fin, fecha_fin))
+    agendas = {"medico": AgendaIntervalos(), "paciente": AgendaIntervalos()}
+    hasta = hoy + HORIZONTE_SERIES
+    for *fila, del_medico in cur.fetchall():
+        tipo = "medico" if del_medico else "paciente"
+        agendas[tipo].agregar(_armar_turno(*fila, agenda=tipo))
+        hasta = max(hasta, fila[1] + timedelta(days=1))
+    for o in ocurrencias_series(cur, hoy - timedelta(days=1), hoy + HORIZONTE_SERIES,
+                                "s.id_medico = %s OR s.id_paciente = %s", (id_medico, id_paciente)):
+        tipo = "medico" if o["id_medico"] == id_medico else "paciente"
+        agendas[tipo].agregar(_armar_turno(o["id_turno"], o["fecha"], o["hora"], o["duracion_min"],
+                                           o["medico"], o["lugar"], agenda=tipo))
+
+    duracion = timedelta(minutes=duracion_min)
+    for fecha in fechas_serie(fecha_inicio, frecuencia, intervalo, fecha_fin, hoy, hasta):
+        inicio = datetime.combine(fecha, hora)
+        for agenda in agendas.values():
+            conflictos = agenda.superpuestos(inicio, inicio + duracion)
+            if conflictos:
+                return conflictos[0]
+    return None
+
+def crear_serie_turnos(id_paciente, id_medico, fecha_inicio, hora, lugar, frecuencia,
+                       intervalo=1, fecha_fin=None, duracion_min=DURACION_TURNO_MIN):
+    """
+    Guarda una regla de repetición (semanal o mensual) y devuelve su id.
+    En la misma transacción del alta, con las agendas bloqueadas, revisa cada ocurrencia
+    futura contra los turnos y las otras series del médico y del paciente en la base, y
+    lanza TurnoSuperpuestoError con la primera que se pisa con otro turno.
+    """
+    asegurar_esquema_series()
+    conn = connect_to_supabase()
+    cur = conn.cursor()
+    try:
+        _bloquear_agendas(cur, id_medico, id_paciente)
+        conflicto = _conflicto_serie_nueva(cur, id_medico, id_paciente, fecha_inicio, hora, frecuencia,
+                                           intervalo, fecha_fin, duracion_min)
+        if conflicto:
+            raise TurnoSuperpuestoError(conflicto)
+        cur.execute(
+            """
+            INSERT INTO series_turnos
+            (id_paciente, id_medico, lugar, fecha_inicio, fecha_fin, hora, duracion_min, frecuencia, intervalo)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id_serie
+            """,
+            (id_paciente, id_medico, lugar, fecha_inicio, fecha_fin, hora, duracion_min, frecuencia, intervalo)
+        )
+        id_serie = cur.fetchone()[0]
+        conn.commit()
+    except TurnoSuperpuestoError:
+        conn.rollback()
+        raise
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al guardar la serie de turnos: {e}")
+        raise e
+    finally:
+        cur.close()
+        conn.close()
+    # Las agendas se recargan con las ocurrencias nuevas la próxima vez que se consulten
+    obtener_detector_conflictos().olvidar(id_medico, id_paciente)
+    return id_serie
+
+def _guardar_excepcion(id_serie, fecha_original, nueva_fecha=None, nueva_hora=None, cancelada=False):
+    conn = connect_to_supabase()
+    if not conn: return
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO excepciones_series (id_serie, fecha_original, nueva_fecha, nueva_hora, cancelada)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (id_serie, fecha_original)
+                DO UPDATE SET nueva_fecha = EXCLUDED.nueva_fecha,
+                              nueva_hora = EXCLUDED.nueva_hora,
+                              cancelada = EXCLUDED.cancelada
+                """,
+                (int(id_serie), fecha_original, nueva_fecha, nueva_hora, cancelada)
+            )
+        conn.commit()
+    except Exception as e:
+        st.error(f"Error al modificar el turno recurrente: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+def _medico_y_paciente_serie(id_serie):
+    """(id_medico, id_paciente, hora, duracion_min) de la serie."""
+    conn = connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id_medico, id_paciente, hora, duracion_min FROM series_turnos WHERE id_serie = %s",
+                        (int(id_serie),))
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+def mover_ocurrencia(id_serie, fecha_original, nueva_fecha, nueva_hora):
+    """
+    Mueve una sola ocurrencia de la serie sin tocar las demás.
+    Lanza TurnoSuperpuestoError si el nuevo horario se pisa con otro turno.
+    """
+    id_medico, id_paciente, hora, duracion_min = _medico_y_paciente_serie(id_serie)
+    detector = obtener_detector_conflictos()
+    inicio = datetime.combine(nueva_fecha, nueva_hora or hora)
+    conflicto = detector.buscar_conflicto(id_medico, id_paciente, inicio, inicio + timedelta(minutes=duracion_min),
+                                          excluir=id_ocurrencia(id_serie, fecha_original))
+    if conflicto:
+        raise TurnoSuperpuestoError(conflicto)
+    _guardar_excepcion(id_serie, fecha_original, nueva_fecha=nueva_fecha, nueva_hora=nueva_hora)
+    detector.olvidar(id_medico, id_paciente)
+
+def cancelar_ocurrencia(id_serie, fecha_original):
+    """Cancela una sola ocurrencia de la serie."""
+    _guardar_excepcion(id_serie, fecha_original, cancelada=True)
+    obtener_detector_conflictos().olvidar(*_medico_y_paciente_serie(id_serie)[:2])
+
+def eliminar_serie(id_serie):
+    """Elimina la serie completa (las excepciones se borran en cascada)."""
+    conn = connect_to_supabase()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM series_turnos WHERE id_serie = %s RETURNING id_medico, id_paciente", (int(id_serie),))
+    serie = cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+    if serie:
+        obtener_detector_conflictos().olvidar(*serie)
+
+
+# ------------------------
+# 📤 Exportar e importar iCalendar (.ics)
+# ------------------------
+ICS_LOTE = 1000
+
+def _escapar_ics(texto):
+    texto = str(texto or "")
+    for original, escapado in (("\\", "\\\\"), (";", "\\;"), (",", "\\,"), ("\n", "\\n")):
+        texto = texto.replace(original, escapado)
+    return texto
+
+def _desescapar_ics(texto):
+    resultado, i = [], 0
+    while i < len(texto):
+        if texto[i] == "\\" and i + 1 < len(texto):
+            resultado.append("\n" if texto[i + 1] in "nN" else texto[i + 1])
+            i += 2
+        else:
+            resultado.append(texto[i])
+            i += 1
+    return "".join(resultado)
+
+def _plegar_ics(linea):
+    """Corta las líneas largas a 75 caracteres, como pide el RFC 5545."""
+    partes = [linea[:75]]
+    for i in range(75, len(linea), 74):
+        partes.append(" " + linea[i:i + 74])
+    return "\r\n".join(partes) + "\r\n"
+
+def _evento_ics(uid, inicio, duracion_min, lugar, medico, especialidad, sello):
+    fin = inicio + timedelta(minutes=duracion_min or DURACION_TURNO_MIN)
+    return (
+        "BEGIN:VEVENT\r\n"
+        + _plegar_ics(f"UID:{_escapar_ics(uid)}")
+        + f"DTSTAMP:{sello}\r\n"
+        + f"DTSTART:{inicio.strftime('%Y%m%dT%H%M%S')}\r\n"
+        + f"DTEND:{fin.strftime('%Y%m%dT%H%M%S')}\r\n"
+        + _plegar_ics(f"SUMMARY:{_escapar_ics(f'Turno con {medico}')}")
+        + _plegar_ics(f"LOCATION:{_escapar_ics(lugar)}")
+        + _plegar_ics(f"X-MEDCHECK-MEDICO:{_escapar_ics(medico)}")
+        + _plegar_ics(f"X-MEDCHECK-ESPECIALIDAD:{_escapar_ics(especialidad)}")
+        + "END:VEVENT\r\n"
+    )
+
+def generar_ics(dni=None):
+    """
+    Genera el calendario .ics de a pedazos. Sin dni exporta los turnos de toda la clínica.
+    Lee con un cursor del lado del servidor, así que la memoria no crece con la cantidad de turnos.
+    Las series salen como turnos sueltos, desde su inicio hasta HORIZONTE_SERIES; también
+    se leen con un cursor del lado del servidor y se expanden de a una.
+    """
+    asegurar_esquema_turnos()
+    query = """
+        SELECT t.id_turno, t.uid_ics, t.fecha, t.hora, t.duracion_min, t.lugar, m.nombre, m.especialidad
+        FROM Turnos t
+        JOIN Medicos m ON t.id_medico = m.id_medico
+        JOIN Pacientes p ON t.id_paciente = p.id_paciente
+        WHERE t.hora IS NOT NULL AND (%s IS NULL OR p.dni = %s)
+        ORDER BY t.fecha, t.hora
+    """
+    # Misma fila que ocurrencias_series, más las excepciones de la serie como JSON
+    query_series = """
+        SELECT s.id_serie, s.fecha_inicio, s.frecuencia, s.intervalo, s.fecha_fin, s.hora, s.duracion_min,
+               s.id_paciente, s.id_medico, m.nombre, m.especialidad, s.lugar, p.nombre, p.email,
+               (SELECT jsonb_agg(jsonb_build_array(e.fecha_original, e.nueva_fecha, e.nueva_hora, e.cancelada))
+                FROM excepciones_series e WHERE e.id_serie = s.id_serie)
+        FROM series_turnos s
+        JOIN Pacientes p ON s.id_paciente = p.id_paciente
+        JOIN Medicos m ON s.id_medico = m.id_medico
+        WHERE s.fecha_inicio < %s AND (%s IS NULL OR p.dni = %s)
+        ORDER BY s.id_serie
+    """
+    yield "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//MedCheck//Turnos//ES\r\nCALSCALE:GREGORIAN\r\n"
+
+    conn = connect_to_supabase()
+    if not conn:
+        yield "END:VCALENDAR\r\n"
+        return
+    sello = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    try:
+        with conn.cursor(name="exportar_ics") as cur:
+            cur.itersize = ICS_LOTE
+            cur.execute(query, (dni, dni))
+            for id_turno, uid, fecha, hora, duracion_min, lugar, medico, especialidad in cur:
+                yield _evento_ics(uid or f"turno-{id_turno}@medcheck", datetime.combine(fecha, hora),
+                                  duracion_min, lugar, medico, especialidad, sello)
+        conn.commit()
+        if asegurar_esquema_series():
+            hasta = date.today() + HORIZONTE_SERIES
+            with conn.cursor(name="exportar_ics_series") as cur:
+                cur.itersize = ICS_LOTE
+                cur.execute(query_series, (hasta, dni, dni))
+                for *fila, excepciones in cur:
+                    excepciones = {date.fromisoformat(original): [
+                                       nueva_fecha and date.fromisoformat(nueva_fecha),
+                                       nueva_hora and time.fromisoformat(nueva_hora), cancelada]
+                                   for original, nueva_fecha, nueva_hora, cancelada in excepciones or ()}
+                    for o in _expandir_ocurrencias(fila, excepciones, date.min, hasta):
+                        yield _evento_ics(f"{o['id_turno']}@medcheck", datetime.combine(o["fecha"], o["hora"]),
+                                          o["duracion_min"], o["lugar"], o["medico"], o["especialidad"], sello)
+            conn.commit()
+    finally:
+        conn.close()
+    yield "END:VCALENDAR\r\n"
+
+def exportar_ics(destino, dni=None):
+    """Escribe el .ics en un archivo abierto (texto), pedazo a pedazo."""
+    for pedazo in generar_ics(dni):
+        destino.write(pedazo)
+
+def _leer_lineas_ics(archivo):
+    """Lee un .ics línea a línea, juntando las líneas plegadas."""
+    if isinstance(archivo, (bytes, str)):
+        archivo = io.BytesIO(archivo.encode() if isinstance(archivo, str) else archivo)
+    if not isinstance(archivo, io.TextIOBase):
+        archivo = io.TextIOWrapper(archivo, encoding="utf-8", errors="replace", newline="")
+    actual = None
+    for linea in archivo:
+        linea = linea.rstrip("\r\n")
+        if linea[:1] in (" ", "\t") and actual is not None:
+            actual += linea[1:]
+            continue
+        if actual is not None:
+            yield actual
+        actual = linea
+    if actual:
+        yield actual
+
+def _fecha_hora_ics(valor, tzid=None):
+    """
+    Fecha y hora (sin zona) de un DTSTART/DTEND en ZONA_CLINICA. Las horas en UTC ("Z")
+    o con TZID se pasan a esa zona; las horas flotantes se toman como de la clínica.
+    """
+    if "T" not in valor:
+        return datetime.strptime(valor[:8], "%Y%m%d")
+    momento = datetime.strptime(valor[:15], "%Y%m%dT%H%M%S")
+    if valor.endswith("Z"):
+        zona = timezone.utc
+    elif tzid:
+        try:
+            zona = ZoneInfo(tzid)
+        except Exception:
+            # Zona desconocida (p. ej. un TZID propio de Outlook): se toma como de la clínica
+            return momento
+    else:
+        return momento
+    return momento.replace(tzinfo=zona).astimezone(ZONA_CLINICA).replace(tzinfo=None)
+
+def leer_eventos_ics(archivo):
+    """
+    Devuelve de a uno los VEVENT del archivo como diccionarios, sin cargarlo entero.
+    El TZID de una propiedad queda en "<PROPIEDAD>-TZID" (p. ej. "DTSTART-TZID").
+    """
+    evento = None
+    for linea in _leer_lineas_ics(archivo):
+        if linea == "BEGIN:VEVENT":
+            evento = {}
+        elif linea == "END:VEVENT":
+            if evento and "UID" in evento and "DTSTART" in evento:
+                yield evento
+            evento = None
+        elif evento is not None and ":" in linea:
+            nombre, valor = linea.split(":", 1)
+            nombre, *parametros = nombre.split(";")
+            nombre = nombre.upper()
+            evento[nombre] = valor
+            for parametro in parametros:
+                clave, _, dato = parametro.partition("=")
+                if clave.upper() == "TZID":
+                    evento[f"{nombre}-TZID"] = dato.strip('"')
+
+# UID que pone generar_ics a los turnos y a las ocurrencias de series
+_UID_PROPIO = re.compile(r"^(turno|serie)-(\d+)(?:-\d{4}-\d{2}-\d{2})?@medcheck$")
+
+def _uids_propios_existentes(cur, uids, id_paciente):
+    """
+    De los UID que exportó MedCheck (turno-<id>@medcheck, serie-<id>-<fecha>@medcheck),
+    devuelve los que apuntan a un turno o serie que el paciente todavía tiene.
+    """
+    ids = {"turno": {}, "serie": {}}
+    for uid in uids:
+        coincidencia = _UID_PROPIO.match(uid)
+        if coincidencia:
+            ids[coincidencia.group(1)].setdefault(int(coincidencia.group(2)), []).append(uid)
+    existentes = set()
+    if ids["turno"]:
+        cur.execute("SELECT id_turno FROM Turnos WHERE id_turno = ANY(%s) AND id_paciente = %s",
+                    (list(ids["turno"]), id_paciente))
+        existentes.update(uid for (id_,) in cur.fetchall() for uid in ids["turno"][id_])
+    if ids["serie"] and asegurar_esquema_series():
+        cur.execute("SELECT id_serie FROM series_turnos WHERE id_serie = ANY(%s) AND id_paciente = %s",
+                    (list(ids["serie"]), id_paciente))
+        existentes.update(uid for (id_,) in cur.fetchall() for uid in ids["serie"][id_])
+    return existentes
+
+def importar_ics(archivo, id_paciente, lote=ICS_LOTE):
+    """
+    Importa los eventos de un .ics como turnos del paciente, en lotes.
+    Los UID ya importados y los que se superponen con otro turno se saltean
+    (ON CONFLICT DO NOTHING cubre tanto el índice único como las restricciones de exclusión;
+    mientras el mantenimiento diario no haya creado esas restricciones, las superposiciones se
+    controlan con el detector en memoria).
+    También se saltean los turnos y series que exportó MedCheck y que el paciente ya tiene,
+    así que importar la propia exportación no duplica nada.
+    Los eventos de día completo (DTSTART sin hora) no son turnos y se ignoran, y las
+    duraciones se recortan a DURACION_MAXIMA_TURNO_MIN.
+    Devuelve (importados, salteados, de_dia_completo).
+    """
+    asegurar_esquema_turnos()
+    medicos = {}
+    importados = salteados = de_dia_completo = 0
+
+    detector = obtener_detector_conflictos()
+    # Turnos de este mismo archivo ya aceptados, que el detector todavía no conoce
+    agendas = {}
+
+    def sin_superposicion(filas):
+        aceptadas = []
+        for fila in filas:
+            fecha, hora, duracion, id_medico = fila[1], fila[2], fila[3], fila[5]
+            inicio = datetime.combine(fecha, hora)
+            fin = inicio + timedelta(minutes=duracion)
+            propias = [agendas.setdefault(clave, AgendaIntervalos())
+                       for clave in (("medico", id_medico), ("paciente", id_paciente))]
+            if detector.buscar_conflicto(id_medico, id_paciente, inicio, fin) or any(
+                    agenda.superpuestos(inicio, fin) for agenda in propias):
+                continue
+            for agenda in propias:
+                agenda.agregar({"id_turno": fila[0], "inicio": inicio, "fin": fin})
+            aceptadas.append(fila)
+        return aceptadas
+
+    conn = connect_to_supabase()
+    try:
+        def insertar(filas):
+            with conn.cursor() as cur:
+                existentes = _uids_propios_existentes(cur, [fila[0] for fila in filas], id_paciente)
+                filas = [fila for fila in filas if fila[0] not in existentes]
+                if not restricciones_turnos_creadas(cur):
+                    filas = sin_superposicion(filas)
+                if not filas:
+                    return 0
+                insertados = psycopg2.extras.execute_values(cur, """
+                    INSERT INTO Turnos (uid_ics, fecha, hora, duracion_min, lugar, id_medico, id_paciente)
+                    VALUES %s
+                    ON CONFLICT DO NOTHING
+                    RETURNING id_turno
+                """, filas, page_size=len(filas), fetch=True)
+            conn.commit()
+            return len(insertados)
+
+        filas = []
+        for evento in leer_eventos_ics(archivo):
+            if "T" not in evento["DTSTART"]:
+                de_dia_completo += 1
+                continue
+            inicio = _fecha_hora_ics(evento["DTSTART"], evento.get("DTSTART-TZID"))
+            fin = _fecha_hora_ics(evento["DTEND"], evento.get("DTEND-TZID")) if "DTEND" in evento else None
+            duracion = int((fin - inicio).total_seconds() // 60) if fin and fin > inicio else DURACION_TURNO_MIN
+            duracion = min(duracion, DURACION_MAXIMA_TURNO_MIN)
+
+            resumen = _desescapar_ics(evento.get("SUMMARY", ""))
+            medico = _desescapar_ics(evento.get("X-MEDCHECK-MEDICO", "")) or resumen.removeprefix("Turno con ").strip() or "Sin especificar"
+            especialidad = _desescapar_ics(evento.get("X-MEDCHECK-ESPECIALIDAD", "")) or "Sin especificar"
+            if (medico, especialidad) not in medicos:
+                medicos[(medico, especialidad)] = obtener_o_crear_medico(medico, especialidad)
+
+            filas.append((_desescapar_ics(evento["UID"]), inicio.date(), inicio.time(), duracion,
+                          _desescapar_ics(evento.get("LOCATION", "")) or None,
+                          medicos[(medico, especialidad)], id_paciente))
+            if len(filas) >= lote:
+                insertados = insertar(filas)
+                importados += insertados
+                salteados += len(filas) - insertados
+                filas = []
+        if filas:
+            insertados = insertar(filas)
+            importados += insertados
+            salteados += len(filas) - insertados
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al importar el calendario: {e}")
+        raise e
+    finally:
+        conn.close()
+
+    # Las agendas en memoria no vieron estos turnos: se recargan la próxima vez
+    for id_medico in medicos.values():
+        detector.olvidar(id_medico, id_paciente)
+    return importados, salteados, de_dia_completo
+
+
+# ------------------------
+# 🗓️ Vista anual: cantidad de turnos por día
+# ------------------------
+@st.cache_data(ttl=3600, show_spinner=False)
+def obtener_turnos_por_dia_anio(dni, year):
+    """
+    Devuelve {fecha: cantidad de turnos} para todo el año, contado en la base con un
+    solo GROUP BY (sin traer los turnos). Las series recurrentes se suman expandiendo
+    sus reglas. Queda en caché por (dni, año).
+    """
+    inicio, fin = date(year, 1, 1), date(year + 1, 1, 1)
+    conn = connect_to_supabase()
+    if not conn:
+        return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT date_trunc('day', t.fecha)::date AS dia, COUNT(*)
+                FROM Turnos t
+                JOIN Pacientes p ON t.id_paciente = p.id_paciente
+                WHERE p.dni = %s
+                  AND t.fecha >= %s
+                  AND t.fecha < %s
+                GROUP BY 1
+            """, (dni, inicio, fin))
+            conteo = {dia: cantidad for dia, cantidad in cur.fetchall()}
+            for fila in _ocurrencias_series(cur, dni, [(year, month) for month in range(1, 13)]):
+                conteo[fila[1]] = conteo.get(fila[1], 0) + 1
+    finally:
+        conn.close()
+    return conteo
+
+def invalidar_calendario(cache, dni, *fechas):
+    """
+    Descarta lo cacheado del paciente después de crear, editar o eliminar turnos.
+    Con fechas, solo se recalculan los años de esas fechas; sin fechas, todos.
+    """
+    cache.limpiar()
+    if not fechas or None in fechas:
+        obtener_turnos_por_dia_anio.clear()
+        return
+    for year in {f.year for f in fechas}:
+        obtener_turnos_por_dia_anio.clear(dni, year)
+
+
+# ------------------------
+# 🕘 Horarios de atención y próximos turnos libres
+# ------------------------
+DIAS_SEMANA = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+# Se usa para los médicos que todavía no cargaron sus horarios: lunes a viernes de 9 a 17
+HORARIO_POR_DEFECTO = [(dia, time(9, 0), time(17, 0)) for dia in range(5)]
+
+_esquema_horarios_listo = False
+
+def asegurar_esquema_horarios():
+    """Crea (una vez por proceso) la tabla de horarios de atención de los médicos."""
+    global _esquema_horarios_listo
+    if _esquema_horarios_listo:
+        return True
+
+    query = """
+        CREATE TABLE IF NOT EXISTS horarios_medicos (
+            id SERIAL PRIMARY KEY,
+            id_medico INTEGER NOT NULL,
+            dia_semana SMALLINT NOT NULL CHECK (dia_semana BETWEEN 0 AND 6),
+            hora_inicio TIME NOT NULL,
+            hora_fin TIME NOT NULL CHECK (hora_fin > hora_inicio)
+        );
+        CREATE INDEX IF NOT EXISTS horarios_medicos_medico_idx ON horarios_medicos (id_medico);
+    """
+    conn = connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+        _esquema_horarios_listo = True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al crear la tabla de horarios de médicos: {e}")
+    finally:
+        conn.close()
+    return _esquema_horarios_listo
+
+@st.cache_data(ttl=600, show_spinner=False)
+def obtener_horarios_medico(id_medico):
+    """Franjas (dia_semana, hora_inicio, hora_fin) del médico; dia_semana 0 = lunes."""
+    if not asegurar_esquema_horarios():
+        return []
+    conn = connect_to_supabase()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT dia_semana, hora_inicio, hora_fin
+                FROM horarios_medicos
+                WHERE id_medico = %s
+                ORDER BY dia_semana, hora_inicio
+            """, (int(id_medico),))
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+def guardar_horarios_medico(id_medico, franjas):
+    """Reemplaza los horarios de atención del médico por las franjas dadas."""
+    asegurar_esquema_horarios()
+    conn = connect_to_supabase()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM horarios_medicos WHERE id_medico = %s", (int(id_medico),))
+        if franjas:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO horarios_medicos (id_medico, dia_semana, hora_inicio, hora_fin) VALUES %s
+            """, [(int(id_medico), dia, inicio, fin) for dia, inicio, fin in franjas])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al guardar horarios del médico: {e}")
+        raise e
+    finally:
+        cur.close()
+        conn.close()
+    obtener_horarios_medico.clear(id_medico)
+
+def obtener_ocupados(id_medico, desde, hasta, id_paciente=None):
+    """
+    Intervalos (inicio, fin) ocupados del médico (y del paciente, si se pasa) entre desde
+    y hasta, ordenados y fusionados. Se leen de la base en cada búsqueda (índice de
+    `periodo` y las series del rango), así que incluyen lo que agendaron otros procesos.
+    """
+    asegurar_esquema_turnos()
+    conn = connect_to_supabase()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT lower(periodo), upper(periodo)
+                FROM Turnos
+                WHERE (id_medico = %s OR id_paciente = %s)
+                  AND periodo && tsrange(%s, %s)
+            """, (int(id_medico), id_paciente, desde, hasta))
+            intervalos = cur.fetchall()
+            for o in ocurrencias_series(cur, desde.date(), hasta.date() + timedelta(days=1),
+                                        "s.id_medico = %s OR s.id_paciente = %s", (int(id_medico), id_paciente)):
+                inicio = datetime.combine(o["fecha"], o["hora"])
+                intervalos.append((inicio, inicio + timedelta(minutes=o["duracion_min"])))
+    finally:
+        conn.close()
+
+    fusionados = []
+    for inicio, fin in sorted(intervalos):
+        if fusionados and inicio <= fusionados[-1][1]:
+            fusionados[-1] = (fusionados[-1][0], max(fusionados[-1][1], fin))
+        else:
+            fusionados.append((inicio, fin))
+    return fusionados
+
+def buscar_turnos_libres(id_medico, desde, hasta, cantidad=5, duracion_min=DURACION_TURNO_MIN, id_paciente=None):
+    """
+    Devuelve los próximos `cantidad` inicios de turno libres del médico entre desde y hasta.
+    Trae los turnos ocupados de la ventana en una consulta, recorre las franjas de atención
+    en orden y avanza sobre los ocupados con un solo puntero.
+    """
+    franjas_por_dia = defaultdict(list)
+    for dia, hora_inicio, hora_fin in obtener_horarios_medico(id_medico) or HORARIO_POR_DEFECTO:
+        franjas_por_dia[dia].append((hora_inicio, hora_fin))
+
+    duracion = timedelta(minutes=duracion_min)
+    ocupados = obtener_ocupados(id_medico, desde, hasta, id_paciente=id_paciente)
+    libres = []
+    j = 0
+    dia = desde.date()
+    while dia <= hasta.date() and len(libres) < cantidad:
+        for hora_inicio, hora_fin in sorted(franjas_por_dia.get(dia.weekday(), ())):
+            comienzo = datetime.combine(dia, hora_inicio)
+            cierre = min(datetime.combine(dia, hora_fin), hasta)
+
+            def alinear(momento):
+                # Primer inicio de turno de la franja que no sea anterior a `momento`
+                if momento <= comienzo:
+                    return comienzo
+                return comienzo + -(-(momento - comienzo) // duracion) * duracion
 
+            inicio = alinear(desde)
+            while inicio + duracion <= cierre and len(libres) < cantidad:
+                while j < len(ocupados) and ocupados[j][1] <= inicio:
+                    j += 1
+                if j < len(ocupados) and ocupados[j][0] < inicio + duracion:
+                    inicio = alinear(ocupados[j][1])
+                    continue
+                libres.append(inicio)
+                inicio += duracion
+        dia += timedelta(days=1)
+    return libres
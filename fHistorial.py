@@ -1,7 +1,15 @@
 import streamlit as st
 import pandas as pd
-from datetime import date
-from functions import execute_query
+from datetime import date, datetime, timedelta
+import os
+import base64
+import hashlib
+import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2.extras
+from PIL import Image, ImageOps, UnidentifiedImageError
+from functions import execute_query, connect_to_supabase
 from fEncuesta import get_id_paciente_por_dni, get_encuesta_completada
 
 # Funciones auxiliares
@@ -115,17 +123,21 @@ def insertar_evento_medico(dni, enfermedad, medicacion, sintomas, comentarios=No
 #-----------------------------------------------------------------------
 
 def get_estudios_medicos_recientes(dni, conn=None):
-    """Obtiene los estudios médicos del paciente con sus imágenes"""
+    """
+    Obtiene los estudios médicos del paciente con la cantidad de imágenes de cada uno.
+    No trae las imágenes: se cargan con get_imagenes_estudio al abrir el estudio.
+    """
     try:
         id_paciente = get_id_paciente_por_dni(dni, conn=conn)
         if not id_paciente:
             return None
         id_paciente = int(id_paciente)
+        asegurar_esquema_imagenes(conn)
         
         query = """
-        SELECT e.id_estudio, e.id_paciente, e.fecha, e.tipo, e.zona, e.descripcion, i.imagen_base64
+        SELECT e.id_estudio, e.id_paciente, e.fecha, e.tipo, e.zona, e.descripcion,
+               (SELECT COUNT(*) FROM imagenes_estudios i WHERE i.id_estudio = e.id_estudio) AS imagenes
         FROM Estudios e
-        LEFT JOIN imagenes_estudios i ON e.id_estudio = i.id_estudio
         WHERE e.id_paciente = %s 
         ORDER BY e.fecha DESC
         """
@@ -135,7 +147,7 @@ def get_estudios_medicos_recientes(dni, conn=None):
         return None
 
 def insertar_estudio_medico(dni, tipo_estudio, fecha_estudio, zona, razon, observaciones=None, conn=None):
-    """Inserta un nuevo estudio médico y devuelve True si tiene éxito."""
+    """Inserta un nuevo estudio médico y devuelve su id_estudio (False si falla)."""
     try:
         id_paciente = get_id_paciente_por_dni(dni, conn=conn)
         if not id_paciente:
@@ -154,21 +166,23 @@ def insertar_estudio_medico(dni, tipo_estudio, fecha_estudio, zona, razon, obser
         """
         params = (id_paciente, fecha_estudio, tipo_estudio.strip(), zona.strip(), descripcion_completa)
 
-        # AVISO IMPORTANTE:
-        # La siguiente línea asume que tu función `execute_query` realiza un `conn.commit()`
-        # para las operaciones que no son de selección.
-        # Estás usando `is_select=True` porque esperas un valor de retorno, pero un INSERT
-        # es una operación de escritura y NECESITA un commit.
-        result = execute_query(query, params=params, conn=conn, is_select=False) # Cambiado a is_select=False
+        # execute_query no devuelve el RETURNING de un INSERT, así que se usa el cursor directo
+        cerrar = conn is None
+        conn = conn or connect_to_supabase()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                id_estudio = cur.fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if cerrar:
+                conn.close()
 
-        # La lógica de `execute_query` debe manejar el retorno de datos incluso con is_select=False
-        if result:
-            print("✅ Inserción confirmada en la base de datos.")
-            return True # <--- ¡LA SOLUCIÓN PRINCIPAL!
-        else:
-            # Este error ahora significa que el commit o la ejecución fallaron.
-            st.error("La base de datos no confirmó el guardado del estudio.")
-            return False
+        print("✅ Inserción confirmada en la base de datos.")
+        return id_estudio
 
     except Exception as e:
         st.error(f"Error crítico al insertar estudio médico: {str(e)}")
@@ -176,15 +190,111 @@ def insertar_estudio_medico(dni, tipo_estudio, fecha_estudio, zona, razon, obser
         return False
 
 
-def guardar_imagen_estudio(id_estudio, id_paciente, imagen_base64, conn=None):
-    """Guarda la imagen de un estudio en la tabla imagenes_estudios"""
+#-----------------------------------------------------------------------
+# IMÁGENES DE ESTUDIOS: ALMACÉN LOCAL DIRECCIONADO POR CONTENIDO
+#-----------------------------------------------------------------------
+# Cada imagen se guarda una sola vez como archivo, con el sha256 de sus bytes como nombre
+# (blobs/ab/abcdef...). En imagenes_estudios quedan solo hash, tamaño y tipo MIME, así los
+# listados no traen bytes y la imagen se lee del disco recién cuando el usuario la abre.
+DIRECTORIO_BLOBS = os.getenv("MEDCHECK_BLOBS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs"))
+LOTE_MIGRACION_IMAGENES = 200
+FIRMAS_MIME = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF", "application/pdf"),
+]
+
+_esquema_imagenes_listo = False
+
+def asegurar_esquema_imagenes(conn=None):
+    """Agrega a imagenes_estudios las columnas del almacén de blobs (se ejecuta una vez por proceso)."""
+    global _esquema_imagenes_listo
+    if _esquema_imagenes_listo:
+        return
+    query = """
+        ALTER TABLE imagenes_estudios
+            ADD COLUMN IF NOT EXISTS hash TEXT,
+            ADD COLUMN IF NOT EXISTS tamanio INTEGER,
+            ADD COLUMN IF NOT EXISTS tipo_mime TEXT,
+            ADD COLUMN IF NOT EXISTS ancho INTEGER,
+            ADD COLUMN IF NOT EXISTS alto INTEGER,
+            ADD COLUMN IF NOT EXISTS miniaturas JSONB,
+            ADD COLUMN IF NOT EXISTS orden SMALLINT,
+            ALTER COLUMN imagen_base64 DROP NOT NULL;
+        CREATE INDEX IF NOT EXISTS imagenes_estudios_estudio_idx ON imagenes_estudios (id_estudio);
+        CREATE INDEX IF NOT EXISTS imagenes_estudios_hash_idx ON imagenes_estudios (hash);
+    """
+    _esquema_imagenes_listo = bool(execute_query(query, conn=conn, is_select=False))
+
+def tipo_mime(contenido):
+    """Tipo MIME según los primeros bytes del archivo."""
+    for firma, tipo in FIRMAS_MIME:
+        if contenido.startswith(firma):
+            return tipo
+    if contenido[:4] == b"RIFF" and contenido[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+def ruta_blob(hash_blob):
+    return os.path.join(DIRECTORIO_BLOBS, hash_blob[:2], hash_blob)
+
+def guardar_blob(contenido):
+    """
+    Guarda los bytes en el almacén y devuelve su hash. Si ya estaban (mismo contenido)
+    no se vuelven a escribir. La escritura es atómica: nunca queda un blob a medias.
+    """
+    hash_blob = hashlib.sha256(contenido).hexdigest()
+    ruta = ruta_blob(hash_blob)
     try:
-        # Insertar imagen
+        # Ya estaba: se renueva su fecha para que limpiar_blobs_huerfanos no lo borre
+        # antes de que se guarde la fila que lo va a usar
+        os.utime(ruta)
+        return hash_blob
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), prefix=".tmp-")
+    try:
+        with os.fdopen(descriptor, "wb") as archivo:
+            archivo.write(contenido)
+        os.replace(temporal, ruta)
+    except Exception:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return hash_blob
+
+def leer_blob(hash_blob):
+    """Bytes de un blob, o None si no está en el almacén."""
+    try:
+        with open(ruta_blob(hash_blob), "rb") as archivo:
+            return archivo.read()
+    except FileNotFoundError:
+        return None
+
+def _decodificar_base64(imagen_base64):
+    """Bytes de una imagen en base64, con o sin el prefijo 'data:...;base64,'."""
+    if imagen_base64.startswith("data:"):
+        imagen_base64 = imagen_base64.split(",", 1)[-1]
+    return base64.b64decode(imagen_base64)
+
+def guardar_imagen_estudio(id_estudio, id_paciente, imagen, conn=None):
+    """
+    Guarda la imagen de un estudio: los bytes van al almacén de blobs y en
+    imagenes_estudios queda solo hash, tamaño y tipo MIME.
+    `imagen` pueden ser los bytes del archivo o el texto base64 de antes.
+    """
+    try:
+        asegurar_esquema_imagenes(conn)
+        contenido = _decodificar_base64(imagen) if isinstance(imagen, str) else bytes(imagen)
         query = """
-        INSERT INTO imagenes_estudios (id_estudio, id_paciente, imagen_base64)
-        VALUES (%s, %s, %s)
+        INSERT INTO imagenes_estudios (id_estudio, id_paciente, hash, tamanio, tipo_mime)
+        VALUES (%s, %s, %s, %s, %s)
         """
-        result = execute_query(query, params=(id_estudio, id_paciente, imagen_base64), conn=conn, is_select=False)
+        params = (id_estudio, id_paciente, guardar_blob(contenido), len(contenido), tipo_mime(contenido))
+        result = execute_query(query, params=params, conn=conn, is_select=False)
 
         if result:
             print(f"✅ Imagen guardada para estudio ID: {id_estudio}, paciente ID: {id_paciente}")
@@ -197,7 +307,251 @@ def guardar_imagen_estudio(id_estudio, id_paciente, imagen_base64, conn=None):
         print(f"❌ Error al guardar imagen del estudio: {str(e)}")
         return False
 
+def get_imagenes_estudio(id_estudio, conn=None):
+    """
+    Hash, tamaño, tipo MIME, dimensiones y miniaturas ({lado: hash}) de las imágenes de un
+    estudio, en el orden en que se subieron (sin los bytes: se leen con leer_blob o se
+    muestran directo desde ruta_blob). Si el estudio todavía tiene imágenes en base64,
+    primero las pasa al almacén.
+    """
+    try:
+        migrar_imagenes_a_blobs(id_estudio=id_estudio, conn=conn)
+        query = """
+        SELECT hash, tamanio, tipo_mime, ancho, alto, miniaturas
+        FROM imagenes_estudios
+        WHERE id_estudio = %s AND hash IS NOT NULL
+        ORDER BY orden NULLS LAST, hash
+        """
+        return execute_query(query, params=(int(id_estudio),), conn=conn, is_select=True)
+    except Exception as e:
+        print(f"Error al obtener imágenes del estudio: {str(e)}")
+        return None
+
+def migrar_imagenes_a_blobs(conn=None, lote=LOTE_MIGRACION_IMAGENES, id_estudio=None):
+    """
+    Pasa al almacén de blobs las imágenes que siguen guardadas en base64 y libera la
+    columna imagen_base64. Trabaja por lotes (un commit por lote), así se puede cortar
+    y retomar. Con id_estudio migra solo ese estudio. Devuelve la cantidad de imágenes migradas.
+    """
+    asegurar_esquema_imagenes(conn)
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    migradas = 0
+    filtro = "AND id_estudio = %s" if id_estudio is not None else ""
+    params = (int(id_estudio),) if id_estudio is not None else ()
+    try:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute(f"""
+                    SELECT ctid::text, imagen_base64 FROM imagenes_estudios
+                    WHERE imagen_base64 IS NOT NULL {filtro}
+                    LIMIT %s
+                """, params + (lote,))
+                filas = cur.fetchall()
+                if not filas:
+                    break
+                valores = []
+                for ctid, imagen_base64 in filas:
+                    contenido = _decodificar_base64(imagen_base64)
+                    valores.append((ctid, guardar_blob(contenido), len(contenido), tipo_mime(contenido)))
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE imagenes_estudios i
+                    SET hash = v.hash, tamanio = v.tamanio, tipo_mime = v.tipo_mime, imagen_base64 = NULL
+                    FROM (VALUES %s) AS v (ctid, hash, tamanio, tipo_mime)
+                    WHERE i.ctid = v.ctid::tid
+                """, valores, page_size=lote)
+                conn.commit()
+                migradas += len(filas)
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al migrar imágenes de estudios: {str(e)}")
+    finally:
+        if cerrar:
+            conn.close()
+    return migradas
+
+PREFIJO_A_BORRAR = ".borrar-"
+
+def _hashes_referenciados(hashes, conn=None):
+    """Los hashes de `hashes` que alguna imagen usa, como imagen o como miniatura."""
+    query = """
+        SELECT hash FROM imagenes_estudios WHERE hash = ANY(%(hashes)s)
+        UNION
+        SELECT m.value AS hash
+        FROM imagenes_estudios i CROSS JOIN LATERAL jsonb_each_text(i.miniaturas) m
+        WHERE jsonb_typeof(i.miniaturas) = 'object' AND m.value = ANY(%(hashes)s)
+    """
+    usados = execute_query(query, params={"hashes": list(hashes)}, conn=conn, is_select=True)
+    if usados is None or "hash" not in usados:
+        raise RuntimeError("No se pudieron leer los blobs en uso")
+    return set(usados["hash"])
+
+def limpiar_blobs_huerfanos(conn=None, antiguedad_minima=timedelta(days=1)):
+    """
+    Borra del almacén los blobs que ya no referencia ninguna imagen ni miniatura (por
+    ejemplo, de estudios eliminados). Los blobs compartidos no se tocan mientras alguna fila los use,
+    y los recién escritos se respetan por si su fila todavía no se guardó.
+    Para no competir con una subida del mismo contenido, cada candidato se renombra
+    primero (.borrar-<hash>) y recién entonces se vuelve a mirar su fecha y la base: si una
+    subida lo tocó (guardar_blob renueva la fecha antes de guardar la fila) o ya tiene una
+    fila, vuelve a su lugar; una subida que llega después del renombre lo escribe de nuevo.
+    Devuelve la cantidad de archivos borrados.
+    """
+    asegurar_esquema_imagenes(conn)
+    limite = (datetime.now() - antiguedad_minima).timestamp()
+    apartados = {}
+    for carpeta, _, archivos in os.walk(DIRECTORIO_BLOBS):
+        for nombre in archivos:
+            ruta = os.path.join(carpeta, nombre)
+            if nombre.startswith(PREFIJO_A_BORRAR):
+                # Quedó de una limpieza cortada: se vuelve a evaluar como cualquier otro
+                nombre = nombre[len(PREFIJO_A_BORRAR):]
+            elif nombre.startswith("."):
+                # Escritura temporal abandonada
+                if os.path.getmtime(ruta) < limite:
+                    os.remove(ruta)
+                continue
+            elif os.path.getmtime(ruta) < limite:
+                apartado = os.path.join(carpeta, PREFIJO_A_BORRAR + nombre)
+                os.replace(ruta, apartado)
+                ruta = apartado
+            else:
+                continue
+            apartados[nombre] = ruta
+    if not apartados:
+        return 0
+
+    try:
+        usados = _hashes_referenciados(apartados, conn)
+    except RuntimeError:
+        usados = set(apartados)
+    borrados = 0
+    for nombre, apartado in apartados.items():
+        if nombre in usados or os.path.getmtime(apartado) >= limite:
+            destino = ruta_blob(nombre)
+            if os.path.exists(destino):
+                os.remove(apartado)
+            else:
+                os.replace(apartado, destino)
+        else:
+            os.remove(apartado)
+            borrados += 1
+    return borrados
+
+
+#-----------------------------------------------------------------------
+# INGESTA DE IMÁGENES: RECODIFICACIÓN Y MINIATURAS EN PARALELO
+#-----------------------------------------------------------------------
+# Cada archivo subido se decodifica con PIL, se endereza según su EXIF y se vuelve a
+# codificar en WebP sin metadatos (ni EXIF ni GPS ni perfil ICC), con un lado máximo de
+# LADO_MAXIMO_IMAGEN. Además se generan miniaturas de los lados de LADOS_MINIATURAS.
+# Todo va al almacén de blobs; la base recibe un único INSERT por estudio.
+LADO_MAXIMO_IMAGEN = 2560
+LADOS_MINIATURAS = (160, 640)
+CALIDAD_WEBP = 82
+TIPOS_IMAGEN_ADMITIDOS = ["png", "jpg", "jpeg", "webp", "gif", "bmp", "tif", "tiff"]
+
+def _codificar_webp(imagen):
+    salida = io.BytesIO()
+    # method=2 pesa casi lo mismo que el 4 por defecto y codifica unas tres veces más rápido
+    imagen.save(salida, format="WEBP", quality=CALIDAD_WEBP, method=2)
+    return salida.getvalue()
+
+def procesar_imagen(contenido):
+    """
+    Decodifica una imagen y devuelve (webp, ancho, alto, {lado: webp de la miniatura}).
+    Lanza ValueError si el archivo no es una imagen válida.
+    """
+    try:
+        with Image.open(io.BytesIO(contenido)) as original:
+            original.seek(0)
+            imagen = ImageOps.exif_transpose(original)
+            imagen.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"no es una imagen válida ({e})") from e
+    imagen = imagen.convert("RGBA" if "A" in imagen.getbands() or "transparency" in imagen.info else "RGB")
+    # Sin metadatos: el WebP se arma solo con los píxeles
+    imagen.info = {}
+    imagen.thumbnail((LADO_MAXIMO_IMAGEN, LADO_MAXIMO_IMAGEN), Image.LANCZOS)
+    # Cada miniatura sale de la anterior (más grande), no de la imagen completa
+    miniaturas, fuente = {}, imagen
+    for lado in sorted(LADOS_MINIATURAS, reverse=True):
+        if max(fuente.size) > lado:
+            fuente = fuente.copy()
+            fuente.thumbnail((lado, lado), Image.LANCZOS)
+            miniaturas[lado] = _codificar_webp(fuente)
+    return _codificar_webp(imagen), imagen.width, imagen.height, miniaturas
+
+def _ingerir_archivo(orden, nombre, contenido):
+    """Procesa un archivo y guarda la imagen y sus miniaturas en el almacén (corre en el pool)."""
+    webp, ancho, alto, miniaturas = procesar_imagen(contenido)
+    hashes_miniaturas = {str(lado): guardar_blob(datos) for lado, datos in miniaturas.items()}
+    return orden, guardar_blob(webp), len(webp), ancho, alto, hashes_miniaturas
+
+@st.cache_resource
+def obtener_pool_imagenes():
+    """Pool de hilos compartido por todas las sesiones (PIL libera el GIL al decodificar y codificar)."""
+    return ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 2), thread_name_prefix="imagenes")
+
+@st.cache_resource
+def _obtener_pool_ingestas():
+    # Aparte del pool de imágenes: una ingesta espera a sus archivos y no debe ocupar un hilo de ese pool
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingestas")
+
+def ingerir_imagenes_estudio(id_estudio, id_paciente, archivos, conn=None):
+    """
+    Procesa en paralelo los archivos [(nombre, bytes)] de un estudio y los guarda con un
+    solo INSERT. Los archivos que no se pueden leer se saltean.
+    Devuelve (cantidad guardada, [(nombre, error)]).
+    """
+    pool = obtener_pool_imagenes()
+    tareas = {pool.submit(_ingerir_archivo, orden, nombre, contenido): nombre
+              for orden, (nombre, contenido) in enumerate(archivos)}
+    filas, errores = [], []
+    for tarea in as_completed(tareas):
+        try:
+            orden, hash_blob, tamanio, ancho, alto, miniaturas = tarea.result()
+            filas.append((int(id_estudio), int(id_paciente), hash_blob, tamanio, "image/webp", ancho, alto,
+                          psycopg2.extras.Json(miniaturas), orden))
+        except Exception as e:
+            errores.append((tareas[tarea], str(e)))
+    if not filas:
+        return 0, errores
+
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    asegurar_esquema_imagenes(conn)
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO imagenes_estudios
+                    (id_estudio, id_paciente, hash, tamanio, tipo_mime, ancho, alto, miniaturas, orden)
+                VALUES %s
+            """, sorted(filas, key=lambda fila: fila[-1]), page_size=len(filas))
+        conn.commit()
+        print(f"✅ {len(filas)} imágenes guardadas para estudio ID: {id_estudio}")
+        return len(filas), errores
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Error al guardar las imágenes del estudio: {str(e)}")
+        return 0, errores + [("(todas)", str(e))]
+    finally:
+        if cerrar:
+            conn.close()
+
+def iniciar_ingesta_imagenes(id_estudio, id_paciente, archivos):
+    """
+    Lanza ingerir_imagenes_estudio en segundo plano (con su propia conexión) y devuelve
+    el Future, así la página no queda esperando a que se procesen las imágenes.
+    """
+    return _obtener_pool_ingestas().submit(ingerir_imagenes_estudio, id_estudio, id_paciente, archivos)
 
+def hash_para_mostrar(imagen, lado):
+    """Hash de la miniatura más chica que cubre `lado`, o de la imagen completa si no hay."""
+    miniaturas = getattr(imagen, "miniaturas", None)
+    miniaturas = miniaturas if isinstance(miniaturas, dict) else {}
+    lados = sorted(int(l) for l in miniaturas if int(l) >= lado)
+    return miniaturas[str(lados[0])] if lados else imagen.hash
 
 
 def eliminar_estudio_medico(estudio_id, dni, conn=None):
@@ -301,12 +655,12 @@ def get_estadisticas_estudios(dni, conn=None):
         query = """
         SELECT 
             COUNT(*) as total_estudios,
-            COUNT(i.imagen_base64) as estudios_con_imagen,
+            COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM imagenes_estudios i WHERE i.id_estudio = e.id_estudio))
+                as estudios_con_imagen,
             COUNT(DISTINCT e.tipo) as tipos_diferentes,
             MIN(e.fecha) as primer_estudio,
             MAX(e.fecha) as ultimo_estudio
         FROM Estudios e
-        LEFT JOIN imagenes_estudios i ON e.id_estudio = i.id_estudio
         WHERE e.id_paciente = %s
         """
         
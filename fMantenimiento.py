@@ -0,0 +1,58 @@
+# fMantenimiento.py
+# Mantenimiento diario de la base: migraciones pendientes, adherencia y log de tomas de
+# medicamentos, restricciones de turnos e imágenes de estudios (almacén de blobs).
+# Cada paso corre aunque falle el anterior; si alguno falla, termina con código 1.
+# Pensado para correr una vez por día (cron), aparte de los recordatorios:
+#     python fMantenimiento.py
+import sys
+from fmedi import (cerrar_adherencia, particionar_tomas, compactar_tomas, completar_dosis_texto,
+                   migrar_horarios_medicamentos)
+from fHistorial import migrar_imagenes_a_blobs, limpiar_blobs_huerfanos
+from fCalendario import migrar_restricciones_turnos
+
+def _horarios():
+    invalidos = migrar_horarios_medicamentos()
+    if invalidos is None:
+        raise RuntimeError("la migración de horarios falló")
+    if invalidos:
+        print(f"frecuencia_valor no es JSON válido en los medicamentos {', '.join(map(str, invalidos))}: "
+              "los horarios quedan sin migrar hasta corregirlos")
+
+def _restricciones_turnos():
+    superpuestos = migrar_restricciones_turnos()
+    if superpuestos is None:
+        raise RuntimeError("no se pudieron crear las restricciones de exclusión")
+    if superpuestos:
+        print(f"Turnos superpuestos: {', '.join(f'{a} y {b}' for a, b in superpuestos)}. "
+              "Las restricciones de exclusión de Turnos no se crean hasta resolverlos")
+
+def _tomas():
+    if not particionar_tomas():
+        raise RuntimeError("no se pudo particionar el log de tomas")
+    print(f"Particiones de tomas compactadas: {', '.join(compactar_tomas()) or 'ninguna'}")
+
+PASOS = [
+    ("horarios de medicamentos", _horarios),
+    ("restricciones de turnos", _restricciones_turnos),
+    ("adherencia", lambda: print(f"Días de adherencia cerrados: {cerrar_adherencia(armar_historico=True)} filas nuevas")),
+    ("dosis_texto", lambda: print(f"Medicamentos con dosis_texto completado: {completar_dosis_texto()}")),
+    ("log de tomas", _tomas),
+    ("imágenes de estudios", lambda: print(f"Imágenes de estudios pasadas al almacén: {migrar_imagenes_a_blobs()}")),
+    ("blobs huérfanos", lambda: print(f"Blobs sin referencias borrados: {limpiar_blobs_huerfanos()}")),
+]
+
+def main():
+    fallidos = []
+    for descripcion, paso in PASOS:
+        try:
+            paso()
+        except Exception as e:
+            print(f"Error en el mantenimiento ({descripcion}): {e}")
+            fallidos.append(descripcion)
+    if fallidos:
+        print(f"Pasos con error: {', '.join(fallidos)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
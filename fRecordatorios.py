@@ -0,0 +1,191 @@
+# fRecordatorios.py
+# Recordatorios diarios de turnos: los arma en el outbox y los entrega por SMTP.
+# El mantenimiento de la base y de los blobs está en fMantenimiento.py.
+# Pensado para correr una vez por día (cron):
+#     python fRecordatorios.py
+import os
+import smtplib
+from email.message import EmailMessage
+from datetime import datetime, timedelta
+from heapq import merge
+from itertools import groupby
+import psycopg2.extras
+from functions import connect_to_supabase
+from fCalendario import ocurrencias_series
+
+LOTE_OUTBOX = 1000
+# Después de tantos envíos fallidos un mensaje queda en el outbox, pero no se reintenta
+INTENTOS_MAXIMOS = 5
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "1025"))
+SMTP_REMITENTE = os.getenv("SMTP_REMITENTE", "recordatorios@medcheck.local")
+
+def asegurar_esquema_recordatorios(conn):
+    """
+    Crea la tabla outbox de recordatorios y el índice por fecha de turnos
+    que usa la consulta por rango.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_recordatorios (
+                id SERIAL PRIMARY KEY,
+                clave TEXT NOT NULL UNIQUE,
+                id_paciente INTEGER NOT NULL,
+                destinatario TEXT,
+                asunto TEXT NOT NULL,
+                cuerpo TEXT NOT NULL,
+                creado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                enviado_en TIMESTAMP,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT
+            );
+            DROP INDEX IF EXISTS outbox_recordatorios_pendientes_idx;
+            CREATE INDEX IF NOT EXISTS outbox_recordatorios_pendientes_intentos_idx
+                ON outbox_recordatorios (intentos, id) WHERE enviado_en IS NULL;
+            CREATE INDEX IF NOT EXISTS turnos_fecha_hora_idx ON turnos (fecha, hora);
+        """)
+    conn.commit()
+
+def _armar_mensaje(nombre, turnos):
+    saludo = f"Hola {nombre}," if nombre else "Hola,"
+    lineas = [saludo, "", "Te recordamos tus próximos turnos:", ""]
+    for fecha, hora, medico, lugar in turnos:
+        lineas.append(f"  • {fecha.strftime('%d/%m/%Y')} a las {hora.strftime('%H:%M')} hs con {medico}"
+                      f" en {lugar or 'lugar no especificado'}")
+    lineas += ["", "MedCheck"]
+    asunto = "Recordatorio de turno" if len(turnos) == 1 else f"Recordatorio: tenés {len(turnos)} turnos"
+    return asunto, "\n".join(lineas)
+
+def generar_recordatorios(ahora=None, conn=None):
+    """
+    Escribe en outbox_recordatorios un mensaje por paciente con sus turnos de
+    mañana (el día calendario siguiente a `ahora`), incluidas las ocurrencias de series
+    recurrentes. Es una sola consulta por fecha (índice por fecha) leída con un cursor
+    del lado del servidor y ordenada por paciente, así que se agrupa al vuelo sin
+    consultas por paciente. La clave del mensaje es el paciente y el día de los turnos,
+    así que correrlo dos veces el mismo día, a cualquier hora, no duplica mensajes.
+    Devuelve la cantidad de mensajes nuevos.
+    """
+    dia = (ahora or datetime.now()).date() + timedelta(days=1)
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    asegurar_esquema_recordatorios(conn)
+
+    escritor = conn.cursor()
+    nuevos = 0
+    lote = []
+
+    def volcar():
+        nonlocal nuevos, lote
+        if lote:
+            insertados = psycopg2.extras.execute_values(escritor, """
+                INSERT INTO outbox_recordatorios (clave, id_paciente, destinatario, asunto, cuerpo)
+                VALUES %s
+                ON CONFLICT (clave) DO NOTHING
+                RETURNING id
+            """, lote, page_size=len(lote), fetch=True)
+            nuevos += len(insertados)
+            lote = []
+
+    try:
+        # Las series se expanden en memoria (son pocas filas) y se intercalan con los turnos en orden
+        with conn.cursor() as cur:
+            series = sorted(
+                ((o["id_paciente"], o["paciente"], o["email"], o["fecha"], o["hora"], o["medico"], o["lugar"])
+                 for o in ocurrencias_series(cur, dia, dia + timedelta(days=1))),
+                key=lambda fila: fila[:1] + fila[3:5])
+
+        with conn.cursor(name="recordatorios_turnos") as lector:
+            lector.itersize = 10000
+            lector.execute("""
+                SELECT t.id_paciente, p.nombre, p.email, t.fecha, t.hora, m.nombre, t.lugar
+                FROM Turnos t
+                JOIN Pacientes p ON t.id_paciente = p.id_paciente
+                JOIN Medicos m ON t.id_medico = m.id_medico
+                WHERE t.fecha = %s AND t.hora IS NOT NULL
+                ORDER BY t.id_paciente, t.fecha, t.hora
+            """, (dia,))
+
+            turnos = merge(lector, series, key=lambda fila: fila[:1] + fila[3:5])
+            for id_paciente, filas in groupby(turnos, key=lambda fila: fila[0]):
+                filas = list(filas)
+                _, nombre, email, _, _, _, _ = filas[0]
+                asunto, cuerpo = _armar_mensaje(nombre, [fila[3:] for fila in filas])
+                clave = f"turnos-{id_paciente}-{dia}"
+                lote.append((clave, id_paciente, email, asunto, cuerpo))
+                if len(lote) >= LOTE_OUTBOX:
+                    volcar()
+            volcar()
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al generar recordatorios: {e}")
+        raise e
+    finally:
+        escritor.close()
+        if cerrar:
+            conn.close()
+    return nuevos
+
+def entregar_pendientes(conn=None, host=SMTP_HOST, port=SMTP_PORT, limite=5000):
+    """
+    Envía por SMTP los mensajes pendientes del outbox y los marca como enviados.
+    Primero van los que menos intentos llevan, así que los que fallan una y otra vez no
+    frenan a los nuevos; después de INTENTOS_MAXIMOS fallas un mensaje ya no se reintenta.
+    En desarrollo alcanza con un servidor local de prueba, por ejemplo:
+        python -m aiosmtpd -n -l localhost:1025
+    Devuelve (enviados, fallidos).
+    """
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    enviados, fallidos = [], []
+    try:
+        with conn.cursor() as cur:
+            # SKIP LOCKED permite correr varios entregadores en paralelo sin mandar dos veces
+            cur.execute("""
+                SELECT id, destinatario, asunto, cuerpo
+                FROM outbox_recordatorios
+                WHERE enviado_en IS NULL AND destinatario IS NOT NULL AND intentos < %s
+                ORDER BY intentos, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (INTENTOS_MAXIMOS, limite))
+            pendientes = cur.fetchall()
+
+            with smtplib.SMTP(host, port) as smtp:
+                for id_mensaje, destinatario, asunto, cuerpo in pendientes:
+                    mensaje = EmailMessage()
+                    mensaje["From"] = SMTP_REMITENTE
+                    mensaje["To"] = destinatario
+                    mensaje["Subject"] = asunto
+                    mensaje.set_content(cuerpo)
+                    try:
+                        smtp.send_message(mensaje)
+                        enviados.append(id_mensaje)
+                    except smtplib.SMTPException as e:
+                        fallidos.append((id_mensaje, str(e)))
+
+            if enviados:
+                cur.execute("UPDATE outbox_recordatorios SET enviado_en = NOW(), intentos = intentos + 1 WHERE id = ANY(%s)",
+                            (enviados,))
+            if fallidos:
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE outbox_recordatorios o
+                    SET intentos = o.intentos + 1, ultimo_error = f.error
+                    FROM (VALUES %s) AS f (id, error)
+                    WHERE o.id = f.id
+                """, fallidos)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al entregar recordatorios: {e}")
+        raise e
+    finally:
+        if cerrar:
+            conn.close()
+    return len(enviados), len(fallidos)
+
+if __name__ == "__main__":
+    print(f"Recordatorios nuevos en el outbox: {generar_recordatorios()}")
+    enviados, fallidos = entregar_pendientes()
+    print(f"Enviados: {enviados} · Fallidos: {fallidos}")
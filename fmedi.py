@@ -1,25 +1,89 @@
 # fMedicamentos.py
+import streamlit as st
 import pandas as pd
-from datetime import date
+from datetime import date, datetime, time, timedelta
+from collections import namedtuple
+from functools import lru_cache
+import os
 import json
-from functions import execute_query
+import uuid
+import tempfile
+import unicodedata
+import psycopg2.extras
+from functions import execute_query, connect_to_supabase
 from fEncuesta import get_id_paciente_por_dni
 
-def get_medicamentos(dni, solo_actuales=False, solo_finalizados=False, conn=None):
+# Se ejecuta una sola vez por proceso (los CREATE INDEX son idempotentes)
+_indices_medicamentos_listos = False
+
+def asegurar_indices_medicamentos(conn=None):
+    global _indices_medicamentos_listos
+    if _indices_medicamentos_listos:
+        return
+    query = """
+        CREATE INDEX IF NOT EXISTS tomas_medicamentos_medicamento_fecha_idx
+            ON tomas_medicamentos (id_medicamento, fecha_toma);
+        CREATE INDEX IF NOT EXISTS medicamentos_paciente_idx
+            ON medicamentos (id_paciente);
+        CREATE INDEX IF NOT EXISTS medicamentos_paciente_fin_idx
+            ON medicamentos (id_paciente, fecha_fin, id_medicamento);
+    """
+    _indices_medicamentos_listos = bool(execute_query(query, conn=conn, is_select=False))
+
+def get_medicamentos(dni, solo_actuales=False, solo_finalizados=False, con_tomas=False, conn=None):
     """
     Obtiene los medicamentos de un paciente con información del paciente.
+    Con con_tomas=True agrega, en la misma consulta, tomas_hoy (cantidad tomada hoy),
+    ultima_toma, dosis_restantes (dosis que alcanzan con el stock actual) y
+    ritmo_reciente (tomas registradas / programadas de los últimos días, del rollup).
     """
     id_paciente = get_id_paciente_por_dni(dni, conn)
     if not id_paciente:
         return pd.DataFrame()
 
-    query = """
-        SELECT m.*, p.nombre as nombre_paciente 
-        FROM medicamentos m 
-        JOIN pacientes p ON m.id_paciente = p.id_paciente 
-        WHERE m.id_paciente = %s AND (m.oculto IS NULL OR m.oculto = FALSE)
-    """
-    params = [int(id_paciente)]
+    if con_tomas:
+        asegurar_indices_medicamentos(conn)
+        asegurar_esquema_adherencia(conn)
+        query = """
+            SELECT m.*, p.nombre as nombre_paciente,
+                   COALESCE(h.tomas_hoy, 0) AS tomas_hoy,
+                   u.ultima_toma, r.ritmo_reciente,
+                   CASE WHEN m.stock_actual IS NULL OR COALESCE(m.dosis_cantidad, 0) <= 0 THEN NULL
+                        ELSE FLOOR(m.stock_actual / m.dosis_cantidad) END AS dosis_restantes
+            FROM medicamentos m 
+            JOIN pacientes p ON m.id_paciente = p.id_paciente 
+            -- Solo el rango de hoy (y la partición de este mes), no todo el historial
+            LEFT JOIN LATERAL (
+                SELECT SUM(tm.cantidad_tomada) AS tomas_hoy
+                FROM tomas_medicamentos tm
+                WHERE tm.id_medicamento = m.id_medicamento
+                  AND tm.fecha_toma >= CURRENT_DATE AND tm.fecha_toma < CURRENT_DATE + 1
+            ) h ON TRUE
+            -- La última toma es la primera fila del índice (id_medicamento, fecha_toma) recorrido al revés
+            LEFT JOIN LATERAL (
+                SELECT tm.fecha_toma AS ultima_toma
+                FROM tomas_medicamentos tm
+                WHERE tm.id_medicamento = m.id_medicamento
+                ORDER BY tm.fecha_toma DESC
+                LIMIT 1
+            ) u ON TRUE
+            LEFT JOIN (
+                SELECT id_medicamento, SUM(tomadas)::float / NULLIF(SUM(programadas), 0) AS ritmo_reciente
+                FROM adherencia_diaria
+                WHERE id_paciente = %s AND dia >= CURRENT_DATE - %s AND dia < CURRENT_DATE
+                GROUP BY id_medicamento
+            ) r ON r.id_medicamento = m.id_medicamento
+            WHERE m.id_paciente = %s AND (m.oculto IS NULL OR m.oculto = FALSE)
+        """
+        params = [int(id_paciente), DIAS_CONSUMO_RECIENTE, int(id_paciente)]
+    else:
+        query = """
+            SELECT m.*, p.nombre as nombre_paciente 
+            FROM medicamentos m 
+            JOIN pacientes p ON m.id_paciente = p.id_paciente 
+            WHERE m.id_paciente = %s AND (m.oculto IS NULL OR m.oculto = FALSE)
+        """
+        params = [int(id_paciente)]
 
     if solo_actuales:
         query += " AND (m.fecha_fin IS NULL OR m.fecha_fin > CURRENT_DATE)"
@@ -32,62 +96,189 @@ def get_medicamentos(dni, solo_actuales=False, solo_finalizados=False, conn=None
 
 def insertar_medicamento(dni, droga, nombre, gramaje_mg, motivo, fecha_inicio, fecha_fin,
                          dosis_cantidad, dosis_unidad, frecuencia_tipo, frecuencia_valor,
-                         stock_inicial, recordatorio, conn=None):
+                         stock_inicial, recordatorio, ignorar_alergias=False, conn=None):
     """
     Inserta un nuevo medicamento con la lógica mejorada de dosis, frecuencia y recordatorios.
+    Si la droga está en el conjunto de alergias del paciente lanza AlergiaMedicamento,
+    salvo que ignorar_alergias=True (el paciente ya vio la advertencia y confirmó).
     """
+    if not ignorar_alergias:
+        alergias = verificar_alergias(dni, droga, conn)
+        if alergias:
+            raise AlergiaMedicamento(droga, alergias)
     id_paciente = int(get_id_paciente_por_dni(dni, conn))
     stock_actual = stock_inicial if stock_inicial > 0 else None
-    frecuencia_valor_json = json.dumps(frecuencia_valor) if frecuencia_valor else None
+    frecuencia_valor_json = psycopg2.extras.Json(frecuencia_valor) if frecuencia_valor else None
     concentracion = None
+    # El texto para mostrar se arma una sola vez, al guardar
+    dosis_texto = formatear_dosis_texto({'dosis_cantidad': dosis_cantidad, 'dosis_unidad': dosis_unidad,
+                                         'frecuencia_tipo': frecuencia_tipo, 'frecuencia_valor': frecuencia_valor})
+    asegurar_columna_dosis_texto(conn)
 
     query = """
         INSERT INTO medicamentos 
         (id_paciente, droga, nombre, gramaje_mg, concentracion, motivo, fecha_inicio, fecha_fin,
          dosis_cantidad, dosis_unidad, frecuencia_tipo, frecuencia_valor,
-         stock_inicial, stock_actual, oculto, recordatorio)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE, %s)
+         stock_inicial, stock_actual, oculto, recordatorio, dosis_texto)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE, %s, %s)
     """
     params = (id_paciente, droga, nombre, gramaje_mg, concentracion, motivo, fecha_inicio, fecha_fin,
               dosis_cantidad, dosis_unidad, frecuencia_tipo, frecuencia_valor_json,
-              stock_inicial, stock_actual, recordatorio)
+              stock_inicial, stock_actual, recordatorio, dosis_texto)
     
     execute_query(query, params=params, conn=conn, is_select=False)
 
+DOSIS_NO_DISPONIBLE = "Información de dosis no disponible"
+
+@lru_cache(maxsize=8192)
+def _texto_frecuencia(frecuencia_tipo, frecuencia_valor):
+    """
+    Parte del texto de dosis que describe la frecuencia. Se cachea por contenido
+    (frecuencia_valor como texto JSON), así cada frecuencia distinta se parsea una vez.
+    Devuelve None si el JSON no es válido.
+    """
+    try:
+        valor_frec = json.loads(frecuencia_valor) if frecuencia_valor else {}
+        if frecuencia_tipo == "Cada 'X' horas":
+            intervalo = valor_frec.get('intervalo_horas', '?')
+            return f"cada {intervalo} horas"
+        if frecuencia_tipo == "En horarios específicos del día":
+            horas = ', '.join(valor_frec.get('horarios_dia', []))
+            return f"a las {horas}" if horas else "en horarios específicos"
+        if frecuencia_tipo == "En días específicos de la semana":
+            dias = ', '.join(valor_frec.get('dias_semana', []))
+            horas = ', '.join(valor_frec.get('horarios_en_dias', []))
+            return f"los {dias} a las {horas}" if dias and horas else f"los {dias}" if dias else "en días específicos"
+        if frecuencia_tipo == "texto_plano":
+            return valor_frec.get('texto', '')
+        return ""
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def _cantidad_dosis(cantidad):
+    """Cantidad entera de la dosis (1 si falta), o None si no se puede leer como entero."""
+    try:
+        return int(cantidad) if pd.notna(cantidad) else 1
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def _frecuencia_de(frecuencia_tipo, frecuencia_valor):
+    """_texto_frecuencia para los valores crudos de una fila; None si no se pueden interpretar."""
+    try:
+        return _texto_frecuencia(frecuencia_tipo, _clave_frecuencia(frecuencia_valor))
+    except (ValueError, TypeError):
+        return None
+
 def formatear_dosis_texto(row):
     """
     Función helper MEJORADA para crear un texto legible a partir de datos estructurados.
+    Para muchas filas a la vez usar formatear_dosis_columnas.
     """
     try:
-        cantidad = row['dosis_cantidad']
-        cantidad_num = int(cantidad) if pd.notna(cantidad) else 1
+        cantidad_num = _cantidad_dosis(row['dosis_cantidad'])
         unidad = row['dosis_unidad']
-        tipo_frec = row['frecuencia_tipo']
-        valor_frec = row['frecuencia_valor']
+        texto_frecuencia = _frecuencia_de(row['frecuencia_tipo'], row['frecuencia_valor'])
+        if cantidad_num is None or not isinstance(unidad, str) or texto_frecuencia is None:
+            return DOSIS_NO_DISPONIBLE
 
         unidad_texto = unidad[:-1] if cantidad_num == 1 and unidad.endswith('s') else unidad
-        dosis_texto = f"{cantidad_num} {unidad_texto}"
+        return f"{cantidad_num} {unidad_texto} {texto_frecuencia}".strip()
+    except Exception:
+        return DOSIS_NO_DISPONIBLE
 
-        if isinstance(valor_frec, str):
-            valor_frec = json.loads(valor_frec)
-        
-        texto_frecuencia = ""
-        if tipo_frec == "Cada 'X' horas":
-            intervalo = valor_frec.get('intervalo_horas', '?')
-            texto_frecuencia = f"cada {intervalo} horas"
-        elif tipo_frec == "En horarios específicos del día":
-            horas = ', '.join(valor_frec.get('horarios_dia', []))
-            texto_frecuencia = f"a las {horas}" if horas else "en horarios específicos"
-        elif tipo_frec == "En días específicos de la semana":
-            dias = ', '.join(valor_frec.get('dias_semana', []))
-            horas = ', '.join(valor_frec.get('horarios_en_dias', []))
-            texto_frecuencia = f"los {dias} a las {horas}" if dias and horas else f"los {dias}" if dias else "en días específicos"
-        elif tipo_frec == "texto_plano":
-            texto_frecuencia = valor_frec.get('texto', '')
+def formatear_dosis_columnas(df):
+    """
+    Versión por columnas de formatear_dosis_texto (mismo resultado fila por fila, incluidos
+    los casos sin dosis disponible): arma el texto de todas las filas con operaciones de
+    pandas y parsea cada frecuencia distinta una sola vez.
+    """
+    if df.empty:
+        return pd.Series(dtype=object, index=df.index)
+    cantidad = df['dosis_cantidad'].map(_cantidad_dosis)
+    cantidad_invalida = cantidad.isna()
+    cantidad = cantidad.fillna(1).astype(int)
+    unidad = df['dosis_unidad']
+    unidad_invalida = ~unidad.map(lambda valor: isinstance(valor, str)).astype(bool)
+    texto_unidad = unidad.where(~unidad_invalida, '').astype(str)
+    texto_unidad = texto_unidad.where(~((cantidad == 1) & texto_unidad.str.endswith('s')), texto_unidad.str[:-1])
 
-        return f"{dosis_texto} {texto_frecuencia}".strip()
-    except Exception:
-        return "Información de dosis no disponible"
+    # Cada frecuencia distinta se interpreta una vez; las que no sirven de clave, fila por fila
+    textos = {}
+    def frecuencia(tipo, valor):
+        try:
+            clave = (tipo, _clave_frecuencia(valor))
+            hash(clave)
+        except (ValueError, TypeError):
+            return None
+        if clave not in textos:
+            textos[clave] = _frecuencia_de(tipo, valor)
+        return textos[clave]
+    texto_frecuencia = pd.Series([frecuencia(tipo, valor) for tipo, valor in zip(df['frecuencia_tipo'], df['frecuencia_valor'])],
+                                 index=df.index, dtype=object)
+
+    texto = (cantidad.astype(str) + " " + texto_unidad + " " + texto_frecuencia.fillna('')).str.strip()
+    invalido = cantidad_invalida | unidad_invalida | texto_frecuencia.isna()
+    return texto.where(~invalido, DOSIS_NO_DISPONIBLE)
+
+def columna_dosis_texto(df):
+    """
+    Texto de dosis para mostrar: usa la columna guardada dosis_texto y calcula
+    (por columnas) solo las filas que todavía no lo tienen.
+    """
+    if 'dosis_texto' not in df:
+        return formatear_dosis_columnas(df)
+    texto = df['dosis_texto'].copy()
+    faltantes = texto.isna()
+    if faltantes.any():
+        texto[faltantes] = formatear_dosis_columnas(df[faltantes])
+    return texto
+
+_columna_dosis_texto_lista = False
+
+def asegurar_columna_dosis_texto(conn=None):
+    global _columna_dosis_texto_lista
+    if _columna_dosis_texto_lista:
+        return
+    query = "ALTER TABLE medicamentos ADD COLUMN IF NOT EXISTS dosis_texto TEXT"
+    _columna_dosis_texto_lista = bool(execute_query(query, conn=conn, is_select=False))
+
+def completar_dosis_texto(conn=None, lote=5000):
+    """
+    Guarda dosis_texto en los medicamentos que todavía no lo tienen (los cargados antes
+    de que existiera la columna). Devuelve la cantidad de filas actualizadas.
+    """
+    asegurar_columna_dosis_texto(conn)
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    actualizadas = 0
+    try:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute("""
+                    SELECT id_medicamento, dosis_cantidad, dosis_unidad, frecuencia_tipo, frecuencia_valor
+                    FROM medicamentos WHERE dosis_texto IS NULL
+                    ORDER BY id_medicamento LIMIT %s
+                """, (lote,))
+                filas = cur.fetchall()
+                if not filas:
+                    break
+                pendientes = pd.DataFrame(filas, columns=["id_medicamento", "dosis_cantidad", "dosis_unidad",
+                                                          "frecuencia_tipo", "frecuencia_valor"])
+                textos = formatear_dosis_columnas(pendientes)
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE medicamentos m SET dosis_texto = v.texto
+                    FROM (VALUES %s) AS v (id_medicamento, texto)
+                    WHERE m.id_medicamento = v.id_medicamento
+                """, list(zip(pendientes["id_medicamento"].tolist(), textos.tolist())), page_size=lote)
+                conn.commit()
+                actualizadas += len(filas)
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al completar dosis_texto: {e}")
+    finally:
+        if cerrar:
+            conn.close()
+    return actualizadas
 
 def marcar_medicamento_como_finalizado(id_medicamento, conn=None):
     """
@@ -97,23 +288,182 @@ def marcar_medicamento_como_finalizado(id_medicamento, conn=None):
     params = (date.today(), id_medicamento)
     execute_query(query, params=params, conn=conn, is_select=False)
 
-def registrar_toma(id_medicamento, cantidad_tomada, conn=None):
+# ------------------------
+# 📜 Historial de medicamentos finalizados (paginado)
+# ------------------------
+HISTORIAL_POR_PAGINA = 20
+
+def _patron_ilike(texto):
+    """Patrón 'contiene' para ILIKE, con los comodines del texto escapados."""
+    return "%" + texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _filtros_historial(dni, desde=None, hasta=None, droga=None, motivo=None):
+    """Condiciones WHERE y parámetros comunes a la página del historial y a su conteo."""
+    condiciones = ["m.id_paciente = (SELECT id_paciente FROM pacientes WHERE dni = %s)",
+                   "m.fecha_fin IS NOT NULL AND m.fecha_fin <= CURRENT_DATE",
+                   "(m.oculto IS NULL OR m.oculto = FALSE)"]
+    params = [dni]
+    # Tratamientos que se superponen con el período elegido
+    if desde:
+        condiciones.append("m.fecha_fin >= %s")
+        params.append(desde)
+    if hasta:
+        condiciones.append("(m.fecha_inicio IS NULL OR m.fecha_inicio <= %s)")
+        params.append(hasta)
+    if droga:
+        condiciones.append("(m.droga ILIKE %s OR m.nombre ILIKE %s)")
+        params += [_patron_ilike(droga)] * 2
+    if motivo:
+        condiciones.append("m.motivo ILIKE %s")
+        params.append(_patron_ilike(motivo))
+    return " AND ".join(condiciones), params
+
+def get_historial_medicamentos(dni, desde=None, hasta=None, droga=None, motivo=None,
+                               despues_de=None, limite=HISTORIAL_POR_PAGINA, conn=None):
     """
-    Registra una toma y actualiza el stock.
+    Una página del historial de medicamentos finalizados, del más reciente al más viejo,
+    con solo las columnas que se muestran. La paginación es por clave: despues_de es
+    (fecha_fin, id_medicamento) de la última fila de la página anterior, así que cada
+    página es un recorrido corto del índice (id_paciente, fecha_fin, id_medicamento)
+    sin importar cuántas páginas haya antes.
     """
-    query_log = "INSERT INTO tomas_medicamentos (id_medicamento, cantidad_tomada) VALUES (%s, %s)"
-    params_log = (id_medicamento, cantidad_tomada)
-    execute_query(query_log, params=params_log, conn=conn, is_select=False)
-    
-    query_stock = "UPDATE medicamentos SET stock_actual = stock_actual - %s WHERE id_medicamento = %s AND stock_actual >= %s"
-    params_stock = (cantidad_tomada, id_medicamento, cantidad_tomada)
-    execute_query(query_stock, params=params_stock, conn=conn, is_select=False)
+    asegurar_indices_medicamentos(conn)
+    asegurar_columna_dosis_texto(conn)
+    where, params = _filtros_historial(dni, desde, hasta, droga, motivo)
+    if despues_de:
+        where += " AND (m.fecha_fin, m.id_medicamento) < (%s, %s)"
+        params += [despues_de[0], int(despues_de[1])]
+    query = f"""
+        SELECT m.id_medicamento, m.nombre, m.motivo, m.fecha_inicio, m.fecha_fin, m.dosis_texto,
+               -- Solo para las filas viejas sin dosis_texto (las completa completar_dosis_texto)
+               CASE WHEN m.dosis_texto IS NULL THEN m.dosis_cantidad END AS dosis_cantidad,
+               CASE WHEN m.dosis_texto IS NULL THEN m.dosis_unidad END AS dosis_unidad,
+               CASE WHEN m.dosis_texto IS NULL THEN m.frecuencia_tipo END AS frecuencia_tipo,
+               CASE WHEN m.dosis_texto IS NULL THEN m.frecuencia_valor END AS frecuencia_valor
+        FROM medicamentos m
+        WHERE {where}
+        ORDER BY m.fecha_fin DESC, m.id_medicamento DESC
+        LIMIT %s
+    """
+    return execute_query(query, params=params + [limite], conn=conn, is_select=True)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def contar_historial_medicamentos(dni, desde=None, hasta=None, droga=None, motivo=None):
+    """
+    Cantidad de medicamentos del historial con esos filtros. Queda en caché por paciente y
+    filtros (cambiar de página no vuelve a contar); finalizar un tratamiento la invalida
+    con invalidar_historial.
+    """
+    where, params = _filtros_historial(dni, desde, hasta, droga, motivo)
+    resultado = execute_query(f"SELECT COUNT(*) AS total FROM medicamentos m WHERE {where}", params=params, is_select=True)
+    return 0 if resultado.empty else int(resultado.iloc[0]["total"])
+
+def invalidar_historial():
+    """Descarta los conteos del historial cacheados (después de finalizar un tratamiento)."""
+    contar_historial_medicamentos.clear()
+
+_esquema_tomas_listo = False
+
+def asegurar_esquema_tomas(conn=None):
+    """
+    Agrega a tomas_medicamentos la clave de idempotencia. La unicidad vive en claves_tomas,
+    porque una tabla particionada solo admite índices únicos que incluyan la fecha.
+    """
+    global _esquema_tomas_listo
+    if _esquema_tomas_listo:
+        return
+    query = """
+        ALTER TABLE tomas_medicamentos ADD COLUMN IF NOT EXISTS clave_idempotencia TEXT;
+        CREATE TABLE IF NOT EXISTS claves_tomas (
+            clave TEXT PRIMARY KEY,
+            creada_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS claves_tomas_creada_en_idx ON claves_tomas (creada_en);
+    """
+    _esquema_tomas_listo = bool(execute_query(query, conn=conn, is_select=False))
+
+def nueva_clave_toma():
+    """Clave de idempotencia para una toma. Se genera del lado del cliente, antes de registrarla."""
+    return uuid.uuid4().hex
+
+def registrar_toma(id_medicamento, cantidad_tomada, clave_idempotencia=None, dosis_programadas_hoy=None, conn=None):
+    """
+    Registra una toma, descuenta el stock y la suma a los rollups de adherencia,
+    todo en una sola sentencia (un único viaje y una única transacción).
+    Con la misma clave_idempotencia, los reintentos y los doble clic no registran
+    nada nuevo. dosis_programadas_hoy (ver calcular_agenda_dosis) evita una consulta
+    previa para conocer las dosis del día.
+    Devuelve (registrada, stock_actual), o None si falló.
+    """
+    asegurar_esquema_tomas(conn)
+    asegurar_esquema_adherencia(conn)
+    dia = date.today()
+    if dosis_programadas_hoy is None:
+        dosis_programadas_hoy = _dosis_programadas_de(id_medicamento, dia, conn)
+
+    query = """
+        WITH clave AS (
+            INSERT INTO claves_tomas (clave) VALUES (%(clave)s)
+            ON CONFLICT (clave) DO NOTHING
+            RETURNING clave
+        ), toma AS (
+            INSERT INTO tomas_medicamentos (id_medicamento, cantidad_tomada, clave_idempotencia)
+            SELECT %(id_medicamento)s, %(cantidad)s, clave FROM clave
+            RETURNING id_medicamento
+        ), stock AS (
+            UPDATE medicamentos m SET stock_actual = m.stock_actual - %(cantidad)s
+            FROM toma
+            WHERE m.id_medicamento = toma.id_medicamento AND m.stock_actual >= %(cantidad)s
+            RETURNING m.stock_actual
+        ), fila AS (
+            -- xmax = 0 solo en filas recién insertadas: así el total de la clínica suma
+            -- las programadas una única vez por medicamento y día
+            INSERT INTO adherencia_diaria AS a (id_medicamento, id_paciente, dia, programadas, tomadas)
+            SELECT m.id_medicamento, m.id_paciente, %(dia)s, %(programadas)s, 1
+            FROM toma JOIN medicamentos m ON m.id_medicamento = toma.id_medicamento
+            ON CONFLICT (id_medicamento, dia) DO UPDATE SET tomadas = a.tomadas + 1
+            RETURNING (xmax = 0) AS nueva, a.tomadas <= a.programadas AS a_termino
+        ), clinica AS (
+            INSERT INTO adherencia_clinica_diaria AS c (dia, programadas, tomadas)
+            SELECT %(dia)s, CASE WHEN nueva THEN %(programadas)s ELSE 0 END, CASE WHEN a_termino THEN 1 ELSE 0 END
+            FROM fila
+            ON CONFLICT (dia) DO UPDATE
+            SET programadas = c.programadas + EXCLUDED.programadas, tomadas = c.tomadas + EXCLUDED.tomadas
+        )
+        SELECT EXISTS (SELECT 1 FROM toma) AS registrada,
+               COALESCE((SELECT stock_actual FROM stock),
+                        (SELECT stock_actual FROM medicamentos WHERE id_medicamento = %(id_medicamento)s)) AS stock_actual
+    """
+    # Los valores que vienen de una fila de pandas son escalares de numpy
+    cantidad_tomada = cantidad_tomada.item() if hasattr(cantidad_tomada, "item") else cantidad_tomada
+    params = {"id_medicamento": int(id_medicamento), "cantidad": cantidad_tomada,
+              "clave": clave_idempotencia or nueva_clave_toma(), "dia": dia,
+              "programadas": int(dosis_programadas_hoy)}
+
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            registrada, stock_actual = cur.fetchone()
+        conn.commit()
+        return registrada, stock_actual
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al registrar la toma: {e}")
+        return None
+    finally:
+        if cerrar:
+            conn.close()
 
 def verificar_toma_hoy(id_medicamento, conn=None):
     """
     DEPRECADA - Reemplazada por contar_tomas_hoy para mayor precisión.
     """
-    query = "SELECT EXISTS (SELECT 1 FROM tomas_medicamentos WHERE id_medicamento = %s AND DATE(fecha_toma) = CURRENT_DATE);"
+    query = """
+        SELECT EXISTS (SELECT 1 FROM tomas_medicamentos
+                       WHERE id_medicamento = %s AND fecha_toma >= CURRENT_DATE AND fecha_toma < CURRENT_DATE + 1);
+    """
     params = (id_medicamento,)
     result = execute_query(query, params=params, conn=conn, is_select=True)
     return result.iloc[0]['exists'] if not result.empty else False
@@ -125,10 +475,1345 @@ def contar_tomas_hoy(id_medicamento, conn=None):
     query = """
         SELECT COALESCE(SUM(cantidad_tomada), 0) as total_tomado
         FROM tomas_medicamentos 
-        WHERE id_medicamento = %s AND DATE(fecha_toma) = CURRENT_DATE;
+        WHERE id_medicamento = %s AND fecha_toma >= CURRENT_DATE AND fecha_toma < CURRENT_DATE + 1;
     """
     params = (id_medicamento,)
     result = execute_query(query, params=params, conn=conn, is_select=True)
     if not result.empty:
         return int(result.iloc[0]['total_tomado'])
     return 0
+
+
+# ------------------------
+# ⏰ Motor de horarios de dosis
+# ------------------------
+DIAS_SEMANA_INDICE = {"Lunes": 0, "Martes": 1, "Miércoles": 2, "Jueves": 3, "Viernes": 4, "Sábado": 5, "Domingo": 6}
+
+# Hora de la primera toma para "Cada 'X' horas" y para días sin horarios cargados.
+# Los intervalos van siempre sobre la grilla fija que arranca en fecha_inicio a esta hora
+# (no desde la última toma): así coinciden las dosis del día, la próxima toma, la
+# adherencia, las franjas de horarios_medicamentos y los avisos de fAvisosDosis.
+HORA_PRIMERA_TOMA = time(8, 0)
+
+# intervalo: timedelta o None · horarios: tupla ordenada de time · dias: frozenset de weekday (None = todos)
+HorarioDosis = namedtuple("HorarioDosis", ["intervalo", "horarios", "dias"])
+
+def _clave_frecuencia(frecuencia_valor):
+    """Texto estable del JSON de frecuencia, para usarlo como clave de caché."""
+    if frecuencia_valor is None or (not isinstance(frecuencia_valor, (str, dict)) and pd.isna(frecuencia_valor)):
+        return None
+    if isinstance(frecuencia_valor, str):
+        return frecuencia_valor
+    return json.dumps(frecuencia_valor, sort_keys=True)
+
+def _parsear_horas(horas):
+    return tuple(sorted(datetime.strptime(h, "%H:%M").time() for h in horas or []))
+
+@lru_cache(maxsize=8192)
+def parsear_horario(frecuencia_tipo, frecuencia_valor):
+    """
+    Convierte frecuencia_tipo + frecuencia_valor (texto JSON) en un HorarioDosis.
+    Queda en caché por su contenido: un medicamento se vuelve a parsear solo si
+    cambia su frecuencia. Devuelve None si no hay un horario calculable.
+    """
+    try:
+        valor = json.loads(frecuencia_valor) if frecuencia_valor else {}
+        if frecuencia_tipo == "Cada 'X' horas":
+            horas = float(valor.get("intervalo_horas") or 0)
+            return HorarioDosis(timedelta(hours=horas), (), None) if horas > 0 else None
+        if frecuencia_tipo == "En horarios específicos del día":
+            horarios = _parsear_horas(valor.get("horarios_dia"))
+            return HorarioDosis(None, horarios, None) if horarios else None
+        if frecuencia_tipo == "En días específicos de la semana":
+            dias = frozenset(DIAS_SEMANA_INDICE[d] for d in valor.get("dias_semana", []) if d in DIAS_SEMANA_INDICE)
+            horarios = _parsear_horas(valor.get("horarios_en_dias")) or (HORA_PRIMERA_TOMA,)
+            return HorarioDosis(None, horarios, dias) if dias else None
+    except (ValueError, TypeError, AttributeError):
+        pass
+    return None
+
+def horario_de(frecuencia_tipo, frecuencia_valor):
+    return parsear_horario(frecuencia_tipo, _clave_frecuencia(frecuencia_valor))
+
+def tomas_del_dia(horario, dia, fecha_inicio=None, fecha_fin=None):
+    """Momentos programados para un día, respetando las fechas de inicio y fin del tratamiento."""
+    if horario is None or (fecha_inicio and dia < fecha_inicio) or (fecha_fin and dia > fecha_fin):
+        return []
+    if horario.intervalo is not None:
+        ancla = datetime.combine(fecha_inicio or dia, HORA_PRIMERA_TOMA)
+        comienzo, fin = datetime.combine(dia, time(0)), datetime.combine(dia + timedelta(days=1), time(0))
+        saltos = max(0, -(-(comienzo - ancla) // horario.intervalo))
+        momento, tomas = ancla + saltos * horario.intervalo, []
+        while momento < fin:
+            tomas.append(momento)
+            momento += horario.intervalo
+        return tomas
+    if horario.dias is not None and dia.weekday() not in horario.dias:
+        return []
+    return [datetime.combine(dia, h) for h in horario.horarios]
+
+def proxima_toma(horario, ahora, fecha_inicio=None, fecha_fin=None):
+    """
+    Próximo momento en que corresponde una toma, con la misma grilla que tomas_del_dia.
+    Una toma atrasada no corre las siguientes: queda contada como omitida.
+    """
+    if horario is None:
+        return None
+    dia = max(ahora.date(), fecha_inicio) if fecha_inicio else ahora.date()
+    for _ in range(8):
+        for momento in tomas_del_dia(horario, dia, fecha_inicio, fecha_fin):
+            if momento > ahora:
+                return momento
+        dia += timedelta(days=1)
+    return None
+
+def _fecha_o_none(valor):
+    if valor is None or pd.isna(valor):
+        return None
+    return valor.date() if isinstance(valor, datetime) else valor
+
+def calcular_agenda_dosis(medicamentos, ahora=None):
+    """
+    Calcula para todos los medicamentos de un paciente, de una vez:
+    - proxima_toma: próximo horario que corresponde
+    - dosis_hoy: tomas programadas para hoy
+    - dosis_pendientes_hoy: las que quedan por tomar hoy
+    - dosis_omitidas: las que ya pasaron hoy y no se registraron
+    Usa tomas_hoy si viene (get_medicamentos con con_tomas=True).
+    Devuelve una copia del DataFrame con esas columnas agregadas.
+    """
+    ahora = ahora or datetime.now()
+    df = medicamentos.copy()
+    n = len(df)
+    columna = lambda nombre, defecto=None: df[nombre] if nombre in df else [defecto] * n
+
+    proximas, hoy_total, pendientes, omitidas = [], [], [], []
+    for tipo, valor, inicio, fin, tomado, cantidad in zip(
+            columna("frecuencia_tipo"), columna("frecuencia_valor"), columna("fecha_inicio"), columna("fecha_fin"),
+            columna("tomas_hoy", 0), columna("dosis_cantidad", 1)):
+        horario = horario_de(tipo, valor)
+        inicio, fin = _fecha_o_none(inicio), _fecha_o_none(fin)
+        tomas_hoy = tomas_del_dia(horario, ahora.date(), inicio, fin)
+        vencidas = sum(1 for momento in tomas_hoy if momento <= ahora)
+        cantidad = cantidad if cantidad and not pd.isna(cantidad) and cantidad > 0 else 1
+        registradas = int((tomado or 0) // cantidad)
+
+        proximas.append(proxima_toma(horario, ahora, inicio, fin))
+        hoy_total.append(len(tomas_hoy))
+        pendientes.append(max(len(tomas_hoy) - registradas, 0))
+        omitidas.append(max(vencidas - registradas, 0))
+
+    df["proxima_toma"] = proximas
+    df["dosis_hoy"] = hoy_total
+    df["dosis_pendientes_hoy"] = pendientes
+    df["dosis_omitidas"] = omitidas
+    return df
+
+
+# ------------------------
+# 🗓️ Franjas horarias por día de la semana
+# ------------------------
+# frecuencia_valor es JSONB. Un trigger lo expande en horarios_medicamentos: una fila por
+# medicamento, día de la semana (0 = lunes) y hora, con índice por (dia_semana, hora), así
+# "qué toca el lunes entre 08:00 y 08:30" es una sola consulta indexada para toda la clínica.
+# Los intervalos que no dividen 24 horas (cada 5, 36, 48 horas...) no se repiten por semana:
+# quedan en intervalos_medicamentos y su próxima toma se calcula en la consulta.
+# La conversión de la columna y las tablas las crea migrar_horarios_medicamentos desde el
+# mantenimiento diario (fMantenimiento.py): toma locks exclusivos sobre medicamentos y no corre desde las páginas.
+_esquema_horarios_listo = False
+
+def asegurar_esquema_horarios(conn=None):
+    """Verifica (una vez por proceso) que migrar_horarios_medicamentos ya corrió. No cambia el esquema."""
+    global _esquema_horarios_listo
+    if _esquema_horarios_listo:
+        return
+    resultado = execute_query("SELECT to_regclass('horarios_medicamentos') IS NOT NULL AS lista",
+                              conn=conn, is_select=True)
+    if resultado is None or resultado.empty or not resultado.iloc[0]["lista"]:
+        raise RuntimeError("Faltan las franjas horarias de los medicamentos: hay que correr el mantenimiento diario "
+                           "(fMantenimiento.py), que ejecuta migrar_horarios_medicamentos")
+    _esquema_horarios_listo = True
+
+def _frecuencias_no_convertibles(cur):
+    """Ids de medicamentos cuyo frecuencia_valor (texto) no se puede convertir a JSONB, o [] si ya es JSONB."""
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'medicamentos' AND column_name = 'frecuencia_valor'
+    """)
+    if cur.fetchone()[0] == "jsonb":
+        return []
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION pg_temp.es_jsonb(texto TEXT) RETURNS BOOLEAN AS $$
+        BEGIN
+            PERFORM texto::jsonb;
+            RETURN TRUE;
+        EXCEPTION WHEN invalid_text_representation OR untranslatable_character THEN
+            RETURN FALSE;
+        END
+        $$ LANGUAGE plpgsql;
+        SELECT id_medicamento FROM medicamentos
+        WHERE NULLIF(frecuencia_valor::text, '') IS NOT NULL AND NOT pg_temp.es_jsonb(frecuencia_valor::text)
+        ORDER BY id_medicamento;
+    """)
+    return [fila[0] for fila in cur.fetchall()]
+
+def migrar_horarios_medicamentos(conn=None):
+    """
+    Convierte frecuencia_valor a JSONB, crea horarios_medicamentos e intervalos_medicamentos
+    (expandiendo los medicamentos que ya existían) y el trigger que los mantiene al día.
+    Si algún frecuencia_valor no es JSON válido no cambia nada y devuelve esos ids para
+    corregirlos a mano; si no, devuelve []. None si la migración falló.
+    Pensado para el mantenimiento diario (fMantenimiento.py); con todo migrado solo reemplaza las funciones.
+    """
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    dias = ", ".join(f"'{dia}'" for dia in sorted(DIAS_SEMANA_INDICE, key=DIAS_SEMANA_INDICE.get))
+    primera = HORA_PRIMERA_TOMA.strftime("%H:%M")
+    query = f"""
+        DO $$
+        DECLARE
+            disparador RECORD;
+            definiciones TEXT[] := '{{}}';
+            definicion TEXT;
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'medicamentos'
+                  AND column_name = 'frecuencia_valor') <> 'jsonb' THEN
+                -- Los triggers que nombran la columna (UPDATE OF ...) impiden cambiarle el tipo:
+                -- se quitan y se vuelven a crear igual
+                FOR disparador IN SELECT tgname, pg_get_triggerdef(oid) AS definicion FROM pg_trigger
+                                  WHERE tgrelid = 'medicamentos'::regclass AND NOT tgisinternal LOOP
+                    definiciones := definiciones || disparador.definicion;
+                    EXECUTE format('DROP TRIGGER %I ON medicamentos', disparador.tgname);
+                END LOOP;
+                ALTER TABLE medicamentos ALTER COLUMN frecuencia_valor TYPE JSONB
+                    USING NULLIF(frecuencia_valor::text, '')::jsonb;
+                FOREACH definicion IN ARRAY definiciones LOOP
+                    EXECUTE definicion;
+                END LOOP;
+            END IF;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION expandir_horario(tipo TEXT, valor JSONB)
+        RETURNS TABLE (dia_semana SMALLINT, hora TIME) AS $$
+        DECLARE
+            dias TEXT[] := ARRAY[{dias}];
+            horas NUMERIC;
+        BEGIN
+            IF jsonb_typeof(valor) IS DISTINCT FROM 'object' THEN
+                RETURN;
+            END IF;
+            IF tipo = 'En horarios específicos del día' AND jsonb_typeof(valor->'horarios_dia') = 'array' THEN
+                RETURN QUERY
+                    SELECT DISTINCT d::smallint, h::time
+                    FROM generate_series(0, 6) d, jsonb_array_elements_text(valor->'horarios_dia') h;
+            ELSIF tipo = 'En días específicos de la semana' AND jsonb_typeof(valor->'dias_semana') = 'array' THEN
+                RETURN QUERY
+                    SELECT DISTINCT (array_position(dias, d) - 1)::smallint, h::time
+                    FROM jsonb_array_elements_text(valor->'dias_semana') d,
+                         unnest(COALESCE(NULLIF(ARRAY(
+                             SELECT jsonb_array_elements_text(valor->'horarios_en_dias')
+                             WHERE jsonb_typeof(valor->'horarios_en_dias') = 'array'), '{{}}'),
+                             ARRAY['{primera}'])) h
+                    WHERE array_position(dias, d) IS NOT NULL;
+            ELSIF tipo = 'Cada ''X'' horas' THEN
+                horas := (valor->>'intervalo_horas')::numeric;
+                IF horas > 0 AND mod(24, horas) = 0 THEN
+                    RETURN QUERY
+                        SELECT d::smallint, (time '{primera}' + k * horas * interval '1 hour')::time
+                        FROM generate_series(0, 6) d, generate_series(0, (24 / horas)::int - 1) k;
+                END IF;
+            END IF;
+        EXCEPTION WHEN invalid_text_representation OR invalid_datetime_format OR datetime_field_overflow THEN
+            RETURN;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE;
+
+        CREATE OR REPLACE FUNCTION intervalo_irregular(tipo TEXT, valor JSONB) RETURNS INTERVAL AS $$
+        DECLARE
+            horas NUMERIC;
+        BEGIN
+            IF tipo IS DISTINCT FROM 'Cada ''X'' horas' OR jsonb_typeof(valor) IS DISTINCT FROM 'object' THEN
+                RETURN NULL;
+            END IF;
+            horas := (valor->>'intervalo_horas')::numeric;
+            RETURN CASE WHEN horas > 0 AND mod(24, horas) <> 0 THEN horas * interval '1 hour' END;
+        EXCEPTION WHEN invalid_text_representation THEN
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql IMMUTABLE;
+
+        DO $$
+        BEGIN
+            IF to_regclass('horarios_medicamentos') IS NULL THEN
+                CREATE TABLE horarios_medicamentos (
+                    id_medicamento INTEGER NOT NULL REFERENCES medicamentos (id_medicamento) ON DELETE CASCADE,
+                    dia_semana SMALLINT NOT NULL CHECK (dia_semana BETWEEN 0 AND 6),
+                    hora TIME NOT NULL,
+                    PRIMARY KEY (id_medicamento, dia_semana, hora)
+                );
+                CREATE INDEX horarios_medicamentos_dia_hora_idx
+                    ON horarios_medicamentos (dia_semana, hora) INCLUDE (id_medicamento);
+                CREATE TABLE intervalos_medicamentos (
+                    id_medicamento INTEGER PRIMARY KEY REFERENCES medicamentos (id_medicamento) ON DELETE CASCADE,
+                    intervalo INTERVAL NOT NULL
+                );
+                -- Primera vez: se expanden los medicamentos que ya existían
+                INSERT INTO horarios_medicamentos (id_medicamento, dia_semana, hora)
+                    SELECT m.id_medicamento, e.dia_semana, e.hora
+                    FROM medicamentos m, expandir_horario(m.frecuencia_tipo, m.frecuencia_valor) e;
+                INSERT INTO intervalos_medicamentos (id_medicamento, intervalo)
+                    SELECT id_medicamento, intervalo_irregular(frecuencia_tipo, frecuencia_valor)
+                    FROM medicamentos
+                    WHERE intervalo_irregular(frecuencia_tipo, frecuencia_valor) IS NOT NULL;
+            END IF;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION sincronizar_horario_medicamento() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM horarios_medicamentos WHERE id_medicamento = NEW.id_medicamento;
+            DELETE FROM intervalos_medicamentos WHERE id_medicamento = NEW.id_medicamento;
+            INSERT INTO horarios_medicamentos (id_medicamento, dia_semana, hora)
+                SELECT NEW.id_medicamento, e.dia_semana, e.hora
+                FROM expandir_horario(NEW.frecuencia_tipo, NEW.frecuencia_valor) e;
+            INSERT INTO intervalos_medicamentos (id_medicamento, intervalo)
+                SELECT NEW.id_medicamento, i
+                FROM intervalo_irregular(NEW.frecuencia_tipo, NEW.frecuencia_valor) i
+                WHERE i IS NOT NULL;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                           WHERE tgrelid = 'medicamentos'::regclass AND tgname = 'medicamentos_horarios') THEN
+                CREATE TRIGGER medicamentos_horarios
+                    AFTER INSERT OR UPDATE OF frecuencia_tipo, frecuencia_valor ON medicamentos
+                    FOR EACH ROW EXECUTE FUNCTION sincronizar_horario_medicamento();
+            END IF;
+        END
+        $$;
+    """
+    try:
+        with conn.cursor() as cur:
+            invalidos = _frecuencias_no_convertibles(cur)
+            if not invalidos:
+                cur.execute(query)
+        conn.commit()
+        return invalidos
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al migrar los horarios de medicamentos: {e}")
+        return None
+    finally:
+        if cerrar:
+            conn.close()
+
+_ACTIVO_EL_DIA = """
+    (m.fecha_inicio IS NULL OR m.fecha_inicio <= %(dia)s)
+    AND (m.fecha_fin IS NULL OR m.fecha_fin >= %(dia)s)
+    AND (m.oculto IS NULL OR m.oculto = FALSE)
+"""
+
+def get_tomas_programadas(dia, desde, hasta=None, conn=None):
+    """
+    Tomas programadas de toda la población el `dia` entre las horas `desde` (incluida) y
+    `hasta` (excluida; None = hasta la medianoche). Devuelve un DataFrame con id_medicamento,
+    id_paciente, nombre, droga y momento, ordenado por momento.
+    """
+    asegurar_esquema_horarios(conn)
+    query = f"""
+        SELECT m.id_medicamento, m.id_paciente, m.nombre, m.droga, %(dia)s + h.hora AS momento
+        FROM horarios_medicamentos h
+        JOIN medicamentos m ON m.id_medicamento = h.id_medicamento
+        WHERE h.dia_semana = %(dia_semana)s AND h.hora >= %(desde)s::time AND h.hora < %(hasta)s::time
+          AND {_ACTIVO_EL_DIA}
+          -- "Cada X horas" arranca a la hora de la primera toma el día de inicio
+          AND (m.frecuencia_tipo <> 'Cada ''X'' horas' OR h.hora >= %(primera)s::time OR m.fecha_inicio < %(dia)s)
+        UNION ALL
+        SELECT m.id_medicamento, m.id_paciente, m.nombre, m.droga, t.momento
+        FROM intervalos_medicamentos i
+        JOIN medicamentos m ON m.id_medicamento = i.id_medicamento
+        CROSS JOIN LATERAL (SELECT COALESCE(m.fecha_inicio, %(dia)s) + %(primera)s::time AS ancla) a
+        CROSS JOIN LATERAL generate_series(
+            a.ancla + i.intervalo * GREATEST(0, CEIL(
+                EXTRACT(EPOCH FROM (%(dia)s + %(desde)s::time) - a.ancla) / EXTRACT(EPOCH FROM i.intervalo))),
+            %(dia)s + %(hasta)s::time - interval '1 microsecond',
+            i.intervalo
+        ) AS t (momento)
+        WHERE {_ACTIVO_EL_DIA}
+        ORDER BY momento, id_medicamento
+    """
+    params = {"dia": dia, "dia_semana": dia.weekday(), "desde": desde, "hasta": hasta or "24:00",
+              "primera": HORA_PRIMERA_TOMA}
+    return execute_query(query, params=params, conn=conn, is_select=True)
+
+
+# ------------------------
+# 📈 Adherencia (rollups incrementales)
+# ------------------------
+# adherencia_diaria: una fila por medicamento y día con las dosis programadas y las tomadas.
+# adherencia_clinica_diaria: los mismos totales para toda la clínica, una fila por día
+# (tomadas cuenta solo las tomas dentro de lo programado, para no compensar días con faltas).
+# Las tomas se suman al registrarlas (registrar_toma); los días sin tomas los completa cerrar_adherencia.
+LOTE_ADHERENCIA = 5000
+_esquema_adherencia_listo = False
+_adherencia_cerrada_hasta = None
+
+def asegurar_esquema_adherencia(conn=None):
+    global _esquema_adherencia_listo
+    if _esquema_adherencia_listo:
+        return
+    query = """
+        CREATE TABLE IF NOT EXISTS adherencia_diaria (
+            id_medicamento INTEGER NOT NULL,
+            dia DATE NOT NULL,
+            id_paciente INTEGER NOT NULL,
+            programadas INTEGER NOT NULL DEFAULT 0,
+            tomadas INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id_medicamento, dia)
+        );
+        CREATE INDEX IF NOT EXISTS adherencia_diaria_paciente_dia_idx
+            ON adherencia_diaria (id_paciente, dia);
+        CREATE INDEX IF NOT EXISTS adherencia_diaria_dia_idx
+            ON adherencia_diaria (dia);
+        CREATE TABLE IF NOT EXISTS adherencia_clinica_diaria (
+            dia DATE PRIMARY KEY,
+            programadas INTEGER NOT NULL DEFAULT 0,
+            tomadas INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS adherencia_estado (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            cerrado_hasta DATE
+        );
+        INSERT INTO adherencia_estado (id) VALUES (TRUE) ON CONFLICT DO NOTHING;
+    """
+    _esquema_adherencia_listo = bool(execute_query(query, conn=conn, is_select=False))
+
+def dosis_programadas(frecuencia_tipo, frecuencia_valor, dia, fecha_inicio=None, fecha_fin=None):
+    """Cantidad de tomas que corresponden a un día según la frecuencia del medicamento."""
+    horario = horario_de(frecuencia_tipo, frecuencia_valor)
+    return len(tomas_del_dia(horario, dia, _fecha_o_none(fecha_inicio), _fecha_o_none(fecha_fin)))
+
+def _dosis_programadas_de(id_medicamento, dia, conn=None):
+    """Dosis programadas de un medicamento para un día, leyendo su frecuencia de la base."""
+    med = execute_query("""
+        SELECT frecuencia_tipo, frecuencia_valor, fecha_inicio, fecha_fin
+        FROM medicamentos WHERE id_medicamento = %s
+    """, params=(int(id_medicamento),), conn=conn, is_select=True)
+    if med.empty:
+        return 0
+    med = med.iloc[0]
+    return dosis_programadas(med["frecuencia_tipo"], med["frecuencia_valor"], dia, med["fecha_inicio"], med["fecha_fin"])
+
+def _filas_adherencia(medicamentos, desde, hasta, tomadas):
+    """Genera (id_medicamento, id_paciente, dia, programadas, tomadas) para cada día activo en [desde, hasta]."""
+    for id_medicamento, id_paciente, tipo, valor, inicio, fin in medicamentos:
+        horario = horario_de(tipo, valor)
+        inicio, fin = _fecha_o_none(inicio), _fecha_o_none(fin)
+        dia = max(desde, inicio) if desde else inicio
+        ultimo = min(hasta, fin) if fin else hasta
+        while dia <= ultimo:
+            programadas = len(tomas_del_dia(horario, dia, inicio, fin))
+            tomado = tomadas.get((id_medicamento, dia), 0)
+            if programadas or tomado:
+                yield (id_medicamento, id_paciente, dia, programadas, tomado)
+            dia += timedelta(days=1)
+
+def cerrar_adherencia(hasta=None, armar_historico=False, conn=None):
+    """
+    Completa los rollups con las dosis programadas de los días todavía no cerrados
+    (por defecto, hasta ayer), incluidos los días sin ninguna toma.
+    La primera vez hay que armar el histórico a partir de tomas_medicamentos, y eso solo
+    lo hace el proceso diario (armar_historico=True): las páginas que leen los rollups
+    no lo disparan. Después solo procesa los días nuevos, así que correrlo varias veces
+    por día no cuesta nada.
+    Devuelve la cantidad de filas diarias agregadas.
+    """
+    global _adherencia_cerrada_hasta
+    hasta = hasta or date.today() - timedelta(days=1)
+    if _adherencia_cerrada_hasta is not None and _adherencia_cerrada_hasta >= hasta:
+        return 0
+    asegurar_esquema_adherencia(conn)
+
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    agregadas = 0
+    try:
+        with conn.cursor() as cur:
+            # El bloqueo evita que dos procesos cierren los mismos días a la vez
+            cur.execute("SELECT cerrado_hasta FROM adherencia_estado FOR UPDATE")
+            cerrado_hasta = cur.fetchone()[0]
+            if cerrado_hasta is None and not armar_historico:
+                conn.commit()
+                return 0
+            if cerrado_hasta is None or cerrado_hasta < hasta:
+                desde = cerrado_hasta + timedelta(days=1) if cerrado_hasta else None
+                cur.execute("""
+                    SELECT id_medicamento, id_paciente, frecuencia_tipo, frecuencia_valor, fecha_inicio, fecha_fin
+                    FROM medicamentos
+                    WHERE fecha_inicio <= %s AND (fecha_fin IS NULL OR %s IS NULL OR fecha_fin >= %s)
+                """, (hasta, desde, desde))
+                medicamentos = cur.fetchall()
+
+                # Solo la primera vez: las tomas anteriores a los rollups salen del log crudo
+                tomadas = {}
+                if cerrado_hasta is None:
+                    cur.execute("""
+                        SELECT id_medicamento, fecha_toma::date, COUNT(*)
+                        FROM tomas_medicamentos
+                        WHERE fecha_toma < %s
+                        GROUP BY 1, 2
+                    """, (hasta + timedelta(days=1),))
+                    tomadas = {(id_medicamento, dia): n for id_medicamento, dia, n in cur.fetchall()}
+
+                insertadas = psycopg2.extras.execute_values(cur, """
+                    WITH nuevas AS (
+                        INSERT INTO adherencia_diaria (id_medicamento, id_paciente, dia, programadas, tomadas)
+                        VALUES %s
+                        ON CONFLICT (id_medicamento, dia) DO NOTHING
+                        RETURNING dia, programadas, LEAST(tomadas, programadas) AS a_termino
+                    ), por_dia AS (
+                        INSERT INTO adherencia_clinica_diaria AS c (dia, programadas, tomadas)
+                        SELECT dia, SUM(programadas), SUM(a_termino) FROM nuevas GROUP BY dia
+                        ON CONFLICT (dia) DO UPDATE
+                        SET programadas = c.programadas + EXCLUDED.programadas, tomadas = c.tomadas + EXCLUDED.tomadas
+                    )
+                    SELECT COUNT(*) FROM nuevas
+                """, _filas_adherencia(medicamentos, desde, hasta, tomadas), page_size=LOTE_ADHERENCIA, fetch=True)
+                agregadas = sum(n for (n,) in insertadas)
+                cur.execute("UPDATE adherencia_estado SET cerrado_hasta = %s", (hasta,))
+                cerrado_hasta = hasta
+        conn.commit()
+        _adherencia_cerrada_hasta = cerrado_hasta
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al cerrar la adherencia: {e}")
+    finally:
+        if cerrar:
+            conn.close()
+    return agregadas
+
+# Días hacia atrás para medir el ritmo de consumo real (ver pronosticar_agotamiento)
+DIAS_CONSUMO_RECIENTE = 14
+
+_PERIODOS_ADHERENCIA = {"dia": "{col}", "semana": "date_trunc('week', {col})::date", "mes": "date_trunc('month', {col})::date"}
+
+def get_adherencia_paciente(dni, meses=12, por="semana", conn=None):
+    """
+    Adherencia de un paciente por medicamento y por día, semana o mes de los últimos
+    `meses`, leída del rollup diario (no del log de tomas).
+    Columnas: id_medicamento, nombre, periodo, programadas, tomadas, adherencia (%).
+    """
+    if por not in _PERIODOS_ADHERENCIA:
+        raise ValueError(f"Período no soportado: {por}")
+    id_paciente = get_id_paciente_por_dni(dni, conn)
+    if not id_paciente:
+        return pd.DataFrame()
+    cerrar_adherencia(conn=conn)
+    periodo = _PERIODOS_ADHERENCIA[por].format(col="a.dia")
+    query = f"""
+        SELECT a.id_medicamento, m.nombre, {periodo} AS periodo,
+               SUM(a.programadas) AS programadas, SUM(a.tomadas) AS tomadas,
+               ROUND(100.0 * SUM(LEAST(a.tomadas, a.programadas)) / NULLIF(SUM(a.programadas), 0), 1) AS adherencia
+        FROM adherencia_diaria a
+        JOIN medicamentos m ON m.id_medicamento = a.id_medicamento
+        WHERE a.id_paciente = %s AND a.dia >= %s
+        GROUP BY a.id_medicamento, m.nombre, periodo
+        ORDER BY periodo, m.nombre
+    """
+    desde = (pd.Timestamp(date.today()) - pd.DateOffset(months=meses)).date()
+    return execute_query(query, params=(int(id_paciente), desde), conn=conn, is_select=True)
+
+def get_adherencia_clinica(desde=None, hasta=None, por="semana", conn=None):
+    """
+    Adherencia de toda la clínica por día, semana o mes entre `desde` y `hasta`
+    (por defecto, el último año), leída del rollup de la clínica: una fila por día.
+    """
+    if por not in _PERIODOS_ADHERENCIA:
+        raise ValueError(f"Período no soportado: {por}")
+    cerrar_adherencia(conn=conn)
+    hasta = hasta or date.today()
+    desde = desde or hasta - timedelta(days=365)
+    periodo = _PERIODOS_ADHERENCIA[por].format(col="dia")
+    query = f"""
+        SELECT {periodo} AS periodo, SUM(programadas) AS programadas, SUM(tomadas) AS tomadas,
+               ROUND(100.0 * SUM(tomadas) / NULLIF(SUM(programadas), 0), 1) AS adherencia
+        FROM adherencia_clinica_diaria
+        WHERE dia BETWEEN %s AND %s
+        GROUP BY periodo
+        ORDER BY periodo
+    """
+    return execute_query(query, params=(desde, hasta), conn=conn, is_select=True)
+
+
+@st.cache_data(show_spinner=False)
+def obtener_mapa_tomas(dni, hasta, dias=365):
+    """
+    Tomas registradas y programadas por medicamento y día de los últimos `dias` días
+    hasta `hasta`: {id_medicamento: {"nombre": ..., "dias": {fecha: (tomadas, programadas)}}}.
+    Sale del rollup diario en una sola consulta por paciente (no una por medicamento).
+    Queda en caché por (dni, hasta): cambia de clave al cambiar el día, y registrar
+    una toma la invalida con invalidar_mapa_tomas.
+    """
+    cerrar_adherencia()
+    query = """
+        SELECT a.id_medicamento, m.nombre, a.dia, a.tomadas, a.programadas
+        FROM adherencia_diaria a
+        JOIN pacientes p ON p.id_paciente = a.id_paciente
+        JOIN medicamentos m ON m.id_medicamento = a.id_medicamento
+        WHERE p.dni = %s AND a.dia > %s AND a.dia <= %s
+        ORDER BY m.nombre, a.dia
+    """
+    filas = execute_query(query, params=(dni, hasta - timedelta(days=dias), hasta), is_select=True)
+    mapa = {}
+    for id_medicamento, nombre, dia, tomadas, programadas in filas.itertuples(index=False):
+        medicamento = mapa.setdefault(int(id_medicamento), {"nombre": nombre, "dias": {}})
+        medicamento["dias"][dia] = (int(tomadas), int(programadas))
+    return mapa
+
+def invalidar_mapa_tomas(dni):
+    """Descarta el mapa de tomas cacheado del paciente (después de registrar una toma)."""
+    obtener_mapa_tomas.clear(dni, date.today())
+
+# ------------------------
+# 📦 Pronóstico de stock
+# ------------------------
+# Avisar cuando el stock alcanza para esta cantidad de días o menos
+DIAS_AVISO_REPOSICION = 7
+
+def tomas_por_dia(horario):
+    """Promedio de tomas por día de un HorarioDosis (los horarios semanales se reparten en 7 días)."""
+    if horario is None:
+        return 0.0
+    if horario.intervalo is not None:
+        return timedelta(days=1) / horario.intervalo
+    dias = 7 if horario.dias is None else len(horario.dias)
+    return len(horario.horarios) * dias / 7
+
+def pronosticar_agotamiento(medicamentos, hoy=None):
+    """
+    Proyecta cuándo se termina el stock de cada medicamento, todos juntos:
+    consumo_diario = tomas por día según la frecuencia × dosis_cantidad × ritmo_reciente
+    (si el paciente viene tomando menos o más de lo indicado, el consumo se ajusta;
+    sin historial se asume lo indicado).
+    Agrega consumo_diario, dias_restantes, fecha_agotamiento y requiere_reposicion
+    (False si el tratamiento termina antes de quedarse sin stock o no hay stock cargado).
+    """
+    hoy = hoy or date.today()
+    df = medicamentos.copy()
+    if df.empty:
+        for columna in ("consumo_diario", "dias_restantes", "fecha_agotamiento", "requiere_reposicion"):
+            df[columna] = pd.Series(dtype=object)
+        return df
+
+    # El parseo de la frecuencia está cacheado; el resto del cálculo es por columnas
+    tomas = pd.Series([tomas_por_dia(horario_de(tipo, valor))
+                       for tipo, valor in zip(df["frecuencia_tipo"], df["frecuencia_valor"])], index=df.index)
+    cantidad = pd.to_numeric(df["dosis_cantidad"], errors="coerce")
+    cantidad = cantidad.where(cantidad > 0, 1)
+    ritmo = pd.to_numeric(df["ritmo_reciente"], errors="coerce") if "ritmo_reciente" in df else pd.Series(float("nan"), index=df.index)
+    ritmo = ritmo.where(ritmo > 0, 1.0)
+    stock = pd.to_numeric(df["stock_actual"], errors="coerce")
+
+    consumo = tomas * cantidad * ritmo
+    dias = stock // consumo.where(consumo > 0)
+    fecha = pd.Timestamp(hoy) + pd.to_timedelta(dias, unit="D")
+    fin = pd.to_datetime(df["fecha_fin"], errors="coerce")
+
+    df["consumo_diario"] = consumo.round(2)
+    df["dias_restantes"] = dias
+    df["fecha_agotamiento"] = fecha.dt.date.where(fecha.notna(), None)
+    df["requiere_reposicion"] = fecha.notna() & ~(fin.notna() & (fin < fecha))
+    return df
+
+def get_medicamentos_por_agotarse(dias=DIAS_AVISO_REPOSICION, conn=None):
+    """
+    Medicamentos activos de toda la clínica cuyo stock se termina dentro de `dias` días
+    (y antes de que finalice el tratamiento), ordenados por fecha de agotamiento.
+    El filtro se hace en la base: las tomas por día salen de las franjas de
+    horarios_medicamentos e intervalos_medicamentos, con la misma cuenta que
+    pronosticar_agotamiento, así que solo viajan los medicamentos por agotarse.
+    """
+    asegurar_esquema_adherencia(conn)
+    asegurar_esquema_horarios(conn)
+    query = """
+        WITH consumo AS (
+            SELECT m.id_medicamento, m.id_paciente, p.nombre AS nombre_paciente, m.nombre, m.droga,
+                   m.stock_actual, m.dosis_cantidad, m.frecuencia_tipo, m.frecuencia_valor, m.fecha_fin,
+                   r.ritmo_reciente,
+                   (COALESCE(h.franjas, 0) / 7.0 + COALESCE(86400 / EXTRACT(EPOCH FROM i.intervalo), 0))
+                       * CASE WHEN m.dosis_cantidad > 0 THEN m.dosis_cantidad ELSE 1 END
+                       * CASE WHEN r.ritmo_reciente > 0 THEN r.ritmo_reciente ELSE 1 END AS consumo_diario
+            FROM medicamentos m
+            JOIN pacientes p ON m.id_paciente = p.id_paciente
+            LEFT JOIN LATERAL (
+                SELECT COUNT(*) AS franjas FROM horarios_medicamentos WHERE id_medicamento = m.id_medicamento
+            ) h ON TRUE
+            LEFT JOIN intervalos_medicamentos i ON i.id_medicamento = m.id_medicamento
+            LEFT JOIN (
+                SELECT id_medicamento, SUM(tomadas)::float / NULLIF(SUM(programadas), 0) AS ritmo_reciente
+                FROM adherencia_diaria
+                -- Días completos: hoy todavía no terminó y bajaría el ritmo
+                WHERE dia >= CURRENT_DATE - %(dias_ritmo)s AND dia < CURRENT_DATE
+                GROUP BY id_medicamento
+            ) r ON r.id_medicamento = m.id_medicamento
+            WHERE m.stock_actual IS NOT NULL
+              AND (m.fecha_fin IS NULL OR m.fecha_fin > CURRENT_DATE)
+              AND (m.oculto IS NULL OR m.oculto = FALSE)
+        )
+        SELECT id_medicamento, id_paciente, nombre_paciente, nombre, droga, stock_actual, dosis_cantidad,
+               frecuencia_tipo, frecuencia_valor, fecha_fin, ritmo_reciente
+        FROM consumo
+        WHERE consumo_diario > 0
+          AND FLOOR(stock_actual / consumo_diario) <= %(dias)s
+          AND (fecha_fin IS NULL OR fecha_fin >= CURRENT_DATE + FLOOR(stock_actual / consumo_diario)::int)
+    """
+    params = {"dias_ritmo": DIAS_CONSUMO_RECIENTE, "dias": dias}
+    pronostico = pronosticar_agotamiento(execute_query(query, params=params, conn=conn, is_select=True))
+    if pronostico.empty:
+        return pronostico
+    por_agotarse = pronostico[pronostico["requiere_reposicion"] & (pronostico["dias_restantes"] <= dias)]
+    return por_agotarse.sort_values(["fecha_agotamiento", "nombre_paciente"]).reset_index(drop=True)
+
+
+# ------------------------
+# ⚠️ Interacciones entre drogas
+# ------------------------
+DIRECTORIO_DATOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datos")
+ARCHIVO_DROGAS = os.path.join(DIRECTORIO_DATOS, "drogas.csv")
+ARCHIVO_INTERACCIONES = os.path.join(DIRECTORIO_DATOS, "interacciones.csv")
+SEVERIDADES = {"contraindicada": 3, "mayor": 2, "moderada": 1}
+
+Interaccion = namedtuple("Interaccion", ["droga", "otra", "severidad", "descripcion"])
+
+def normalizar_droga(nombre):
+    """Minúsculas, sin tildes y con espacios simples, para comparar nombres de drogas."""
+    if not isinstance(nombre, str):
+        return ""
+    sin_tildes = unicodedata.normalize("NFKD", nombre).encode("ascii", "ignore").decode("ascii")
+    return " ".join(sin_tildes.lower().split())
+
+class IndiceInteracciones:
+    """
+    Índice precalculado de interacciones: cada nombre o alias normalizado apunta a un id
+    canónico, y los pares que interactúan se guardan en un dict con clave (id_a, id_b) ordenada.
+    Verificar una droga nueva contra k drogas activas son k búsquedas en el dict.
+    """
+    def __init__(self):
+        self._canonica = {}
+        self._pares = {}
+
+    def agregar_droga(self, id_droga, *nombres):
+        for nombre in (id_droga,) + nombres:
+            clave = normalizar_droga(nombre)
+            if clave:
+                self._canonica[clave] = id_droga
+
+    def agregar_interaccion(self, droga_a, droga_b, severidad, descripcion):
+        self._pares[tuple(sorted((droga_a, droga_b)))] = (severidad, descripcion)
+
+    def canonica(self, nombre):
+        """Id canónico de la droga; si no está en el catálogo, su nombre normalizado."""
+        clave = normalizar_droga(nombre)
+        return self._canonica.get(clave, clave)
+
+    def conoce(self, nombre):
+        """True si el nombre (o alias) es una droga de la tabla de drogas."""
+        return normalizar_droga(nombre) in self._canonica
+
+    def interaccion(self, droga_a, droga_b):
+        a, b = self.canonica(droga_a), self.canonica(droga_b)
+        return self._pares.get((a, b) if a <= b else (b, a)) if a and b and a != b else None
+
+    def verificar(self, droga, activas):
+        """Interacciones de `droga` con cada una de las drogas `activas`, de la más grave a la más leve."""
+        encontradas = []
+        for otra in activas:
+            hallada = self.interaccion(droga, otra)
+            if hallada:
+                encontradas.append(Interaccion(droga, otra, *hallada))
+        return sorted(encontradas, key=lambda i: -SEVERIDADES.get(i.severidad, 0))
+
+    def __len__(self):
+        return len(self._pares)
+
+@lru_cache(maxsize=1)
+def obtener_indice_interacciones(archivo_drogas=ARCHIVO_DROGAS, archivo_interacciones=ARCHIVO_INTERACCIONES):
+    """Carga el catálogo de drogas y las interacciones (datos locales, sin conexión) una vez por proceso."""
+    indice = IndiceInteracciones()
+    drogas = pd.read_csv(archivo_drogas, dtype=str, keep_default_na=False)
+    for id_droga, nombre, alias in drogas[["id", "nombre", "alias"]].itertuples(index=False):
+        indice.agregar_droga(id_droga, nombre, *[a for a in alias.split("|") if a])
+    interacciones = pd.read_csv(archivo_interacciones, dtype=str, keep_default_na=False)
+    for droga_a, droga_b, severidad, descripcion in interacciones[["droga_a", "droga_b", "severidad", "descripcion"]].itertuples(index=False):
+        indice.agregar_interaccion(droga_a, droga_b, severidad, descripcion)
+    return indice
+
+def verificar_interacciones(dni, droga, conn=None):
+    """Interacciones de una droga nueva con los medicamentos activos del paciente."""
+    actuales = get_medicamentos(dni, solo_actuales=True, conn=conn)
+    if actuales.empty:
+        return []
+    return obtener_indice_interacciones().verificar(droga, actuales["droga"].dropna())
+
+def auditar_interacciones(conn=None):
+    """
+    Revisa los medicamentos activos de todos los pacientes y devuelve un DataFrame
+    con cada par que interactúa: id_paciente, nombre_paciente, droga_a, droga_b,
+    severidad y descripcion. Es una sola consulta, ordenada por paciente.
+    """
+    query = """
+        SELECT m.id_paciente, p.nombre AS nombre_paciente, m.droga
+        FROM medicamentos m
+        JOIN pacientes p ON m.id_paciente = p.id_paciente
+        WHERE (m.fecha_fin IS NULL OR m.fecha_fin > CURRENT_DATE)
+          AND (m.oculto IS NULL OR m.oculto = FALSE)
+          AND m.droga IS NOT NULL
+        ORDER BY m.id_paciente
+    """
+    activos = execute_query(query, conn=conn, is_select=True)
+    columnas = ["id_paciente", "nombre_paciente", "droga_a", "droga_b", "severidad", "descripcion"]
+    if activos.empty:
+        return pd.DataFrame(columns=columnas)
+
+    indice = obtener_indice_interacciones()
+    filas = []
+    for (id_paciente, nombre_paciente), grupo in activos.groupby(["id_paciente", "nombre_paciente"], sort=False):
+        drogas = list(grupo["droga"])
+        for i, droga in enumerate(drogas):
+            for hallada in indice.verificar(droga, drogas[i + 1:]):
+                filas.append((id_paciente, nombre_paciente, hallada.droga, hallada.otra, hallada.severidad, hallada.descripcion))
+    auditoria = pd.DataFrame(filas, columns=columnas)
+    orden = auditoria["severidad"].map(SEVERIDADES).fillna(0)
+    return auditoria.assign(_orden=-orden).sort_values(["_orden", "id_paciente"]).drop(columns="_orden").reset_index(drop=True)
+
+
+# ------------------------
+# 🚨 Alergias a principios activos
+# ------------------------
+ARCHIVO_ALERGIAS = os.path.join(DIRECTORIO_DATOS, "alergias.csv")
+
+class AlergiaMedicamento(ValueError):
+    """La droga que se quiere guardar está en el conjunto de alergias del paciente."""
+    def __init__(self, droga, alergias):
+        super().__init__(f"El paciente es alérgico a {', '.join(alergias)} ({droga})")
+        self.droga = droga
+        self.alergias = alergias
+
+class IndiceAlergias:
+    """
+    Índice de alergias: cada alergia (o grupo, como "aines" o "penicilina") normalizada apunta
+    al frozenset de ids canónicos de drogas que la disparan. Una alergia que no está en la tabla
+    se toma como alergia a la droga de ese nombre. Verificar una droga contra las alergias de un
+    paciente es armar su conjunto una vez y hacer una búsqueda por alergia.
+    """
+    def __init__(self, interacciones):
+        self._interacciones = interacciones
+        self._grupos = {}
+
+    def agregar_alergia(self, alergia, drogas, *nombres):
+        drogas = frozenset(self._interacciones.canonica(d) for d in drogas)
+        for nombre in (alergia,) + nombres:
+            clave = normalizar_droga(nombre)
+            if clave:
+                self._grupos[clave] = drogas
+
+    def drogas_de(self, alergia):
+        """Ids canónicos de las drogas que dispara una alergia."""
+        clave = normalizar_droga(alergia)
+        if clave in self._grupos:
+            return self._grupos[clave]
+        canonica = self._interacciones.canonica(clave)
+        return frozenset([canonica]) if canonica else frozenset()
+
+    def conjunto(self, alergias):
+        """{id de droga: [alergias del paciente que la disparan]} para una lista de alergias."""
+        conjunto = {}
+        for alergia in alergias or []:
+            for droga in self.drogas_de(alergia):
+                conjunto.setdefault(droga, []).append(alergia)
+        return conjunto
+
+    def verificar(self, droga, alergias):
+        """Alergias (de la lista `alergias`) que contraindican `droga`; vacía si no hay conflicto."""
+        return self.conjunto(alergias).get(self._interacciones.canonica(droga), [])
+
+    def pares(self, alergias):
+        """DataFrame (alergia, id_droga) con una fila por cada droga que dispara cada alergia."""
+        filas = [(alergia, droga) for alergia in alergias for droga in self.drogas_de(alergia)]
+        return pd.DataFrame(filas, columns=["alergia", "id_droga"])
+
+    def __len__(self):
+        return len(self._grupos)
+
+@lru_cache(maxsize=1)
+def obtener_indice_alergias(archivo=ARCHIVO_ALERGIAS):
+    """Carga la tabla de alergias a principios activos una vez por proceso."""
+    indice = IndiceAlergias(obtener_indice_interacciones())
+    alergias = pd.read_csv(archivo, dtype=str, keep_default_na=False)
+    for alergia, alias, drogas in alergias[["alergia", "alias", "drogas"]].itertuples(index=False):
+        indice.agregar_alergia(alergia, [d for d in drogas.split("|") if d], *[a for a in alias.split("|") if a])
+    return indice
+
+def alergias_paciente(dni, conn=None):
+    """Alergias registradas en el historial médico más reciente del paciente (lista, puede estar vacía)."""
+    query = """
+        SELECT h.alergias
+        FROM historial_medico h
+        JOIN pacientes p ON h.id_paciente = p.id_paciente
+        WHERE p.dni = %s
+        ORDER BY h.fecha_completado DESC NULLS LAST
+        LIMIT 1
+    """
+    result = execute_query(query, params=(dni,), conn=conn, is_select=True)
+    if result is None or result.empty:
+        return []
+    return list(result.iloc[0]["alergias"] or [])
+
+def verificar_alergias(dni, droga, conn=None):
+    """Alergias del paciente que contraindican la droga; vacía si no hay conflicto."""
+    return obtener_indice_alergias().verificar(droga, alergias_paciente(dni, conn))
+
+def auditar_alergias(conn=None):
+    """
+    Busca en toda la población los medicamentos activos cuya droga está en el conjunto de
+    alergias del paciente. Devuelve un DataFrame con id_paciente, nombre_paciente,
+    id_medicamento, medicamento, droga y alergia. La base devuelve una fila por medicamento
+    y alergia (unnest del historial más reciente) y el cruce con la tabla de alergias es un
+    solo merge de pandas.
+    """
+    query = """
+        WITH historial AS (
+            SELECT DISTINCT ON (id_paciente) id_paciente, alergias
+            FROM historial_medico
+            ORDER BY id_paciente, fecha_completado DESC NULLS LAST
+        )
+        SELECT m.id_paciente, p.nombre AS nombre_paciente, m.id_medicamento,
+               m.nombre AS medicamento, m.droga, a.alergia
+        FROM medicamentos m
+        JOIN pacientes p ON m.id_paciente = p.id_paciente
+        JOIN historial h ON h.id_paciente = m.id_paciente
+        CROSS JOIN LATERAL unnest(h.alergias) AS a (alergia)
+        WHERE (m.fecha_fin IS NULL OR m.fecha_fin > CURRENT_DATE)
+          AND (m.oculto IS NULL OR m.oculto = FALSE)
+          AND m.droga IS NOT NULL
+          AND a.alergia IS NOT NULL
+    """
+    cruces = execute_query(query, conn=conn, is_select=True)
+    columnas = ["id_paciente", "nombre_paciente", "id_medicamento", "medicamento", "droga", "alergia"]
+    if cruces is None or cruces.empty:
+        return pd.DataFrame(columns=columnas)
+
+    # Cada nombre distinto se resuelve una sola vez, no una vez por fila
+    indice = obtener_indice_alergias()
+    drogas = cruces["droga"].unique()
+    cruces["id_droga"] = cruces["droga"].map(dict(zip(drogas, map(obtener_indice_interacciones().canonica, drogas))))
+    conflictos = cruces.merge(indice.pares(cruces["alergia"].unique()), on=["alergia", "id_droga"])
+    return conflictos[columnas].sort_values(["id_paciente", "id_medicamento"]).reset_index(drop=True)
+
+
+# ------------------------
+# 🗄️ Log de tomas particionado por mes
+# ------------------------
+# Las particiones se llaman tomas_medicamentos_AAAA_MM. Las más viejas que la retención se
+# resumen por día en tomas_resumen_diario y se descartan (DROP de la partición, sin DELETE).
+RETENCION_TOMAS_MESES = 13
+MESES_PARTICIONES_ADELANTE = 3
+RETENCION_CLAVES_TOMAS_DIAS = 30
+
+def _inicio_mes(dia, desplazamiento=0):
+    meses = dia.year * 12 + dia.month - 1 + desplazamiento
+    return date(meses // 12, meses % 12 + 1, 1)
+
+def _nombre_particion_tomas(mes):
+    return f"tomas_medicamentos_{mes.year:04d}_{mes.month:02d}"
+
+def _tomas_particionada(cur):
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'tomas_medicamentos'::regclass")
+    return cur.fetchone()[0]
+
+def _particion_default_tomas(cur):
+    cur.execute("""
+        SELECT partdefid::regclass::text FROM pg_partitioned_table
+        WHERE partrelid = 'tomas_medicamentos'::regclass AND partdefid <> 0
+    """)
+    fila = cur.fetchone()
+    return fila[0] if fila else None
+
+def _agregar_particion_tomas(cur, mes):
+    """
+    Agrega la partición del mes si falta. Las filas de ese mes que estén en la partición
+    DEFAULT (la tabla original a medio migrar, o tomas con fecha futura) pasan primero a la
+    partición nueva: con esas filas en DEFAULT, ATTACH y CREATE ... PARTITION OF fallan.
+    La partición se arma suelta con un CHECK del rango, así ATTACH no la vuelve a recorrer.
+    Devuelve cuántas filas movió, o None si la partición ya existía.
+    """
+    particion = _nombre_particion_tomas(mes)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (particion,))
+    if cur.fetchone()[0]:
+        return None
+    default = _particion_default_tomas(cur)
+    rango = {"desde": mes, "hasta": _inicio_mes(mes, 1)}
+    cur.execute(f"""
+        CREATE TABLE {particion} (LIKE tomas_medicamentos INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+        ALTER TABLE {particion} ADD CONSTRAINT {particion}_rango
+            CHECK (fecha_toma >= %(desde)s AND fecha_toma < %(hasta)s);
+    """, rango)
+    movidas = 0
+    if default:
+        # Nadie puede escribir en DEFAULT entre mover las filas y adjuntar la partición
+        cur.execute(f"""
+            LOCK TABLE {default} IN SHARE ROW EXCLUSIVE MODE;
+            WITH movidas AS (
+                DELETE FROM {default} WHERE fecha_toma >= %(desde)s AND fecha_toma < %(hasta)s
+                RETURNING *
+            )
+            INSERT INTO {particion} SELECT * FROM movidas;
+        """, rango)
+        movidas = cur.rowcount
+    cur.execute(f"""
+        ALTER TABLE tomas_medicamentos ATTACH PARTITION {particion} FOR VALUES FROM (%(desde)s) TO (%(hasta)s);
+        ALTER TABLE {particion} DROP CONSTRAINT {particion}_rango;
+    """, rango)
+    return movidas
+
+def _convertir_tomas_en_particionada(conn, cur):
+    """
+    Crea tomas_medicamentos particionada y le adjunta la tabla original, renombrada
+    tomas_medicamentos_previa, como partición DEFAULT. No copia filas: el lock exclusivo
+    dura lo que tardan los cambios de catálogo. Las filas pasan después a sus meses.
+    """
+    # Fuera del lock: lo que recorre la tabla entera (fecha no nula, índice de la clave nueva)
+    cur.execute("SELECT COUNT(*) FROM tomas_medicamentos WHERE fecha_toma IS NULL")
+    sin_fecha = cur.fetchone()[0]
+    if sin_fecha:
+        raise ValueError(f"{sin_fecha} tomas no tienen fecha_toma; hay que completarlas antes de particionar")
+    cur.execute("""
+        INSERT INTO claves_tomas (clave)
+            SELECT clave_idempotencia FROM tomas_medicamentos WHERE clave_idempotencia IS NOT NULL
+            ON CONFLICT DO NOTHING;
+        ALTER TABLE tomas_medicamentos DROP CONSTRAINT IF EXISTS tomas_medicamentos_fecha_no_nula;
+        ALTER TABLE tomas_medicamentos ADD CONSTRAINT tomas_medicamentos_fecha_no_nula
+            CHECK (fecha_toma IS NOT NULL) NOT VALID;
+    """)
+    conn.commit()
+    cur.execute("""
+        ALTER TABLE tomas_medicamentos VALIDATE CONSTRAINT tomas_medicamentos_fecha_no_nula;
+        CREATE UNIQUE INDEX IF NOT EXISTS tomas_medicamentos_previa_pkey ON tomas_medicamentos (id_toma, fecha_toma);
+        CREATE INDEX IF NOT EXISTS tomas_medicamentos_previa_fecha_brin_idx
+            ON tomas_medicamentos USING BRIN (fecha_toma);
+    """)
+    conn.commit()
+
+    cur.execute("""
+        LOCK TABLE tomas_medicamentos IN ACCESS EXCLUSIVE MODE;
+        -- Con el CHECK validado, SET NOT NULL no recorre la tabla
+        ALTER TABLE tomas_medicamentos ALTER COLUMN fecha_toma SET NOT NULL;
+        ALTER TABLE tomas_medicamentos DROP CONSTRAINT tomas_medicamentos_fecha_no_nula;
+        ALTER TABLE tomas_medicamentos RENAME TO tomas_medicamentos_previa;
+        ALTER INDEX IF EXISTS tomas_medicamentos_medicamento_fecha_idx
+            RENAME TO tomas_medicamentos_previa_medicamento_fecha_idx;
+        DO $$
+        DECLARE
+            clave_vieja TEXT;
+        BEGIN
+            -- La clave primaria de una tabla particionada tiene que incluir fecha_toma
+            SELECT conname INTO clave_vieja FROM pg_constraint
+            WHERE conrelid = 'tomas_medicamentos_previa'::regclass AND contype = 'p';
+            IF clave_vieja IS NOT NULL THEN
+                EXECUTE format('ALTER TABLE tomas_medicamentos_previa DROP CONSTRAINT %I', clave_vieja);
+            END IF;
+        END $$;
+        CREATE TABLE tomas_medicamentos (
+            LIKE tomas_medicamentos_previa
+            INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING GENERATED INCLUDING CONSTRAINTS,
+            PRIMARY KEY (id_toma, fecha_toma)
+        ) PARTITION BY RANGE (fecha_toma);
+        CREATE INDEX tomas_medicamentos_medicamento_fecha_idx ON tomas_medicamentos (id_medicamento, fecha_toma);
+        CREATE INDEX tomas_medicamentos_fecha_brin_idx ON tomas_medicamentos USING BRIN (fecha_toma);
+        DO $$
+        DECLARE
+            col TEXT;
+            secuencia TEXT;
+            restriccion RECORD;
+        BEGIN
+            FOR col IN SELECT attname FROM pg_attribute
+                       WHERE attrelid = 'tomas_medicamentos_previa'::regclass AND attnum > 0 AND NOT attisdropped
+            LOOP
+                -- serial: la secuencia pasa a ser de la tabla nueva; identity: la tabla nueva tiene
+                -- la suya y la partición no puede conservar otra
+                secuencia := pg_get_serial_sequence('tomas_medicamentos_previa', col);
+                IF secuencia IS NOT NULL AND EXISTS (SELECT 1 FROM pg_attribute
+                        WHERE attrelid = 'tomas_medicamentos_previa'::regclass AND attname = col AND attidentity <> '') THEN
+                    EXECUTE format('ALTER TABLE tomas_medicamentos_previa ALTER COLUMN %I DROP IDENTITY', col);
+                ELSIF secuencia IS NOT NULL THEN
+                    EXECUTE format('ALTER SEQUENCE %s OWNED BY tomas_medicamentos.%I', secuencia, col);
+                END IF;
+            END LOOP;
+            -- Las claves foráneas van antes del ATTACH: la partición ya tiene las mismas y no se revalidan
+            FOR restriccion IN SELECT pg_get_constraintdef(oid) AS definicion FROM pg_constraint
+                               WHERE conrelid = 'tomas_medicamentos_previa'::regclass AND contype = 'f'
+            LOOP
+                EXECUTE 'ALTER TABLE tomas_medicamentos ADD ' || restriccion.definicion;
+            END LOOP;
+        END $$;
+        ALTER TABLE tomas_medicamentos_previa
+            ADD CONSTRAINT tomas_medicamentos_previa_pkey PRIMARY KEY USING INDEX tomas_medicamentos_previa_pkey;
+        ALTER TABLE tomas_medicamentos ATTACH PARTITION tomas_medicamentos_previa DEFAULT;
+        DO $$
+        DECLARE
+            col TEXT;
+        BEGIN
+            -- identity: la secuencia nueva arranca después del último id existente
+            FOR col IN SELECT attname FROM pg_attribute
+                       WHERE attrelid = 'tomas_medicamentos'::regclass AND attidentity <> ''
+            LOOP
+                EXECUTE format('SELECT setval(pg_get_serial_sequence(''tomas_medicamentos'', %L), '
+                               'COALESCE((SELECT MAX(%I) FROM tomas_medicamentos), 0) + 1, false)', col, col);
+            END LOOP;
+        END $$;
+    """)
+    conn.commit()
+
+def particionar_tomas(conn=None):
+    """
+    Convierte tomas_medicamentos en una tabla particionada por mes de fecha_toma, con clave
+    primaria (id_toma, fecha_toma). La tabla original queda como partición DEFAULT y sus
+    filas pasan mes a mes a su partición, cada mes en su propia transacción; si el job se
+    corta, la próxima corrida sigue donde quedó. Al vaciarse, la tabla original se reemplaza
+    por una DEFAULT nueva. Con la tabla ya particionada, solo agrega los meses que vienen.
+    Cada partición tiene el índice (id_medicamento, fecha_toma) y un BRIN por fecha_toma
+    para los recorridos por rango de toda la clínica.
+    Pensado para el mantenimiento diario (fMantenimiento.py), no para correr desde una página.
+    """
+    asegurar_esquema_tomas(conn)
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    hoy = date.today()
+    try:
+        with conn.cursor() as cur:
+            if not _tomas_particionada(cur):
+                _convertir_tomas_en_particionada(conn, cur)
+
+            default = _particion_default_tomas(cur)
+            desde = hoy
+            if default:
+                cur.execute(f"SELECT MIN(fecha_toma)::date FROM {default}")
+                desde = min(cur.fetchone()[0] or hoy, hoy)
+            mes, hasta = _inicio_mes(desde), _inicio_mes(hoy, MESES_PARTICIONES_ADELANTE)
+            while mes <= hasta:
+                _agregar_particion_tomas(cur, mes)
+                conn.commit()
+                mes = _inicio_mes(mes, 1)
+
+            if default == "tomas_medicamentos_previa":
+                cur.execute("SELECT EXISTS (SELECT 1 FROM tomas_medicamentos_previa)")
+                if not cur.fetchone()[0]:
+                    cur.execute("""
+                        ALTER TABLE tomas_medicamentos DETACH PARTITION tomas_medicamentos_previa;
+                        DROP TABLE tomas_medicamentos_previa;
+                    """)
+                    default = None
+            if default is None:
+                cur.execute("CREATE TABLE tomas_medicamentos_default PARTITION OF tomas_medicamentos DEFAULT")
+        conn.commit()
+        return True
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al particionar tomas_medicamentos: {e}")
+        return False
+    finally:
+        if cerrar:
+            conn.close()
+
+def compactar_tomas(retencion_meses=RETENCION_TOMAS_MESES, conn=None):
+    """
+    Resume por medicamento y día las particiones anteriores a la ventana de retención
+    (tomas_resumen_diario) y las elimina. También borra las claves de idempotencia viejas.
+    Cada partición se procesa en su propia transacción. Devuelve las particiones compactadas.
+    """
+    cerrar = conn is None
+    conn = conn or connect_to_supabase()
+    limite = _inicio_mes(date.today(), -retencion_meses)
+    compactadas = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS tomas_resumen_diario (
+                    id_medicamento INTEGER NOT NULL,
+                    dia DATE NOT NULL,
+                    tomas INTEGER NOT NULL,
+                    cantidad_total NUMERIC NOT NULL,
+                    primera_toma TIMESTAMP,
+                    ultima_toma TIMESTAMP,
+                    PRIMARY KEY (id_medicamento, dia)
+                );
+                DELETE FROM claves_tomas WHERE creada_en < NOW() - make_interval(days => %s);
+            """, (RETENCION_CLAVES_TOMAS_DIAS,))
+            conn.commit()
+            if not _tomas_particionada(cur):
+                return compactadas
+
+            cur.execute("""
+                SELECT c.relname
+                FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'tomas_medicamentos'::regclass
+                  AND c.relname ~ '^tomas_medicamentos_[0-9]{4}_[0-9]{2}$'
+                ORDER BY c.relname
+            """)
+            for (particion,) in cur.fetchall():
+                anio, mes = map(int, particion.rsplit("_", 2)[1:])
+                if _inicio_mes(date(anio, mes, 1), 1) > limite:
+                    break
+                cur.execute(f"""
+                    INSERT INTO tomas_resumen_diario AS r (id_medicamento, dia, tomas, cantidad_total, primera_toma, ultima_toma)
+                    SELECT id_medicamento, fecha_toma::date, COUNT(*), COALESCE(SUM(cantidad_tomada), 0),
+                           MIN(fecha_toma), MAX(fecha_toma)
+                    FROM {particion}
+                    GROUP BY id_medicamento, fecha_toma::date
+                    ON CONFLICT (id_medicamento, dia) DO UPDATE
+                    SET tomas = r.tomas + EXCLUDED.tomas,
+                        cantidad_total = r.cantidad_total + EXCLUDED.cantidad_total,
+                        primera_toma = LEAST(r.primera_toma, EXCLUDED.primera_toma),
+                        ultima_toma = GREATEST(r.ultima_toma, EXCLUDED.ultima_toma);
+                    ALTER TABLE tomas_medicamentos DETACH PARTITION {particion};
+                    DROP TABLE {particion};
+                """)
+                conn.commit()
+                compactadas.append(particion)
+    except Exception as e:
+        conn.rollback()
+        print(f"Error al compactar tomas_medicamentos: {e}")
+    finally:
+        if cerrar:
+            conn.close()
+    return compactadas
+
+
+# ------------------------
+# 📚 Catálogo de medicamentos (autocompletado)
+# ------------------------
+ARCHIVO_CATALOGO = os.path.join(DIRECTORIO_DATOS, "catalogo_medicamentos.csv")
+COLUMNAS_CATALOGO = ["marca", "droga", "concentraciones_mg"]
+LIMITE_SUGERENCIAS = 20
+
+class TrieCatalogo:
+    """
+    Trie de prefijos sobre el catálogo. Cada entrada (marca + droga + concentración) se indexa
+    por cada palabra normalizada de su marca, su droga y su concentración. Cada nodo guarda,
+    ya ordenadas, las posiciones de las entradas que pasan por él, así que una búsqueda de una
+    palabra solo recorre los caracteres del prefijo.
+    """
+    def __init__(self):
+        self.entradas = []
+        self._raiz = {}
+
+    def agregar(self, marca, droga, gramaje_mg):
+        entrada = {"marca": marca, "droga": droga, "gramaje_mg": gramaje_mg,
+                   "etiqueta": f"{marca} · {droga} {gramaje_mg:g} mg"}
+        self.entradas.append(entrada)
+        return entrada
+
+    def construir(self):
+        """Ordena las entradas y arma los nodos. Se llama una vez, después de agregar todas."""
+        self.entradas.sort(key=lambda e: (normalizar_droga(e["marca"]), e["gramaje_mg"]))
+        self._raiz = {}
+        for posicion, entrada in enumerate(self.entradas):
+            palabras = set(normalizar_droga(f"{entrada['marca']} {entrada['droga']} {entrada['gramaje_mg']:g}").split())
+            for palabra in palabras:
+                nodo = self._raiz
+                for letra in palabra:
+                    nodo = nodo.setdefault(letra, {"": []})
+                    # Dos palabras de la misma entrada pueden compartir prefijo
+                    if not nodo[""] or nodo[""][-1] != posicion:
+                        nodo[""].append(posicion)
+        return self
+
+    def buscar(self, texto, limite=LIMITE_SUGERENCIAS):
+        """
+        Entradas cuya marca o droga tienen una palabra que empieza con cada palabra de `texto`
+        (por ejemplo "ibu 400"). Sin texto no devuelve nada.
+        """
+        listas = []
+        for palabra in normalizar_droga(texto).split():
+            nodo = self._raiz
+            for letra in palabra:
+                nodo = nodo.get(letra)
+                if nodo is None:
+                    return []
+            listas.append(nodo[""])
+        if not listas:
+            return []
+        # Se filtra la lista más corta contra las demás, sin salir del orden del catálogo
+        listas.sort(key=len)
+        otras = [set(lista) for lista in listas[1:]]
+        resultado = []
+        for posicion in listas[0]:
+            if all(posicion in otra for otra in otras):
+                resultado.append(self.entradas[posicion])
+                if len(resultado) == limite:
+                    break
+        return resultado
+
+    def __len__(self):
+        return len(self.entradas)
+
+def _leer_catalogo(origen):
+    """Lee y valida un CSV de catálogo. Devuelve un DataFrame con una fila por marca, droga y concentración."""
+    try:
+        catalogo = pd.read_csv(origen, dtype=str, keep_default_na=False)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+        raise ValueError(f"El archivo no es un CSV válido: {e}")
+    faltantes = [c for c in COLUMNAS_CATALOGO if c not in catalogo.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en el catálogo: {', '.join(faltantes)}")
+    catalogo = catalogo[COLUMNAS_CATALOGO].apply(lambda columna: columna.str.strip())
+    catalogo = catalogo[(catalogo["marca"] != "") & (catalogo["droga"] != "")]
+    filas = catalogo.assign(gramaje_mg=catalogo["concentraciones_mg"].str.split("|")).explode("gramaje_mg")
+    gramajes = pd.to_numeric(filas["gramaje_mg"].str.strip().str.replace(",", ".", regex=False), errors="coerce")
+    invalidas = filas.loc[gramajes.isna() | (gramajes <= 0), "marca"].unique()
+    if len(invalidas):
+        raise ValueError(f"Concentraciones inválidas para: {', '.join(invalidas[:10])}")
+    return filas.assign(gramaje_mg=gramajes)[["marca", "droga", "gramaje_mg"]].drop_duplicates()
+
+@lru_cache(maxsize=1)
+def _cargar_catalogo(archivo, modificado):
+    trie = TrieCatalogo()
+    for marca, droga, gramaje_mg in _leer_catalogo(archivo).itertuples(index=False):
+        trie.agregar(marca, droga, float(gramaje_mg))
+    return trie.construir()
+
+def obtener_catalogo(archivo=ARCHIVO_CATALOGO):
+    """
+    Trie del catálogo, compartido por todas las sesiones del proceso. Se vuelve a construir
+    solo si el archivo cambió (por ejemplo, después de actualizar_catalogo).
+    """
+    return _cargar_catalogo(archivo, os.path.getmtime(archivo))
+
+def actualizar_catalogo(origen, archivo=ARCHIVO_CATALOGO):
+    """
+    Reemplaza el catálogo con un CSV nuevo (ruta o archivo abierto) con las columnas
+    marca, droga y concentraciones_mg (separadas por "|"). Lo valida antes de escribirlo
+    y lo reemplaza de forma atómica. Devuelve la cantidad de entradas cargadas.
+    """
+    filas = _leer_catalogo(origen)
+    # Una droga que no está en drogas.csv quedaría fuera de los controles de interacciones y alergias
+    indice = obtener_indice_interacciones()
+    desconocidas = sorted(droga for droga in filas["droga"].unique() if not indice.conoce(droga))
+    if desconocidas:
+        raise ValueError(f"Drogas que no están en {os.path.basename(ARCHIVO_DROGAS)}: {', '.join(desconocidas[:10])}")
+    por_marca = (filas.assign(gramaje_mg=filas["gramaje_mg"].map("{:g}".format))
+                 .groupby(["marca", "droga"], sort=True)["gramaje_mg"].agg("|".join)
+                 .rename("concentraciones_mg").reset_index())
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(archivo), suffix=".csv")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8", newline="") as salida:
+            por_marca.to_csv(salida, index=False)
+        os.replace(temporal, archivo)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return len(obtener_catalogo(archivo))
@@ -5,19 +5,39 @@ from datetime import datetime, timedelta, date, time
 from functions import connect_to_supabase
 # Se asume que estas funciones existen y funcionan correctamente en fCalendario.py
 from fCalendario import (
-    obtener_todos_los_medicos, 
-    obtener_lugares_por_medico, 
     obtener_dias_con_turnos, 
     obtener_turnos_mes, 
     eliminar_turno, 
     editar_turno, 
     obtener_o_crear_paciente, 
     obtener_o_crear_medico, 
-    guardar_turno
+    guardar_turno,
+    obtener_cache_meses,
+    cargar_mes,
+    precargar_meses_adyacentes,
+    obtener_directorio_medicos,
+    TurnoSuperpuestoError,
+    FRECUENCIAS_SERIE,
+    crear_serie_turnos,
+    mover_ocurrencia,
+    cancelar_ocurrencia,
+    eliminar_serie,
+    generar_ics,
+    importar_ics,
+    obtener_turnos_por_dia_anio,
+    invalidar_calendario,
+    buscar_turnos_libres,
+    obtener_horarios_medico,
+    guardar_horarios_medico,
+    DIAS_SEMANA,
+    HORARIO_POR_DEFECTO
 )
 from fEncuesta import get_encuesta_completada
 from functions import connect_to_supabase
 
+MEDICOS_POR_PAGINA = 50
+DIAS_BUSQUEDA_LIBRES = 30
+
 # --- Configuración de la Página ---
 st.set_page_config(
     page_title="MedCheck - Calendario",
@@ -85,6 +105,17 @@ st.markdown("""
             margin-top: 4px;
         }
 
+        /* --- Estilos de la Vista Anual --- */
+        .heat-year { display: grid; grid-template-columns: repeat(4, 1fr); gap: 16px; }
+        .heat-title { font-weight: bold; color: #555; font-size: 0.9em; margin-bottom: 4px; }
+        .heat-grid { display: grid; grid-template-columns: repeat(7, 14px); gap: 3px; }
+        .heat-cell { width: 14px; height: 14px; border-radius: 3px; }
+        .heat-0 { background-color: #EEEEEE; }
+        .heat-1 { background-color: #E8C4CB; }
+        .heat-2 { background-color: #C7788A; }
+        .heat-3 { background-color: #A33A52; }
+        .heat-4 { background-color: #800020; }
+
         /* --- Estilos de Tarjetas de Turno --- */
         .card {
             background-color: #FFFFFF;
@@ -128,6 +159,7 @@ if not encuesta_completada.empty and not encuesta_completada.iloc[0]["encuesta_c
 # --- Inicialización de Fecha ---
 if "current_date" not in st.session_state:
     st.session_state.current_date = datetime.today()
+cache_meses = obtener_cache_meses()
 
 # --- Layout Principal en Dos Columnas ---
 col_main, col_sidebar = st.columns([2, 1])
@@ -149,7 +181,8 @@ with col_main:
 
     # --- Renderizado del Calendario Mejorado ---
     st.markdown('<div class="calendar-container">', unsafe_allow_html=True)
-    dias_con_turnos = obtener_dias_con_turnos(current_date.year, current_date.month, dni)
+    datos_mes = cargar_mes(current_date.year, current_date.month, dni, cache_meses)
+    dias_con_turnos = datos_mes["dias"]
     cal = calendar.Calendar(firstweekday=6) # Domingo como primer día
     month_days = cal.monthdatescalendar(current_date.year, current_date.month)
     
@@ -176,7 +209,7 @@ with col_main:
 
     # --- Listado de Turnos del Mes ---
     st.subheader("📋 Turnos Agendados para este Mes")
-    df_turnos = obtener_turnos_mes(current_date.year, current_date.month, dni)
+    df_turnos = datos_mes["turnos"]
 
     if not df_turnos.empty:
         for i, row in df_turnos.iterrows():
@@ -191,6 +224,38 @@ with col_main:
                     </div>
                 """, unsafe_allow_html=True)
                 
+                if pd.notna(row["Serie"]):
+                    st.caption("🔁 Turno recurrente")
+                    with st.expander("✏️ Mover o Cancelar esta Fecha"):
+                        with st.form(f"edit_form_{row['ID']}", border=False):
+                            nueva_fecha = st.date_input("Nueva fecha", value=row["Fecha"], key=f"fecha_{i}")
+                            nueva_hora = st.time_input("Nueva hora", value=row["Hora"], key=f"hora_{i}")
+
+                            mover_col, cancelar_col, serie_col = st.columns(3)
+                            with mover_col:
+                                if st.form_submit_button("✅ Mover", use_container_width=True):
+                                    try:
+                                        mover_ocurrencia(row["Serie"], row["FechaOriginal"], nueva_fecha, nueva_hora)
+                                    except TurnoSuperpuestoError as e:
+                                        st.error(f"⚠️ No se pudo mover el turno. {e}")
+                                    else:
+                                        invalidar_calendario(cache_meses, dni, row["Fecha"], nueva_fecha)
+                                        st.success("Turno movido.")
+                                        st.rerun()
+                            with cancelar_col:
+                                if st.form_submit_button("🚫 Cancelar esta fecha", type="secondary", use_container_width=True):
+                                    cancelar_ocurrencia(row["Serie"], row["FechaOriginal"])
+                                    invalidar_calendario(cache_meses, dni, row["Fecha"])
+                                    st.warning("Turno cancelado.")
+                                    st.rerun()
+                            with serie_col:
+                                if st.form_submit_button("🗑️ Eliminar serie", type="secondary", use_container_width=True):
+                                    eliminar_serie(row["Serie"])
+                                    invalidar_calendario(cache_meses, dni)
+                                    st.warning("Serie de turnos eliminada.")
+                                    st.rerun()
+                    continue
+
                 with st.expander("✏️ Editar o Eliminar Turno"):
                     with st.form(f"edit_form_{row['ID']}", border=False):
                         nueva_fecha = st.date_input("Nueva fecha", value=row["Fecha"], key=f"fecha_{i}")
@@ -200,63 +265,190 @@ with col_main:
                         edit_col, del_col = st.columns(2)
                         with edit_col:
                             if st.form_submit_button("✅ Guardar Cambios", use_container_width=True):
-                                editar_turno(row["ID"], nueva_fecha, nueva_hora, nuevo_lugar)
-                                st.success("Turno actualizado.")
-                                st.rerun()
+                                try:
+                                    editar_turno(row["ID"], nueva_fecha, nueva_hora, nuevo_lugar)
+                                except TurnoSuperpuestoError as e:
+                                    st.error(f"⚠️ No se pudo mover el turno. {e}")
+                                else:
+                                    invalidar_calendario(cache_meses, dni, row["Fecha"], nueva_fecha)
+                                    st.success("Turno actualizado.")
+                                    st.rerun()
                         with del_col:
                             if st.form_submit_button("🗑️ Eliminar Turno", type="secondary", use_container_width=True):
                                 eliminar_turno(row["ID"])
+                                invalidar_calendario(cache_meses, dni, row["Fecha"])
                                 st.warning("Turno eliminado.")
                                 st.rerun()
     else:
         st.info("No hay turnos agendados para este mes.")
 
+    st.divider()
+
+    # --- Vista Anual (mapa de calor de turnos por día) ---
+    with st.expander(f"🗓️ Vista anual {current_date.year}"):
+        turnos_por_dia = obtener_turnos_por_dia_anio(dni, current_date.year)
+        max_turnos = max(turnos_por_dia.values(), default=0)
+        st.caption(f"{sum(turnos_por_dia.values())} turnos en el año · {len(turnos_por_dia)} días con turnos")
+
+        meses_html = ""
+        for mes in range(1, 13):
+            # Celdas vacías hasta el primer día (la semana empieza el domingo)
+            celdas = '<div class="heat-cell"></div>' * ((date(current_date.year, mes, 1).weekday() + 1) % 7)
+            for semana in calendar.Calendar(firstweekday=6).monthdatescalendar(current_date.year, mes):
+                for dia in semana:
+                    if dia.month != mes:
+                        continue
+                    cantidad = turnos_por_dia.get(dia, 0)
+                    nivel = 0 if not cantidad else min(4, 1 + (3 * cantidad) // max(max_turnos, 1))
+                    celdas += f'<div class="heat-cell heat-{nivel}" title="{dia.strftime("%d/%m")}: {cantidad} turno(s)"></div>'
+            nombre_mes = date(current_date.year, mes, 1).strftime("%B").capitalize()
+            meses_html += f'<div class="heat-month"><div class="heat-title">{nombre_mes}</div><div class="heat-grid">{celdas}</div></div>'
+        st.markdown(f'<div class="heat-year">{meses_html}</div>', unsafe_allow_html=True)
+
 # --- Columna Lateral (Derecha) ---
 with col_sidebar:
     st.subheader("➕ Agendar Nuevo Turno")
     
+    # Detalles del Médico (fuera del formulario, para que la búsqueda responda al tipear)
+    st.write("**Detalles del Médico**")
+    directorio_medicos = obtener_directorio_medicos()
+    busqueda_medico = st.text_input("Buscar médico", placeholder="Nombre o especialidad", key="busqueda_medico")
+    medicos_pagina, total_medicos = directorio_medicos.buscar(busqueda_medico, por_pagina=MEDICOS_POR_PAGINA)
+    if total_medicos > MEDICOS_POR_PAGINA:
+        total_paginas = -(-total_medicos // MEDICOS_POR_PAGINA)
+        pagina_medicos = st.number_input(f"Página de resultados (de {total_paginas})", min_value=1, max_value=total_paginas, value=1, step=1)
+        medicos_pagina, _ = directorio_medicos.buscar(busqueda_medico, pagina=pagina_medicos - 1, por_pagina=MEDICOS_POR_PAGINA)
+
+    opciones_medicos = [None] + [m["id_medico"] for m in medicos_pagina]
+    id_medico_seleccionado = st.selectbox(
+        "Médico", opciones_medicos, key="selector_medico", label_visibility="collapsed",
+        format_func=lambda id_medico: "Seleccionar médico existente" if id_medico is None
+            else directorio_medicos.obtener(id_medico)["etiqueta"]
+    )
+
+    # Próximos turnos libres del médico elegido (según sus horarios de atención)
+    if "fecha_turno" not in st.session_state:
+        st.session_state.fecha_turno = date.today()
+        st.session_state.hora_turno = time(9, 0)
+    if id_medico_seleccionado:
+        if "id_paciente" not in st.session_state:
+            st.session_state.id_paciente = obtener_o_crear_paciente(dni)
+
+        def elegir_turno_libre(momento):
+            st.session_state.fecha_turno = momento.date()
+            st.session_state.hora_turno = momento.time()
+
+        ahora = datetime.now()
+        turnos_libres = buscar_turnos_libres(id_medico_seleccionado, ahora, ahora + timedelta(days=DIAS_BUSQUEDA_LIBRES),
+                                             cantidad=6, id_paciente=st.session_state.id_paciente)
+        st.write("**🕒 Próximos turnos libres**")
+        if turnos_libres:
+            cols_libres = st.columns(2)
+            for k, momento in enumerate(turnos_libres):
+                cols_libres[k % 2].button(momento.strftime("%d/%m %H:%M"), key=f"libre_{k}", use_container_width=True,
+                                          on_click=elegir_turno_libre, args=(momento,))
+        else:
+            st.caption(f"Sin turnos libres en los próximos {DIAS_BUSQUEDA_LIBRES} días.")
+
+        with st.expander("🕘 Horarios de atención del médico"):
+            franjas = obtener_horarios_medico(id_medico_seleccionado)
+            if not franjas:
+                st.caption("Sin horarios cargados: se asume lunes a viernes de 9 a 17 hs.")
+            df_franjas = pd.DataFrame(
+                [(DIAS_SEMANA[dia], inicio, fin) for dia, inicio, fin in franjas or HORARIO_POR_DEFECTO],
+                columns=["Día", "Desde", "Hasta"]
+            )
+            franjas_editadas = st.data_editor(
+                df_franjas, num_rows="dynamic", hide_index=True, use_container_width=True,
+                key=f"horarios_{id_medico_seleccionado}",
+                column_config={
+                    "Día": st.column_config.SelectboxColumn("Día", options=DIAS_SEMANA, required=True),
+                    "Desde": st.column_config.TimeColumn("Desde", format="HH:mm", required=True),
+                    "Hasta": st.column_config.TimeColumn("Hasta", format="HH:mm", required=True),
+                }
+            )
+            if st.button("💾 Guardar horarios", use_container_width=True):
+                nuevas_franjas = [(DIAS_SEMANA.index(f["Día"]), f["Desde"], f["Hasta"])
+                                  for _, f in franjas_editadas.dropna().iterrows()]
+                if any(desde >= hasta for _, desde, hasta in nuevas_franjas):
+                    st.warning("Cada franja debe terminar después de empezar.")
+                else:
+                    guardar_horarios_medico(id_medico_seleccionado, nuevas_franjas)
+                    st.success("Horarios actualizados.")
+                    st.rerun()
+
     with st.form("form_turno", border=False):
-        # Detalles del Médico
-        st.write("**Detalles del Médico**")
-        medicos_disponibles = obtener_todos_los_medicos()
-        opciones_medicos = ["Seleccionar médico existente"] + [f"{m[1]}" for m in medicos_disponibles]
-        opcion_elegida = st.selectbox("Médico", opciones_medicos, key="selector_medico", label_visibility="collapsed")
-        
         with st.expander("➕ Ingresar un médico nuevo"):
             nombre_medico_nuevo = st.text_input("Nombre del nuevo médico")
             especialidad_medico_nuevo = st.text_input("Especialidad del nuevo médico")
 
         # Fecha y Lugar
         st.write("**Fecha y Lugar del Turno**")
-        fecha = st.date_input("Fecha", value=date.today())
-        hora = st.time_input("Hora", value=time(9, 0))
+        fecha = st.date_input("Fecha", key="fecha_turno")
+        hora = st.time_input("Hora", key="hora_turno")
         
-        id_medico_seleccionado = None
-        if opcion_elegida != "Seleccionar médico existente":
-            for m in medicos_disponibles:
-                if f"{m[1]}" == opcion_elegida:
-                    id_medico_seleccionado = m[0]
-                    break
-            if id_medico_seleccionado:
-                lugares = obtener_lugares_por_medico(id_medico_seleccionado)
-                lugar_seleccionado = st.selectbox("Lugar", lugares)
-            else:
-                lugar_seleccionado = st.text_input("Lugar")
+        if id_medico_seleccionado:
+            lugar_medico = directorio_medicos.obtener(id_medico_seleccionado)["lugar"]
+            lugar_seleccionado = st.selectbox("Lugar", [lugar_medico or "Lugar no especificado"])
         else:
             lugar_seleccionado = st.text_input("Lugar")
 
+        # Repetición
+        st.write("**Repetición**")
+        repeticion = st.selectbox("Repetir", ["no"] + list(FRECUENCIAS_SERIE),
+                                  format_func=lambda f: "No se repite" if f == "no" else FRECUENCIAS_SERIE[f])
+        col_intervalo, col_hasta = st.columns(2)
+        with col_intervalo:
+            intervalo_serie = st.number_input("Cada (semanas / meses)", min_value=1, max_value=12, value=1, step=1)
+        with col_hasta:
+            fecha_fin_serie = st.date_input("Hasta (opcional)", value=None)
+
         if st.form_submit_button("💾 Guardar Turno", type="primary", use_container_width=True):
             id_paciente = obtener_o_crear_paciente(dni)
             
             # Lógica para guardar
+            id_medico = None
             if nombre_medico_nuevo and especialidad_medico_nuevo:
-                id_medico = obtener_o_crear_medico(nombre_medico_nuevo, especialidad_medico_nuevo)
-                guardar_turno(id_paciente, id_medico, fecha, hora, lugar_seleccionado)
-                st.success("Turno guardado con nuevo médico.")
-                st.rerun()
+                id_medico = obtener_o_crear_medico(nombre_medico_nuevo, especialidad_medico_nuevo, lugar_seleccionado or None)
+                directorio_medicos.agregar(id_medico, nombre_medico_nuevo, especialidad_medico_nuevo, lugar_seleccionado or None)
             elif id_medico_seleccionado:
-                guardar_turno(id_paciente, id_medico_seleccionado, fecha, hora, lugar_seleccionado)
-                st.success("Turno guardado.")
-                st.rerun()
-            else:
+                id_medico = id_medico_seleccionado
+
+            if id_medico is None:
                 st.warning("Por favor, selecciona un médico existente o ingresa los datos de uno nuevo.")
+            else:
+                try:
+                    if repeticion == "no":
+                        guardar_turno(id_paciente, id_medico, fecha, hora, lugar_seleccionado)
+                    else:
+                        crear_serie_turnos(id_paciente, id_medico, fecha, hora, lugar_seleccionado,
+                                           repeticion, intervalo=intervalo_serie, fecha_fin=fecha_fin_serie)
+                except TurnoSuperpuestoError as e:
+                    st.error(f"⚠️ No se pudo agendar el turno. {e}")
+                else:
+                    invalidar_calendario(cache_meses, dni, fecha if repeticion == "no" else None)
+                    st.success("Turno guardado con nuevo médico." if nombre_medico_nuevo and especialidad_medico_nuevo else "Turno guardado.")
+                    st.rerun()
+
+    # --- Exportar / Importar Calendario (.ics) ---
+    with st.expander("📤 Exportar o 📥 Importar Calendario"):
+        st.download_button(
+            "📤 Descargar mis turnos (.ics)",
+            data=lambda: "".join(generar_ics(dni)),
+            file_name=f"turnos_{dni}.ics",
+            mime="text/calendar",
+            use_container_width=True,
+        )
+        archivo_ics = st.file_uploader("Archivo .ics para importar", type=["ics"])
+        if archivo_ics is not None and st.button("📥 Importar turnos", use_container_width=True):
+            with st.spinner("Importando turnos..."):
+                importados, salteados, de_dia_completo = importar_ics(archivo_ics, obtener_o_crear_paciente(dni))
+            invalidar_calendario(cache_meses, dni)
+            st.success(f"Se importaron {importados} turnos.")
+            if salteados:
+                st.info(f"Se saltearon {salteados} turnos ya importados o superpuestos con otros.")
+            if de_dia_completo:
+                st.info(f"Se ignoraron {de_dia_completo} eventos de día completo: los turnos necesitan una hora.")
+
+# --- Precarga de los meses vecinos (después de renderizar el actual) ---
+precargar_meses_adyacentes(current_date.year, current_date.month, dni, cache_meses)
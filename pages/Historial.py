@@ -3,6 +3,11 @@ from datetime import date
 # Se asume que estas funciones existen y funcionan correctamente
 from fHistorial import (
     get_estudios_medicos_recientes, 
+    get_imagenes_estudio,
+    iniciar_ingesta_imagenes,
+    hash_para_mostrar,
+    leer_blob,
+    TIPOS_IMAGEN_ADMITIDOS,
     insertar_estudio_medico, 
     insertar_evento_medico, 
     get_eventos_medicos_recientes, 
@@ -218,6 +223,36 @@ with tab2:
 # --- Pestaña 3: Estudios Médicos ---
 with tab3:
     st.subheader("Historial de Estudios")
+
+    # Las imágenes subidas se procesan en segundo plano; esto muestra cómo van
+    ingestas = st.session_state.setdefault("ingestas_imagenes", [])
+    for aviso in st.session_state.pop("avisos_imagenes", []):
+        if aviso.startswith("No se pudo"):
+            st.warning(aviso)
+        else:
+            st.success(aviso)
+
+    @st.fragment(run_every=1 if ingestas else None)
+    def mostrar_ingestas():
+        terminadas = [ingesta for ingesta in ingestas if ingesta["tarea"].done()]
+        for ingesta in ingestas:
+            if ingesta not in terminadas:
+                st.info(f"⏳ Procesando {ingesta['cantidad']} imagen(es) del estudio {ingesta['tipo']}...")
+        if terminadas:
+            avisos = st.session_state.setdefault("avisos_imagenes", [])
+            for ingesta in terminadas:
+                ingestas.remove(ingesta)
+                try:
+                    guardadas, errores = ingesta["tarea"].result()
+                except Exception as e:
+                    guardadas, errores = 0, [("(todas)", str(e))]
+                if guardadas:
+                    avisos.append(f"🖼️ {guardadas} imagen(es) guardada(s) en el estudio {ingesta['tipo']}.")
+                avisos += [f"No se pudo guardar '{nombre}': {error}" for nombre, error in errores]
+            # Se vuelve a dibujar toda la página para que el listado muestre las imágenes nuevas
+            st.rerun()
+
+    mostrar_ingestas()
     estudios = get_estudios_medicos_recientes(dni, conn=conn)
 
     # SECCIÓN PARA MOSTRAR ESTUDIOS EXISTENTES
@@ -233,6 +268,34 @@ with tab3:
                         </div>
                     </div>
                 """, unsafe_allow_html=True)
+                # Las imágenes se leen del almacén solo si el usuario las abre
+                cantidad_imagenes = int(estudio.get('imagenes') or 0)
+                if cantidad_imagenes and st.toggle(f"🖼️ Ver imágenes ({cantidad_imagenes})", key=f"ver_imagenes_{estudio['id_estudio']}"):
+                    imagenes = get_imagenes_estudio(estudio['id_estudio'], conn=conn)
+                    imagenes = list(imagenes.itertuples()) if imagenes is not None else []
+                    fotos = [imagen for imagen in imagenes if imagen.tipo_mime.startswith("image/")]
+                    columnas_fotos = st.columns(4)
+                    for numero, imagen in enumerate(fotos, start=1):
+                        miniatura = leer_blob(hash_para_mostrar(imagen, 320))
+                        if miniatura is None:
+                            columnas_fotos[(numero - 1) % 4].info(f"#{numero}: imagen no disponible")
+                        else:
+                            columnas_fotos[(numero - 1) % 4].image(miniatura, caption=f"#{numero}", use_container_width=True)
+                    if fotos:
+                        elegida = st.selectbox("Ver en tamaño completo", [None] + list(range(1, len(fotos) + 1)),
+                                               format_func=lambda n: "—" if n is None else f"Imagen #{n}",
+                                               key=f"imagen_completa_{estudio['id_estudio']}")
+                        if elegida:
+                            contenido = leer_blob(fotos[elegida - 1].hash)
+                            if contenido is None:
+                                st.warning("Esta imagen no está disponible en el almacén.")
+                            else:
+                                st.image(contenido, use_container_width=True)
+                    for imagen in imagenes:
+                        if not imagen.tipo_mime.startswith("image/"):
+                            st.download_button(f"📄 Descargar archivo ({imagen.tamanio // 1024} KB)", data=leer_blob(imagen.hash) or b"",
+                                               file_name=imagen.hash[:12] + (".pdf" if imagen.tipo_mime == "application/pdf" else ""),
+                                               mime=imagen.tipo_mime, key=f"archivo_{estudio['id_estudio']}_{imagen.hash}")
                 
     else:
         st.info("🔬 Sin Estudios Registrados: Usa el formulario para agregar tu primer estudio.")
@@ -278,8 +341,12 @@ with tab3:
                 placeholder="Ej: Valores normales, se observa fractura..."
             )
 
-            # --- ELIMINADO: Carga de archivo ---
-            # Se ha quitado el st.file_uploader de esta sección.
+            archivos_imagenes = st.file_uploader(
+                "Imágenes del estudio",
+                type=TIPOS_IMAGEN_ADMITIDOS,
+                accept_multiple_files=True,
+                help="Se guardan comprimidas y sin metadatos (ubicación, cámara, etc.)."
+            )
 
             # Botón de envío del formulario
             submitted_estudio = st.form_submit_button("🔬 Guardar Estudio Médico")
@@ -289,12 +356,7 @@ with tab3:
                     st.error("❌ Los campos 'Tipo de Estudio', 'Zona del Cuerpo' y 'Razón del Estudio' son obligatorios.")
                 else:
                     with st.spinner("Guardando estudio médico..."):
-                        
-                        # --- ELIMINADO: Procesamiento de imagen ---
-                        # Se quitó la lógica para manejar el archivo subido.
-                        
-                        # Llamada a la función para insertar en la BD (sin el parámetro de la imagen)
-                        success = insertar_estudio_medico(
+                        id_estudio = insertar_estudio_medico(
                             dni=dni,
                             tipo_estudio=tipo_estudio,
                             fecha_estudio=fecha_estudio,
@@ -304,7 +366,13 @@ with tab3:
                             conn=conn
                         )
                         
-                        if success:
+                        if id_estudio:
+                            if archivos_imagenes:
+                                # Las imágenes se procesan en el pool: la página no espera
+                                archivos = [(archivo.name, archivo.getvalue()) for archivo in archivos_imagenes]
+                                tarea = iniciar_ingesta_imagenes(id_estudio, int(paciente['id_paciente']), archivos)
+                                st.session_state.ingestas_imagenes.append(
+                                    {"tarea": tarea, "cantidad": len(archivos), "tipo": tipo_estudio})
                             st.success("✅ ¡Estudio médico guardado exitosamente!")
                             st.rerun()
                         else:
@@ -1,14 +1,28 @@
 import streamlit as st
 import pandas as pd
-from datetime import date, time
+from datetime import date, time, timedelta
 # Se importan las funciones necesarias del backend, incluyendo la nueva
 from fmedi import (
     get_medicamentos, 
     marcar_medicamento_como_finalizado, 
+    get_historial_medicamentos,
+    contar_historial_medicamentos,
+    invalidar_historial,
+    HISTORIAL_POR_PAGINA,
     insertar_medicamento, 
-    formatear_dosis_texto, 
-    registrar_toma, 
-    contar_tomas_hoy  # Reemplaza a verificar_toma_hoy
+    columna_dosis_texto, 
+    registrar_toma,
+    nueva_clave_toma,
+    obtener_indice_interacciones,
+    obtener_indice_alergias,
+    alergias_paciente,
+    obtener_catalogo,
+    obtener_mapa_tomas,
+    invalidar_mapa_tomas,
+    calcular_agenda_dosis,
+    get_adherencia_paciente,
+    pronosticar_agotamiento,
+    DIAS_AVISO_REPOSICION
 )
 from fEncuesta import get_encuesta_completada
 from functions import connect_to_supabase
@@ -34,6 +48,13 @@ st.markdown("""
     .low-stock-warning { font-weight: bold; color: #D32F2F; margin-top: 5px; display: block; }
     .action-container { padding-top: 15px; }
     .st-expander { border: 1px solid #ddd !important; border-radius: 10px !important; }
+    .tomas-grid { display: grid; grid-template-rows: repeat(7, 12px); grid-auto-flow: column; grid-auto-columns: 12px; gap: 2px; overflow-x: auto; padding-bottom: 4px; }
+    .tomas-cell { width: 12px; height: 12px; border-radius: 2px; }
+    .tomas-0 { background-color: #EEEEEE; }
+    .tomas-1 { background-color: #F3D3D9; }
+    .tomas-2 { background-color: #C7788A; }
+    .tomas-3 { background-color: #A33A52; }
+    .tomas-4 { background-color: #800020; }
     </style>
     """, unsafe_allow_html=True)
 
@@ -53,24 +74,57 @@ if not encuesta_completada.empty and not encuesta_completada.iloc[0]["encuesta_c
     st.stop()
 # --- Sección de Medicamentos Actuales ---
 st.subheader("Tratamientos actuales")
-med_actuales = get_medicamentos(dni=dni, solo_actuales=True, conn=conn)
+med_actuales = get_medicamentos(dni=dni, solo_actuales=True, con_tomas=True, conn=conn)
 if med_actuales.empty:
     st.info("No hay medicamentos actualmente registrados.")
 else:
-    med_actuales['dosis_formateada'] = med_actuales.apply(formatear_dosis_texto, axis=1)
+    med_actuales['dosis_formateada'] = columna_dosis_texto(med_actuales)
+    med_actuales = pronosticar_agotamiento(calcular_agenda_dosis(med_actuales))
+
+    def clave_toma(id_medicamento):
+        """Clave de idempotencia pendiente del medicamento: sobrevive a los reruns hasta que la toma se registra."""
+        return st.session_state.setdefault(f"clave_toma_{id_medicamento}", nueva_clave_toma())
+
+    def registrar_toma_click(id_medicamento, cantidad, dosis_programadas_hoy, clave):
+        resultado = registrar_toma(id_medicamento, cantidad, clave_idempotencia=clave,
+                                   dosis_programadas_hoy=dosis_programadas_hoy, conn=conn)
+        if resultado is None:
+            # Se reintenta con la misma clave: si la toma llegó a guardarse, no se duplica
+            st.toast("No se pudo registrar la toma. Intentá de nuevo.", icon="⚠️")
+            return
+        if st.session_state.get(f"clave_toma_{id_medicamento}") == clave:
+            st.session_state[f"clave_toma_{id_medicamento}"] = nueva_clave_toma()
+        if resultado[0]:
+            invalidar_mapa_tomas(dni)
+
     for i, row in med_actuales.iterrows():
         col1, col2 = st.columns([0.8, 0.2])
         with col1:
             stock_actual = row.get('stock_actual')
             recordatorio_activo = row.get('recordatorio', False)
-            tomas_registradas_hoy = contar_tomas_hoy(row['id_medicamento'], conn=conn)
+            tomas_registradas_hoy = int(row['tomas_hoy'])
             
             stock_text = f"<b>Stock:</b> {int(stock_actual)} unidades" if pd.notna(stock_actual) else "<b>Stock:</b> No registrado"
+            if pd.notna(row['dosis_restantes']):
+                stock_text += f" (alcanza para {int(row['dosis_restantes'])} tomas)"
+            if row['requiere_reposicion']:
+                stock_text += f" · se termina aprox. el {row['fecha_agotamiento'].strftime('%d/%m')}"
             tomas_text = f"<b>Tomas registradas hoy:</b> {tomas_registradas_hoy}"
+            if pd.notna(row['ultima_toma']):
+                tomas_text += f" · <b>Última:</b> {pd.Timestamp(row['ultima_toma']).strftime('%d/%m %H:%M')}"
+
+            proxima_html = ""
+            if pd.notna(row['proxima_toma']):
+                proxima = pd.Timestamp(row['proxima_toma'])
+                cuando = f"hoy a las {proxima.strftime('%H:%M')}" if proxima.date() == date.today() else proxima.strftime('%d/%m a las %H:%M')
+                proxima_html = f"<span class='stock-info'>⏰ <b>Próxima toma:</b> {cuando}</span><br>"
+            if row['dosis_omitidas'] > 0:
+                proxima_html += f"<span class='stock-info'>⚠️ <b>Tomas atrasadas hoy:</b> {row['dosis_omitidas']}</span><br>"
 
             low_stock_html = ""
-            if recordatorio_activo and pd.notna(stock_actual) and stock_actual <= 5:
-                 low_stock_html = f"<div class='low-stock-warning'>🔔 ¡QUEDAN POCAS UNIDADES!</div>"
+            if recordatorio_activo and row['requiere_reposicion'] and row['dias_restantes'] <= DIAS_AVISO_REPOSICION:
+                 alcanza = "se termina hoy" if row['dias_restantes'] < 1 else f"alcanza para {int(row['dias_restantes'])} día(s)"
+                 low_stock_html = f"<div class='low-stock-warning'>🔔 ¡QUEDAN POCAS UNIDADES! ({alcanza})</div>"
             
             st.markdown(f"""
                 <div class='med-card'>
@@ -78,35 +132,99 @@ else:
                     <i>{row['dosis_formateada']}</i><br>
                     <b>Motivo:</b> {row['motivo']}<br>
                     <span class='stock-info'>{stock_text}</span><br>
-                    <span class='stock-info'>{tomas_text}</span>
+                    <span class='stock-info'>{tomas_text}</span><br>
+                    {proxima_html}
                     {low_stock_html}
                 </div>""", unsafe_allow_html=True)
         with col2:
             st.markdown("<div class='action-container'>", unsafe_allow_html=True)
             # --- Botón para registrar la toma ---
-            if st.button("Registrar Toma 💊", key=f"toma_btn_{row['id_medicamento']}", help="Registra una toma y descuenta del stock."):
-                registrar_toma(row['id_medicamento'], row['dosis_cantidad'], conn=conn)
-                st.rerun()
+            # La clave se guarda por medicamento y cambia solo después de registrar la toma:
+            # un doble clic o un rerun repiten la misma clave y se registra una sola toma
+            st.button("Registrar Toma 💊", key=f"toma_btn_{row['id_medicamento']}", help="Registra una toma y descuenta del stock.",
+                      on_click=registrar_toma_click,
+                      args=(row['id_medicamento'], row['dosis_cantidad'], row['dosis_hoy'], clave_toma(row['id_medicamento'])))
 
             # --- Botón para finalizar el tratamiento ---
             if st.button("Finalizar ❌", key=f"final_btn_{row['id_medicamento']}", help="Mueve este tratamiento al historial."):
                 marcar_medicamento_como_finalizado(row['id_medicamento'], conn=conn)
+                invalidar_historial()
                 st.toast(f"El tratamiento con '{row['nombre']}' se movió al historial.", icon="📜")
                 st.rerun()
             st.markdown("</div>", unsafe_allow_html=True)
+
+# --- Adherencia de los últimos 12 meses (rollup semanal) ---
+with st.expander("📈 Adherencia de los últimos 12 meses"):
+    adherencia = get_adherencia_paciente(dni, meses=12, por="semana", conn=conn)
+    if adherencia.empty:
+        st.info("Todavía no hay tomas programadas para calcular la adherencia.")
+    else:
+        total_programadas = adherencia['programadas'].sum()
+        total_a_termino = (adherencia['adherencia'].fillna(0).astype(float) / 100 * adherencia['programadas']).sum()
+        if total_programadas:
+            st.metric("Adherencia general", f"{100 * total_a_termino / total_programadas:.0f}%")
+        grafico = adherencia.pivot_table(index='periodo', columns='nombre', values='adherencia', aggfunc='mean')
+        st.line_chart(grafico.astype(float), y_label="% de dosis tomadas", x_label="Semana")
+
+# --- Calendario de tomas del último año, por medicamento ---
+with st.expander("🗓️ Tomas del último año"):
+    hoy = date.today()
+    mapa_tomas = obtener_mapa_tomas(dni, hoy)
+    if not mapa_tomas:
+        st.info("Todavía no hay tomas registradas ni programadas.")
+    else:
+        id_med_mapa = st.selectbox("Medicamento", list(mapa_tomas), key="medicamento_mapa_tomas",
+                                   format_func=lambda id_med: mapa_tomas[id_med]["nombre"])
+        dias_med = mapa_tomas[id_med_mapa]["dias"]
+        desde = hoy - timedelta(days=364)
+        # Una columna por semana, empezando en lunes
+        celdas = '<div class="tomas-cell"></div>' * desde.weekday()
+        for n in range(365):
+            dia = desde + timedelta(days=n)
+            tomadas, programadas = dias_med.get(dia, (0, 0))
+            if programadas == 0 and tomadas == 0:
+                nivel = 0
+            elif programadas == 0 or tomadas >= programadas:
+                nivel = 4
+            else:
+                nivel = 1 + min(2, int(3 * tomadas / programadas))
+            celdas += f'<div class="tomas-cell tomas-{nivel}" title="{dia.strftime("%d/%m/%Y")}: {tomadas} de {programadas} tomas"></div>'
+        st.markdown(f'<div class="tomas-grid">{celdas}</div>', unsafe_allow_html=True)
+        st.caption("Más oscuro = más dosis tomadas de las programadas. Gris: sin tomas programadas.")
 st.markdown("---")
 
 # --- FORMULARIO AVANZADO PARA AGREGAR MEDICAMENTO ---
 with st.expander("➕ Agregar nuevo medicamento", expanded=True):
+    # Búsqueda en el catálogo (fuera del formulario, para que responda al tipear)
+    catalogo = obtener_catalogo()
+    busqueda_catalogo = st.text_input("Buscar en el catálogo", placeholder="Marca, droga o concentración. Ej: ibu 400",
+                                      key="busqueda_catalogo")
+    sugerencias = catalogo.buscar(busqueda_catalogo)
+
+    def elegir_del_catalogo():
+        entrada = st.session_state.sugerencia_catalogo
+        if entrada:
+            st.session_state.nombre_medicamento = entrada["marca"]
+            st.session_state.droga_medicamento = entrada["droga"]
+            st.session_state.gramaje_medicamento = entrada["gramaje_mg"]
+
+    if busqueda_catalogo:
+        if sugerencias:
+            st.selectbox("Resultados del catálogo", [None] + sugerencias, key="sugerencia_catalogo",
+                         on_change=elegir_del_catalogo,
+                         format_func=lambda entrada: "Elegir para completar el formulario" if entrada is None else entrada["etiqueta"])
+        else:
+            st.caption("No está en el catálogo: completá los datos a mano.")
+
     with st.form("nuevo_medicamento_avanzado", clear_on_submit=True):
         st.write("Información General")
         col_nombre, col_droga, col_gramaje = st.columns(3)
         with col_nombre:
-            nombre = st.text_input("Nombre comercial", placeholder="Ej: Actron")
+            nombre = st.text_input("Nombre comercial", placeholder="Ej: Actron", key="nombre_medicamento")
         with col_droga:
-            droga = st.text_input("Droga", placeholder="Ej: Ibuprofeno")
+            droga = st.text_input("Droga", placeholder="Ej: Ibuprofeno", key="droga_medicamento")
         with col_gramaje:
-            gramaje_mg = st.number_input("Gramaje (mg)", min_value=0.0, step=0.1, format="%.2f")
+            gramaje_mg = st.number_input("Gramaje (mg)", min_value=0.0, step=0.1, format="%.2f", key="gramaje_medicamento")
 
         st.write("Dosis y Frecuencia")
         col_cant, col_unidad, col_tipo_frec = st.columns(3)
@@ -155,22 +273,87 @@ with st.expander("➕ Agregar nuevo medicamento", expanded=True):
             if not all([nombre, droga]) or not frecuencia_valor:
                 st.warning("Por favor, complete todos los campos obligatorios (Nombre, Droga, y detalles de Frecuencia).")
             else:
-                insertar_medicamento(dni, droga, nombre, gramaje_mg, motivo, fecha_inicio, fecha_fin,
-                                     dosis_cantidad, dosis_unidad, frecuencia_tipo, frecuencia_valor,
-                                     stock_inicial, recordatorio, conn=conn)
+                nuevo = dict(droga=droga, nombre=nombre, gramaje_mg=gramaje_mg, motivo=motivo, fecha_inicio=fecha_inicio,
+                             fecha_fin=fecha_fin, dosis_cantidad=dosis_cantidad, dosis_unidad=dosis_unidad,
+                             frecuencia_tipo=frecuencia_tipo, frecuencia_valor=frecuencia_valor,
+                             stock_inicial=stock_inicial, recordatorio=recordatorio)
+                drogas_activas = med_actuales['droga'].dropna() if not med_actuales.empty else []
+                interacciones = obtener_indice_interacciones().verificar(droga, drogas_activas)
+                alergias = obtener_indice_alergias().verificar(droga, alergias_paciente(dni, conn))
+                if interacciones or alergias:
+                    # Se guarda recién cuando el usuario confirma (fuera del formulario)
+                    st.session_state.medicamento_pendiente = nuevo
+                    st.session_state.interacciones_pendientes = interacciones
+                    st.session_state.alergias_pendientes = alergias
+                    st.rerun()
+                insertar_medicamento(dni, ignorar_alergias=True, conn=conn, **nuevo)
                 st.success(f"Medicamento '{nombre}' agregado correctamente.")
                 st.rerun()
 
-# --- Historial de Medicamentos (sin cambios) ---
+    # --- Confirmación cuando la droga nueva choca con una alergia o interactúa con un tratamiento actual ---
+    pendiente = st.session_state.get("medicamento_pendiente")
+    if pendiente:
+        alergias = st.session_state.get("alergias_pendientes", [])
+        if alergias:
+            st.error(f"⛔ Registraste alergia a **{', '.join(alergias)}**, y '{pendiente['nombre']}' "
+                     f"contiene {pendiente['droga']}. No lo tomes sin indicación de tu médico.")
+        if st.session_state.interacciones_pendientes:
+            iconos = {"contraindicada": "⛔", "mayor": "⚠️", "moderada": "ℹ️"}
+            detalle = "\n".join(f"- {iconos.get(i.severidad, '⚠️')} **{i.droga} + {i.otra}** ({i.severidad}): {i.descripcion}"
+                                 for i in st.session_state.interacciones_pendientes)
+            st.warning(f"'{pendiente['nombre']}' puede interactuar con tus tratamientos actuales:\n\n{detalle}\n\n"
+                       "Consultá con tu médico antes de combinarlos.")
+        col_guardar, col_cancelar = st.columns(2)
+        if col_guardar.button("Guardar de todos modos", key="confirmar_interaccion"):
+            insertar_medicamento(dni, ignorar_alergias=True, conn=conn, **pendiente)
+            del st.session_state.medicamento_pendiente, st.session_state.interacciones_pendientes, st.session_state.alergias_pendientes
+            st.toast(f"Medicamento '{pendiente['nombre']}' agregado.", icon="💊")
+            st.rerun()
+        if col_cancelar.button("Cancelar", key="cancelar_interaccion"):
+            del st.session_state.medicamento_pendiente, st.session_state.interacciones_pendientes, st.session_state.alergias_pendientes
+            st.rerun()
+
+# --- Historial de Medicamentos (paginado, filtrado en la base) ---
 st.markdown("---")
 st.subheader("📜 Historial de medicamentos finalizados")
-med_historial = get_medicamentos(dni=dni, solo_finalizados=True, conn=conn)
+
+# Pila de cursores: el último es (fecha_fin, id_medicamento) donde arranca la página actual
+def reiniciar_historial():
+    st.session_state.historial_cursores = [None]
+
+def avanzar_historial(cursor):
+    st.session_state.historial_cursores.append(cursor)
+
+def retroceder_historial():
+    st.session_state.historial_cursores.pop()
+
+col_periodo, col_droga, col_motivo = st.columns(3)
+periodo = col_periodo.date_input("Período", value=(), format="DD/MM/YYYY", key="historial_periodo", on_change=reiniciar_historial)
+filtro_droga = col_droga.text_input("Droga o nombre", key="historial_droga", on_change=reiniciar_historial)
+filtro_motivo = col_motivo.text_input("Motivo", key="historial_motivo", on_change=reiniciar_historial)
+desde, hasta = (tuple(periodo) + (None, None))[:2]
+filtros = dict(desde=desde, hasta=hasta, droga=filtro_droga.strip() or None, motivo=filtro_motivo.strip() or None)
+
+total_historial = contar_historial_medicamentos(dni, **filtros)
+cursores = st.session_state.setdefault("historial_cursores", [None])
+med_historial = get_historial_medicamentos(dni, despues_de=cursores[-1], conn=conn, **filtros) if total_historial else pd.DataFrame()
 if med_historial.empty:
-    st.info("Aún no hay medicamentos finalizados.")
+    if any(filtros.values()):
+        st.info("Ningún tratamiento finalizado coincide con los filtros.")
+    else:
+        st.info("Aún no hay medicamentos finalizados.")
 else:
-    med_historial['dosis_formateada'] = med_historial.apply(formatear_dosis_texto, axis=1)
+    med_historial['dosis_formateada'] = columna_dosis_texto(med_historial)
     st.dataframe(med_historial[["nombre", "dosis_formateada", "motivo", "fecha_inicio", "fecha_fin"]],
                  use_container_width=True, hide_index=True,
                  column_config={"nombre": "Nombre", "dosis_formateada": "Dosis y Frecuencia", "motivo": "Motivo",
                                 "fecha_inicio": st.column_config.DateColumn("Desde", format="DD/MM/YYYY"),
                                 "fecha_fin": st.column_config.DateColumn("Hasta", format="DD/MM/YYYY")})
+    paginas = -(-total_historial // HISTORIAL_POR_PAGINA)
+    col_anterior, col_pagina, col_siguiente = st.columns([1, 2, 1])
+    col_anterior.button("← Más recientes", key="historial_anterior", disabled=len(cursores) == 1,
+                        on_click=retroceder_historial)
+    col_pagina.caption(f"Página {len(cursores)} de {paginas} · {total_historial} tratamiento(s)")
+    ultima = med_historial.iloc[-1]
+    col_siguiente.button("Más antiguos →", key="historial_siguiente", disabled=len(cursores) >= paginas,
+                         on_click=avanzar_historial, args=((ultima['fecha_fin'], int(ultima['id_medicamento'])),))
@@ -0,0 +1,76 @@
+# pruebas/bench_avisos.py
+# Benchmark del servicio de avisos de dosis (fAvisosDosis.py): carga muchos medicamentos con
+# horarios variados y simula un día entero minuto a minuto, como el proceso real. Informa
+# cuánto tarda la carga y cuántos avisos por segundo despacha, y controla que los avisos del
+# día sean exactamente las tomas que calcula tomas_del_dia (la misma grilla que la app).
+# No usa la base; el resultado es el mismo en cada corrida (semilla fija).
+#     python pruebas/bench_avisos.py [medicamentos]
+import json
+import os
+import random
+import sys
+from collections import Counter
+from datetime import date, datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fAvisosDosis import ServicioAvisosDosis
+from fmedi import horario_de, tomas_del_dia
+
+MEDICAMENTOS = 500_000
+DIA = date(2026, 10, 19)  # lunes
+INICIOS = [DIA - timedelta(days=d) for d in (1, 7, 30, 95)]
+FRECUENCIAS = (
+    [("Cada 'X' horas", json.dumps({"intervalo_horas": h})) for h in (6, 8, 12, 24)]
+    + [("En horarios específicos del día", json.dumps({"horarios_dia": horas}))
+       for horas in (["08:00"], ["08:00", "20:00"], ["07:30", "13:00", "21:00"])]
+    + [("En días específicos de la semana",
+        json.dumps({"dias_semana": ["Lunes", "Jueves"], "horarios_en_dias": ["09:00"]}))]
+)
+
+def armar_medicamentos(cantidad):
+    """(id_medicamento, id_paciente, tipo, valor, fecha_inicio) al azar, siempre los mismos."""
+    azar = random.Random(1)
+    return [(i, i // 3, *azar.choice(FRECUENCIAS), azar.choice(INICIOS)) for i in range(cantidad)]
+
+def avisos_esperados(medicamentos, desde, hasta):
+    """Tomas programadas en (desde, hasta] según tomas_del_dia, contadas por combinación."""
+    combinaciones = Counter((tipo, valor, inicio) for _, _, tipo, valor, inicio in medicamentos)
+    total = 0
+    for (tipo, valor, inicio), veces in combinaciones.items():
+        horario = horario_de(tipo, valor)
+        tomas = [m for dia in (desde.date(), hasta.date()) for m in tomas_del_dia(horario, dia, inicio)]
+        total += veces * sum(1 for momento in tomas if desde < momento <= hasta)
+    return total
+
+def main(cantidad=MEDICAMENTOS):
+    medicamentos = armar_medicamentos(cantidad)
+    desde = datetime.combine(DIA, datetime.min.time())
+    hasta = desde + timedelta(days=1)
+
+    comienzo = perf_counter()
+    servicio = ServicioAvisosDosis(desde)
+    for id_medicamento, id_paciente, tipo, valor, inicio in medicamentos:
+        servicio.cargar(id_medicamento, id_paciente, tipo, valor, inicio, None)
+    carga = perf_counter() - comienzo
+
+    # Lo que ya vencía al arrancar (tomas de las 00:00) sale en el primer minuto y no cuenta
+    servicio.avanzar(desde)
+    avisos, minuto = 0, desde
+    comienzo = perf_counter()
+    while minuto < hasta:
+        minuto += timedelta(minutes=1)
+        avisos += len(servicio.avanzar(minuto))
+    simulacion = perf_counter() - comienzo
+
+    esperados = avisos_esperados(medicamentos, desde, hasta)
+    print(f"{cantidad} medicamentos · carga {carga:.2f} s · {avisos} avisos en el día"
+          f" en {simulacion:.2f} s · {avisos / simulacion:,.0f} avisos/s")
+    if avisos != esperados:
+        print(f"FALLA: se esperaban {esperados} avisos según tomas_del_dia")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:2])))
@@ -0,0 +1,84 @@
+# pruebas/bench_conflictos.py
+# Benchmark de AgendaIntervalos: mide cuánto tarda buscar superposiciones en agendas de
+# médicos cada vez más grandes. Como la consulta es un bisect más los pocos turnos de la
+# ventana, el tiempo por consulta tiene que mantenerse casi igual aunque la agenda crezca
+# mil veces. Antes controla una agenda con turnos y ocurrencias de series que empiezan a la
+# misma hora. No usa la base.
+#     python pruebas/bench_conflictos.py
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fCalendario import AgendaIntervalos, DURACION_TURNO_MIN
+
+TAMANIOS = (1_000, 10_000, 100_000, 1_000_000)
+CONSULTAS = 20_000
+# La agenda crece mil veces; con un bisect la consulta se hace apenas más lenta (log n y
+# caché del procesador); recorrerla entera la haría unas mil veces más lenta.
+CRECIMIENTO_ADMITIDO = 20
+
+def armar_agenda(cantidad, desde=datetime(2020, 1, 1, 8, 0)):
+    """Turnos de 30 minutos, uno por hora, agregados en orden como al cargarlos de la base."""
+    agenda = AgendaIntervalos()
+    paso, duracion = timedelta(hours=1), timedelta(minutes=DURACION_TURNO_MIN)
+    for i in range(cantidad):
+        inicio = desde + i * paso
+        agenda.agregar({"id_turno": i, "inicio": inicio, "fin": inicio + duracion,
+                        "medico": "Bench", "lugar": None, "agenda": "medico"})
+    return agenda, desde, desde + cantidad * paso
+
+def medir(agenda, desde, hasta, consultas=CONSULTAS):
+    """Microsegundos promedio por consulta, con turnos nuevos en medias horas al azar de la agenda."""
+    azar = random.Random(1)
+    minutos = int((hasta - desde).total_seconds() // 60)
+    candidatos = [desde + timedelta(minutes=DURACION_TURNO_MIN * azar.randrange(minutos // DURACION_TURNO_MIN))
+                  for _ in range(consultas)]
+    duracion = timedelta(minutes=DURACION_TURNO_MIN)
+    comienzo = perf_counter()
+    choques = sum(1 for inicio in candidatos if agenda.superpuestos(inicio, inicio + duracion))
+    return (perf_counter() - comienzo) / consultas * 1e6, choques
+
+def verificar_ids_mixtos(desde=datetime(2020, 1, 1, 8, 0)):
+    """
+    Turnos (id entero) y ocurrencias de series ("serie-N-AAAA-MM-DD") que empiezan a la
+    misma hora en la misma agenda: agregar, consultar y quitar no pueden comparar int con str.
+    """
+    agenda, duracion = AgendaIntervalos(), timedelta(minutes=DURACION_TURNO_MIN)
+    ids = [7, "serie-3-2020-01-01", 12, "serie-1-2020-01-01"]
+    for id_turno in ids:
+        agenda.agregar({"id_turno": id_turno, "inicio": desde, "fin": desde + duracion,
+                        "medico": "Bench", "lugar": None, "agenda": "medico"})
+    encontrados = {t["id_turno"] for t in agenda.superpuestos(desde, desde + duracion)}
+    sin_serie = {t["id_turno"] for t in agenda.superpuestos(desde, desde + duracion, excluir="serie-3-2020-01-01")}
+    agenda.quitar(7)
+    agenda.quitar("serie-1-2020-01-01")
+    return (encontrados == set(ids) and sin_serie == set(ids) - {"serie-3-2020-01-01"}
+            and len(agenda) == 2 and len(agenda.superpuestos(desde, desde + duracion)) == 2)
+
+def main():
+    if not verificar_ids_mixtos():
+        print("FALLA: turnos y ocurrencias de series que empiezan a la misma hora")
+        return 1
+    tiempos = []
+    for cantidad in TAMANIOS:
+        comienzo = perf_counter()
+        agenda, desde, hasta = armar_agenda(cantidad)
+        carga = perf_counter() - comienzo
+        microsegundos, choques = medir(agenda, desde, hasta)
+        tiempos.append(microsegundos)
+        print(f"{cantidad:>9} turnos · carga {carga:6.2f} s · {microsegundos:6.2f} µs por consulta"
+              f" · {choques / CONSULTAS:.0%} con conflicto")
+
+    crecimiento = tiempos[-1] / tiempos[0]
+    print(f"De {TAMANIOS[0]} a {TAMANIOS[-1]} turnos la consulta es {crecimiento:.1f} veces más lenta")
+    if crecimiento > CRECIMIENTO_ADMITIDO:
+        print(f"FALLA: más de {CRECIMIENTO_ADMITIDO} veces")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
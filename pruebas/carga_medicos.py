@@ -0,0 +1,83 @@
+# pruebas/carga_medicos.py
+# Prueba de carga de obtener_o_crear_medico: cientos de reservas en paralelo que dan de
+# alta los mismos médicos nuevos. Tiene que terminar sin errores de clave duplicada, con
+# un solo id por (nombre, especialidad) y con una sola consulta por alta.
+#     python pruebas/carga_medicos.py [reservas] [hilos]
+# Usa la base configurada en .streamlit/secrets.toml; si no hay base, se omite.
+import os
+import sys
+import threading
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import psycopg2.extensions
+from functions import connect_to_supabase
+from fCalendario import asegurar_esquema_medicos, obtener_o_crear_medico
+
+MEDICOS_DISTINTOS = 10
+consultas = Counter()
+
+class CursorContador(psycopg2.extensions.cursor):
+    """Cuenta las consultas que manda cada hilo."""
+    def execute(self, query, vars=None):
+        consultas[threading.get_ident()] += 1
+        return super().execute(query, vars)
+
+def _conectar_contando(conectar):
+    def conectar_con_contador(*args, **kwargs):
+        kwargs.setdefault("cursor_factory", CursorContador)
+        return conectar(*args, **kwargs)
+    return conectar_con_contador
+
+def main(reservas=300, hilos=50):
+    conn = connect_to_supabase()
+    if conn is None:
+        print("Sin base de datos: se omite la prueba de carga de médicos.")
+        return 0
+    asegurar_esquema_medicos()
+
+    prefijo = f"Prueba carga {uuid.uuid4().hex[:8]}"
+    pedidos = [(f"{prefijo} {i % MEDICOS_DISTINTOS}", "Clínica") for i in range(reservas)]
+    psycopg2.connect = _conectar_contando(psycopg2.connect)
+
+    ids, errores = defaultdict(set), []
+    def reservar(pedido):
+        antes = consultas[threading.get_ident()]
+        try:
+            ids[pedido].add(obtener_o_crear_medico(*pedido))
+        except Exception as e:
+            errores.append(e)
+        return consultas[threading.get_ident()] - antes
+
+    try:
+        with ThreadPoolExecutor(hilos) as pool:
+            por_alta = Counter(pool.map(reservar, pedidos))
+
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM medicos WHERE nombre LIKE %s", (f"{prefijo} %",))
+            filas = cur.fetchone()[0]
+        print(f"{reservas} reservas en {hilos} hilos · errores: {len(errores)} · "
+              f"médicos creados: {filas} · consultas por alta: {dict(por_alta)}")
+
+        fallas = []
+        if errores:
+            fallas.append(f"hubo errores, por ejemplo: {errores[0]}")
+        if filas != MEDICOS_DISTINTOS or any(len(v) != 1 for v in ids.values()):
+            fallas.append("el mismo médico quedó con más de un id")
+        if set(por_alta) != {1}:
+            fallas.append("alguna alta necesitó más de una consulta")
+        for falla in fallas:
+            print(f"FALLA: {falla}")
+        return 1 if fallas else 0
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM medicos WHERE nombre LIKE %s", (f"{prefijo} %",))
+        conn.commit()
+        conn.close()
+
+if __name__ == "__main__":
+    sys.exit(main(*map(int, sys.argv[1:3])))